@@ -0,0 +1,102 @@
+import zmq
+import time
+import json
+import argparse
+
+from common import port_map
+from main import Cluster
+
+
+"""
+Anti-entropy benchmark for the eventual consistency level: every server drops a share of the broadcasts it receives
+(drop_rate), a burst of writes is spread over the servers, and we measure how long after the last write the merkle
+roots of all the servers are equal, i.e. the replicas have converged. It also reports the broadcasts dropped,
+the entries repaired and the bytes exchanged by the anti-entropy until then: the bytes per repaired entry should stay
+flat when the number of keys grows, the sync costs what the replicas diverged, not the size of the keyspace.
+A drop rate of 0 shows the cost of the idle rounds, an interval of 0 disables the anti-entropy (no convergence).
+
+Example:
+    python bench/anti_entropy_bench.py --keys 1000 10000 --drop-rates 0.01 0.1 --intervals 0.5 1
+"""
+
+
+def stats(socket):
+    socket.send_json({"type": "stats", "key": None, "value": None})
+    return json.loads(socket.recv_string().split(":", 1)[1])
+
+
+def run(num_keys, drop_rate, interval, args):
+    ports = port_map(args.servers, args.base_port)
+    server_config = {"api_mode": "router", "log": "off", "drop_rate": drop_rate, "anti_entropy_interval": interval}
+    cluster = Cluster("eventual", args.servers, ports, server_config, quiet=True)
+    context = zmq.Context()
+    try:
+        cluster.wait_ready()
+        poller = zmq.Poller()
+        sockets = []
+        stats_sockets = []
+        for i in ports:
+            socket = context.socket(zmq.DEALER)
+            socket.connect(f"tcp://localhost:{ports[i][2]}")
+            poller.register(socket, zmq.POLLIN)
+            sockets.append(socket)
+            stats_socket = context.socket(zmq.REQ)
+            stats_socket.connect(f"tcp://localhost:{ports[i][2]}")
+            stats_sockets.append(stats_socket)
+
+        # every key is written once, on the servers in turn
+        in_flight = {socket: 0 for socket in sockets}
+        sent = done = 0
+        while done < num_keys:
+            for socket in sockets:
+                while in_flight[socket] < args.window and sent < num_keys:
+                    socket.send_multipart([b"", json.dumps({"type": "set", "key": f"key{sent}", "value": sent,
+                                                             "request_id": sent}).encode()])
+                    in_flight[socket] += 1
+                    sent += 1
+            for socket in dict(poller.poll(1000)):
+                while socket.poll(0):
+                    socket.recv_multipart()
+                    in_flight[socket] -= 1
+                    done += 1
+
+        start = time.perf_counter()
+        convergence = float("nan")
+        while time.perf_counter() - start < args.timeout:
+            snapshots = [stats(socket) for socket in stats_sockets]
+            if len({snapshot["gauges"]["merkle_root"] for snapshot in snapshots}) == 1:
+                convergence = time.perf_counter() - start
+                break
+            time.sleep(0.02)
+        counters = [snapshot["counters"] for snapshot in snapshots]
+        total = lambda name: sum(counter.get(name, 0) for counter in counters)
+        return convergence, total("messages_dropped"), total("anti_entropy_repaired"), total("anti_entropy_bytes")
+    finally:
+        context.destroy(linger=0)
+        cluster._destroy()
+        time.sleep(0.5) # let the ports go before the next run
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Convergence time and sync cost of the anti-entropy after induced message loss.")
+    parser.add_argument("--servers", type=int, default=3)
+    parser.add_argument("--keys", type=int, nargs="+", default=[1000, 10000], help="keys written, once each")
+    parser.add_argument("--drop-rates", type=float, nargs="+", default=[0.01, 0.1])
+    parser.add_argument("--intervals", type=float, nargs="+", default=[1], help="seconds between two anti-entropy rounds of a server")
+    parser.add_argument("--window", type=int, default=64, help="writes in flight per server")
+    parser.add_argument("--timeout", type=float, default=30, help="seconds to wait for the convergence")
+    parser.add_argument("--base-port", type=int, default=8100)
+    args = parser.parse_args()
+
+    print(f"{'keys':>7} {'drop':>5} {'interval':>8} {'converged s':>11} {'dropped':>7} {'repaired':>8} {'bytes':>9} {'bytes/repair':>12}")
+    for num_keys in args.keys:
+        for drop_rate in args.drop_rates:
+            for interval in args.intervals:
+                convergence, dropped, repaired, sync_bytes = run(num_keys, drop_rate, interval, args)
+                per_repair = sync_bytes / repaired if repaired else float("nan")
+                print(f"{num_keys:>7} {drop_rate:>5} {interval:>8} {convergence:>11.2f} {dropped:>7} {repaired:>8} "
+                      f"{sync_bytes:>9} {per_repair:>12.0f}", flush=True)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,72 @@
+import zmq
+import time
+import argparse
+
+from common import port_map
+from main import Cluster
+from codec import CODECS, codec_of
+
+
+"""
+Bulk benchmark of the multi-key requests: loads --keys keys into a cluster with one set per key, then with an mset
+of --chunk keys per request, and reads them back with one get per key, then with mgets, one client with one
+request in flight (the worst case of a round trip per key), and reports the keys per second of each.
+
+Example:
+    python bench/bulk_bench.py --levels linearizability sequential --keys 10000 --chunk 100
+"""
+
+
+def run(consistency_level, args):
+    ports = port_map(args.servers, args.base_port)
+    server_config = {"log": "off", "codec": args.codec}
+    cluster = Cluster(consistency_level, args.servers, ports, server_config, quiet=True)
+    context = zmq.Context()
+    codec = CODECS[args.codec]
+    try:
+        cluster.wait_ready()
+        socket = context.socket(zmq.REQ)
+        socket.connect(f"tcp://localhost:{ports['0'][2]}")
+
+        def request(request_type, keys, values):
+            socket.send_multipart(codec.encode_request({"type": request_type, "key": keys, "value": values}))
+            frames = socket.recv_multipart()
+            codec_of(frames).decode_response(frames)
+
+        keys = [f"key{i}" for i in range(args.keys)]
+        chunks = [keys[i:i + args.chunk] for i in range(0, args.keys, args.chunk)]
+        rates = []
+        for request_type, requests in [("set", [(key, i) for i, key in enumerate(keys)]),
+                                       ("mset", [(chunk, list(range(len(chunk)))) for chunk in chunks]),
+                                       ("get", [(key, None) for key in keys]),
+                                       ("mget", [(chunk, None) for chunk in chunks])]:
+            start = time.perf_counter()
+            for key, value in requests:
+                request(request_type, key, value)
+            rates.append(args.keys / (time.perf_counter() - start))
+        return rates
+    finally:
+        context.destroy(linger=0)
+        cluster._destroy()
+        time.sleep(0.5) # let the ports go before the next run
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Keys per second of single-key and multi-key loads and reads.")
+    parser.add_argument("--levels", nargs="+", default=["linearizability", "sequential", "eventual", "causal"],
+                        choices=["linearizability", "sequential", "eventual", "causal"])
+    parser.add_argument("--servers", type=int, default=3)
+    parser.add_argument("--keys", type=int, default=10000)
+    parser.add_argument("--chunk", type=int, default=100, help="keys per mset and mget")
+    parser.add_argument("--codec", default="json", choices=list(CODECS))
+    parser.add_argument("--base-port", type=int, default=8200)
+    args = parser.parse_args()
+
+    print(f"{'level':<15} {'set keys/s':>10} {'mset keys/s':>11} {'get keys/s':>10} {'mget keys/s':>11}")
+    for consistency_level in args.levels:
+        sets, msets, gets, mgets = run(consistency_level, args)
+        print(f"{consistency_level:<15} {sets:>10.0f} {msets:>11.0f} {gets:>10.0f} {mgets:>11.0f}", flush=True)
+
+
+if __name__ == "__main__":
+    main()
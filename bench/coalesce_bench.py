@@ -0,0 +1,125 @@
+import zmq
+import time
+import json
+import random
+import argparse
+import itertools
+import threading
+
+from common import port_map, Histogram
+from main import SimulatedCluster
+from network import VirtualNetwork
+
+
+"""
+Benchmark of the write coalescing of eventual consistency (coalesce_interval in `Server_eventual`): for every interval
+it drives an in-process cluster with a closed loop of --window writes in flight per server for --duration seconds,
+on keys drawn from a zipf distribution (--skew, so a few keys are hot), and reports the broadcasts sent per write and
+the share of the writes that were never broadcasted because a later write of their key replaced them.
+Meanwhile a probe thread writes a probe key on the first server and reads it on the last one until it sees the write:
+the time it takes is the staleness the coalescing adds to the latency of the network.
+
+Example:
+    python bench/coalesce_bench.py --intervals 0 1 10 100 --skew 1.1
+"""
+
+
+def zipf_weights(num_keys, skew):
+    return list(itertools.accumulate(1 / (rank + 1) ** skew for rank in range(num_keys)))
+
+
+def probe(cluster, ports, stop, histogram):
+    """
+    Write the probe key on the first server, then read it on the last one until the write is visible, again and again.
+    """
+    first, last = cluster.context.socket(zmq.REQ), cluster.context.socket(zmq.REQ)
+    first.connect(cluster.address(ports[min(ports)][2]))
+    last.connect(cluster.address(ports[max(ports)][2]))
+    for value in itertools.count(1):
+        if stop.is_set():
+            break
+        first.send_json({"type": "set", "key": "probe", "value": value})
+        first.recv()
+        written = time.perf_counter()
+        while not stop.is_set():
+            last.send_json({"type": "get", "key": "probe", "value": None})
+            if last.recv_string() == f"probe:{value}":
+                histogram.record(time.perf_counter() - written)
+                break
+        time.sleep(0.01)
+    first.close(linger=0)
+    last.close(linger=0)
+
+
+def run(interval, args, weights):
+    ports = port_map(args.servers, args.base_port)
+    network = VirtualNetwork(latency=args.latency, seed=args.seed)
+    server_config = {"api_mode": "router", "coalesce_interval": interval, "anti_entropy_interval": 0}
+    cluster = SimulatedCluster("eventual", args.servers, ports, server_config, quiet=True, network=network)
+    try:
+        cluster.wait_ready()
+        poller = zmq.Poller()
+        sockets = []
+        for i in ports:
+            socket = cluster.context.socket(zmq.DEALER)
+            socket.connect(cluster.address(ports[i][2]))
+            poller.register(socket, zmq.POLLIN)
+            sockets.append(socket)
+        rng = random.Random(args.seed)
+        keys = rng.choices(range(len(weights)), cum_weights=weights, k=100000)
+
+        staleness = Histogram()
+        stop = threading.Event()
+        prober = threading.Thread(target=probe, args=(cluster, ports, stop, staleness), daemon=True)
+        prober.start()
+
+        in_flight = {socket: 0 for socket in sockets}
+        request_id = done = 0
+        end = time.perf_counter() + args.duration
+        while time.perf_counter() < end:
+            for socket in sockets:
+                while in_flight[socket] < args.window:
+                    socket.send_multipart([b"", json.dumps({"type": "set", "key": f"key{keys[request_id % len(keys)]}",
+                                                             "value": request_id, "request_id": request_id}).encode()])
+                    in_flight[socket] += 1
+                    request_id += 1
+            for socket in dict(poller.poll(100)):
+                while socket.poll(0):
+                    socket.recv_multipart()
+                    in_flight[socket] -= 1
+                    done += 1
+        stop.set()
+        prober.join()
+        for socket in sockets:
+            socket.close(linger=0)
+        counters = [server.metrics.snapshot()["counters"] for server in cluster.servers]
+        total = lambda name: sum(counter.get(name, 0) for counter in counters)
+        writes = done + staleness.count
+        return done / args.duration, total("messages_sent") / writes, total("writes_coalesced") / writes, staleness.summary()
+    finally:
+        cluster._destroy()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Broadcasts saved against staleness added by the write coalescing of eventual consistency.")
+    parser.add_argument("--intervals", type=float, nargs="+", default=[0, 1, 10, 100], help="coalesce_interval in milliseconds, 0 is off")
+    parser.add_argument("--servers", type=int, default=3)
+    parser.add_argument("--duration", type=float, default=5, help="seconds of load per run")
+    parser.add_argument("--window", type=int, default=8, help="writes in flight per server")
+    parser.add_argument("--keys", type=int, default=10000)
+    parser.add_argument("--skew", type=float, default=1.1, help="exponent of the zipf distribution of the keys")
+    parser.add_argument("--latency", type=float, default=1, help="milliseconds between two servers")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--base-port", type=int, default=10800, help="only names of inproc sockets")
+    args = parser.parse_args()
+
+    weights = zipf_weights(args.keys, args.skew)
+    print(f"{'interval ms':>11} {'writes/s':>8} {'broadcasts/write':>16} {'coalesced':>9} {'stale p50 ms':>12} {'stale p99 ms':>12}")
+    for interval in args.intervals:
+        throughput, broadcasts, coalesced, staleness = run(interval, args, weights)
+        print(f"{interval:>11g} {throughput:>8.0f} {broadcasts:>16.4f} {coalesced:>9.1%} "
+              f"{staleness['p50_ms'] or float('nan'):>12.2f} {staleness['p99_ms'] or float('nan'):>12.2f}", flush=True)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,64 @@
+import os
+import sys
+import time
+import argparse
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from codec import CODECS
+
+
+"""
+Micro-benchmark of the wire formats: encode and decode cost, and bytes on the wire, of the json and binary codecs
+for a broadcast message, a client request and a client response carrying values of 10 B, 1 KB and 1 MB.
+
+Example:
+    python bench/codec_bench.py
+"""
+
+
+SIZES = {"10B": 10, "1KB": 1024, "1MB": 1024 * 1024}
+
+
+def messages(size):
+    value = "x" * size
+    return {
+        "message": ("message", {"timestamp": 123456, "id": 2, "ack": 0, "operations": [("set", "some-key", value)]}),
+        "request": ("request", {"type": "set", "key": "some-key", "value": value, "request_id": 42}),
+        "response": ("response", {"type": "get", "key": "some-key", "value": value}),
+    }
+
+
+def measure(codec, kind, message, min_time):
+    encode = getattr(codec, f"encode_{kind}")
+    decode = getattr(codec, f"decode_{kind}")
+    frames = encode(message)
+    wire = sum(len(frame) for frame in frames)
+    rounds = 0
+    encode_time = decode_time = 0.0
+    while encode_time + decode_time < min_time:
+        start = time.perf_counter()
+        frames = encode(message)
+        middle = time.perf_counter()
+        decode(frames)
+        end = time.perf_counter()
+        encode_time += middle - start
+        decode_time += end - middle
+        rounds += 1
+    return 1e6 * encode_time / rounds, 1e6 * decode_time / rounds, wire
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Encode/decode cost and size of the json and binary codecs.")
+    parser.add_argument("--min-time", type=float, default=0.5, help="seconds spent on each measurement")
+    args = parser.parse_args()
+
+    print(f"{'kind':<9} {'size':>5} {'codec':<7} {'encode us':>10} {'decode us':>10} {'bytes':>9}")
+    for size_name, size in SIZES.items():
+        for name, (kind, message) in messages(size).items():
+            for codec in CODECS.values():
+                encode_us, decode_us, wire = measure(codec, kind, message, args.min_time)
+                print(f"{name:<9} {size_name:>5} {codec.name:<7} {encode_us:>10.2f} {decode_us:>10.2f} {wire:>9}")
+
+
+if __name__ == "__main__":
+    main()
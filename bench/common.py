@@ -0,0 +1,93 @@
+import os
+import sys
+import math
+from collections import defaultdict
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+"""
+Helpers shared by the benchmark scripts.
+"""
+
+
+def port_map(num_servers, base_port, watch=False):
+    """
+    The port_number dict of a cluster, in the format of the test configuration files, with a watch port if watch.
+    """
+    return {str(i): [base_port + 10 * i + j for j in range(4 if watch else 3)] for i in range(num_servers)}
+
+
+def rss_kb(pid):
+    """
+    Resident set size of the process in KB, read from /proc (Linux only).
+    """
+    with open(f"/proc/{pid}/status") as f:
+        for line in f:
+            if line.startswith("VmRSS:"):
+                return int(line.split()[1])
+    return 0
+
+
+def percentile(sorted_values, p):
+    """
+    The p-th percentile (0 <= p <= 100) of an already sorted list.
+    """
+    if not sorted_values:
+        return float("nan")
+    return sorted_values[min(len(sorted_values) - 1, int(len(sorted_values) * p / 100))]
+
+
+class Histogram:
+    """
+    Latency histogram with logarithmic buckets (each one GROWTH times wider than the previous), so the histograms of
+    several load processes can be merged and a percentile is off by at most 2%.
+    """
+    GROWTH = 1.02
+
+    def __init__(self):
+        self.buckets = defaultdict(int) # bucket index -> number of latencies, latencies in microseconds
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def record(self, seconds):
+        microseconds = max(1e6 * seconds, 1.0)
+        self.buckets[int(math.log(microseconds, self.GROWTH))] += 1
+        self.count += 1
+        self.total += seconds
+        self.max = max(self.max, seconds)
+
+    def merge(self, other):
+        for bucket, count in other.buckets.items():
+            self.buckets[bucket] += count
+        self.count += other.count
+        self.total += other.total
+        self.max = max(self.max, other.max)
+
+    def percentile(self, p):
+        """
+        The upper bound in seconds of the bucket holding the p-th percentile (0 <= p <= 100).
+        """
+        if not self.count:
+            return float("nan")
+        seen = 0
+        for bucket in sorted(self.buckets):
+            seen += self.buckets[bucket]
+            if seen >= self.count * p / 100:
+                return min(self.GROWTH ** (bucket + 1) / 1e6, self.max)
+        return self.max
+
+    def summary(self):
+        """
+        Machine-readable summary: count, mean, p50, p99, p999 and max in milliseconds, and the [upper bound us, count] buckets.
+        """
+        if not self.count: # no nan in the json results
+            return {"count": 0, "mean_ms": None, "p50_ms": None, "p99_ms": None, "p999_ms": None, "max_ms": None, "buckets": []}
+        return {"count": self.count,
+                "mean_ms": 1000 * self.total / self.count,
+                "p50_ms": 1000 * self.percentile(50),
+                "p99_ms": 1000 * self.percentile(99),
+                "p999_ms": 1000 * self.percentile(99.9),
+                "max_ms": 1000 * self.max,
+                "buckets": [[round(self.GROWTH ** (bucket + 1), 1), self.buckets[bucket]] for bucket in sorted(self.buckets)]}
@@ -0,0 +1,112 @@
+import time
+import random
+import argparse
+import multiprocessing
+
+from common import rss_kb
+from storage import STORAGES
+from expiry import TimingWheel, LruSample
+
+
+"""
+Benchmark of the expiry of the memory-bounded store (see "ttl" in `Server`): it fills a store with --keys keys like
+`Server._write` does for a set with a ttl (the store, the deadlines and the timing wheel), as in a steady state where
+the keys are written with ttls spread over [--ttl-min, --ttl-max] seconds, so their remaining ttls are spread over
+[0, --ttl-max]. It then runs --seconds seconds of that steady state on a simulated clock: every second about as many
+new unique keys are written as expire, and the wheel is advanced tick by tick and the due keys are removed. It reports the cost of the expiry per second of that steady state, of the timing wheel and of a scan
+of the deadlines per tick for comparison, and the memory per key. With --lru the keys are also in an `LruSample`,
+and the cost of evicting as many keys as expire is reported too. The ordering of the expire operations between
+the servers is not included, it is the one of any write (see bench/leader_bench.py).
+
+Example:
+    python bench/expiry_bench.py --keys 1000000 10000000 --ttl-min 60 --ttl-max 600
+"""
+
+
+def run(num_keys, args, results):
+    rss_before = rss_kb(multiprocessing.current_process().pid)
+    rng = random.Random(args.seed)
+    store = STORAGES[args.storage]()
+    deadlines = {}
+    now = 0
+    wheel = TimingWheel(args.tick, now=now)
+    lru = LruSample(seed=args.seed) if args.lru else None
+
+    def write(key, value, deadline):
+        store.put(key, value)
+        deadlines[key] = deadline
+        wheel.schedule(key, deadline)
+        if lru is not None:
+            lru.touch(key)
+
+    start = time.perf_counter()
+    for i in range(num_keys):
+        write(f"key{i}", i, rng.randrange(1000 * args.ttl_max))
+    fill_time = time.perf_counter() - start
+    bytes_per_key = 1024 * (rss_kb(multiprocessing.current_process().pid) - rss_before) / num_keys
+
+    rate = num_keys // args.ttl_max # new keys per second, as many as expire while the first keys do
+    scan_time = 0
+    if args.scan:
+        start = time.perf_counter()
+        [key for key, deadline in deadlines.items() if deadline <= now]
+        scan_time = time.perf_counter() - start
+    expiry_time = 0
+    expired = 0
+    next_key = num_keys
+    for second in range(args.seconds):
+        for i in range(next_key, next_key + rate):
+            write(f"key{i}", i, now + rng.randrange(1000 * args.ttl_min, 1000 * args.ttl_max))
+        next_key += rate
+        start = time.perf_counter()
+        for tick in range(1000 // args.tick):
+            now += args.tick
+            for key in wheel.advance(now):
+                store.delete(key)
+                del deadlines[key]
+                if lru is not None:
+                    lru.discard(key)
+                expired += 1
+        expiry_time += time.perf_counter() - start
+    evict_time = 0
+    if lru is not None:
+        evictions = min(len(lru), expired // args.seconds)
+        start = time.perf_counter()
+        for _ in range(evictions):
+            key = lru.victim()
+            store.delete(key)
+            wheel.cancel(key)
+            del deadlines[key]
+        evict_time = (time.perf_counter() - start) * max(1, expired // args.seconds) / max(1, evictions)
+    results.put((fill_time, bytes_per_key, expired / args.seconds, 1000 * expiry_time / args.seconds,
+                 1000 * scan_time * (1000 // args.tick), 1000 * evict_time, store.size()))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Cost per second of the expiry of the keys with a ttl, with a timing wheel.")
+    parser.add_argument("--keys", type=int, nargs="+", default=[1000000, 10000000])
+    parser.add_argument("--ttl-min", type=int, default=60, help="seconds")
+    parser.add_argument("--ttl-max", type=int, default=600, help="seconds")
+    parser.add_argument("--seconds", type=int, default=30, help="seconds of steady state on the simulated clock")
+    parser.add_argument("--tick", type=int, default=100, help="milliseconds, expiry_tick of the servers")
+    parser.add_argument("--storage", default="dict", choices=list(STORAGES))
+    parser.add_argument("--lru", action="store_true", help="also keep the keys in an LruSample and time the evictions")
+    parser.add_argument("--no-scan", dest="scan", action="store_false", help="skip the scan of the deadlines")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    print(f"{'keys':>9} {'fill s':>7} {'bytes/key':>9} {'expired/s':>9} {'wheel ms/s':>10} {'us/key':>6} "
+          f"{'scan ms/s':>9} {'evict ms/s':>10}")
+    for num_keys in args.keys:
+        results = multiprocessing.Queue()
+        process = multiprocessing.Process(target=run, args=(num_keys, args, results))
+        process.start()
+        fill, bytes_per_key, expired, wheel_ms, scan_ms, evict_ms, size = results.get()
+        process.join()
+        print(f"{num_keys:>9} {fill:>7.1f} {bytes_per_key:>9.1f} {expired:>9.0f} {wheel_ms:>10.1f} "
+              f"{1000 * wheel_ms / max(expired, 1):>6.2f} {scan_ms if args.scan else float('nan'):>9.0f} "
+              f"{evict_ms if args.lru else float('nan'):>10.1f}", flush=True)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,136 @@
+import zmq
+import time
+import json
+import random
+import argparse
+
+from common import port_map, Histogram
+from main import SimulatedCluster
+from network import VirtualNetwork
+
+
+"""
+Benchmark of the two total orders of linearizability and sequential consistency (see "ordering" in `server.py`):
+the lamport clocks, where every server acknowledges every broadcast to every server, and the leader-based log, where
+the followers only acknowledge to the leader and a majority is enough to commit. For every ordering and cluster size it
+drives an in-process cluster with a closed loop of --window writes in flight per server for --duration seconds, and
+reports the throughput, the latency percentiles and the messages delivered per write.
+With --slow, every message to or from one server that is not the leader takes that many more milliseconds once the
+cluster is up, and the load goes to the other servers: the lamport order waits for the slow server on every write,
+the leader-based one only needs a majority.
+
+Example:
+    python bench/leader_bench.py --servers 3 5 9 --duration 5
+    python bench/leader_bench.py --servers 5 --slow 20
+"""
+
+
+class SlowNetwork(VirtualNetwork):
+    """
+    A virtual network on which the links of one server (slow_server, none until it is set) are slower.
+    """
+    def __init__(self, slow, **settings):
+        super().__init__(**settings)
+        self.slow_server = None
+        self.slow = slow
+
+    def _fate(self, sender, receiver, index):
+        delay, reordered = super()._fate(sender, receiver, index)
+        if delay is not None and self.slow_server in [sender, receiver]:
+            delay += self.slow
+        return delay, reordered
+
+
+def run(ordering, num_servers, args):
+    ports = port_map(num_servers, args.base_port)
+    settings = {"latency": args.latency, "jitter": args.jitter, "seed": args.seed}
+    network = SlowNetwork(args.slow, **settings)
+    server_config = {"api_mode": "router", "ordering": ordering, "batch_size": args.batch_size, "batch_window": args.batch_window}
+    server_config.update(json.loads(args.server_config))
+    cluster = SimulatedCluster(args.level, num_servers, ports, server_config, quiet=True, network=network)
+    try:
+        cluster.wait_ready()
+        poller = zmq.Poller()
+        sockets = []
+        for i in ports:
+            socket = cluster.context.socket(zmq.DEALER)
+            socket.connect(cluster.address(ports[i][2]))
+            poller.register(socket, zmq.POLLIN)
+            sockets.append(socket)
+        rng = random.Random(args.seed)
+        request_ids = iter(range(1 << 62))
+
+        def send(socket):
+            request_id = next(request_ids)
+            socket.send_multipart([b"", json.dumps({"type": "set", "key": f"key{rng.randrange(args.keys)}",
+                                                     "value": request_id, "request_id": request_id}).encode()])
+            sent[request_id] = time.perf_counter()
+
+        # one write per server first, answered once the cluster has a leader
+        sent = {}
+        for socket in sockets:
+            send(socket)
+        while sent:
+            if not poller.poll(10000):
+                raise TimeoutError("The cluster does not answer")
+            for socket in sockets:
+                while socket.poll(0):
+                    sent.pop(json.loads(socket.recv_multipart()[1])["request_id"])
+
+        leader = getattr(cluster.servers[0], "leader", None)
+        if args.slow:
+            network.slow_server = max(server for server in range(num_servers) if server != leader)
+            poller.unregister(sockets[network.slow_server])
+            sockets.pop(network.slow_server)
+        histogram = Histogram()
+        in_flight = {socket: 0 for socket in sockets}
+        done = 0
+        delivered = network.stats()["delivered"]
+        end = time.perf_counter() + args.duration
+        while time.perf_counter() < end:
+            for socket in sockets:
+                while in_flight[socket] < args.window:
+                    send(socket)
+                    in_flight[socket] += 1
+            for socket in dict(poller.poll(100)):
+                while socket.poll(0):
+                    reply = json.loads(socket.recv_multipart()[1])
+                    histogram.record(time.perf_counter() - sent.pop(reply["request_id"]))
+                    in_flight[socket] -= 1
+                    done += 1
+        messages = network.stats()["delivered"] - delivered
+        for socket in sockets:
+            socket.close(linger=0)
+        return done / args.duration, histogram.summary(), messages / max(done, 1), leader
+    finally:
+        cluster._destroy()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Lamport against leader-based total order, throughput and messages per write.")
+    parser.add_argument("--level", default="sequential", choices=["linearizability", "sequential"])
+    parser.add_argument("--orderings", nargs="+", default=["lamport", "leader"], choices=["lamport", "leader"])
+    parser.add_argument("--servers", type=int, nargs="+", default=[3, 5, 9])
+    parser.add_argument("--duration", type=float, default=5, help="seconds of load per run")
+    parser.add_argument("--window", type=int, default=8, help="writes in flight per server")
+    parser.add_argument("--keys", type=int, default=1000)
+    parser.add_argument("--latency", type=float, default=0, help="milliseconds")
+    parser.add_argument("--jitter", type=float, default=0, help="milliseconds")
+    parser.add_argument("--slow", type=float, default=0, help="extra milliseconds on the links of a server that is not the leader")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--batch-size", type=int, default=1)
+    parser.add_argument("--batch-window", type=float, default=0, help="milliseconds")
+    parser.add_argument("--server-config", default="{}", help="json of extra server_config settings")
+    parser.add_argument("--base-port", type=int, default=10500, help="only names of inproc sockets")
+    args = parser.parse_args()
+
+    print(f"{'ordering':<8} {'servers':>7} {'writes/s':>8} {'p50 ms':>7} {'p99 ms':>7} {'msgs/write':>10} {'leader':>6}")
+    for num_servers in args.servers:
+        for ordering in args.orderings:
+            throughput, latency, messages, leader = run(ordering, num_servers, args)
+            print(f"{ordering:<8} {num_servers:>7} {throughput:>8.0f} {latency['p50_ms'] or float('nan'):>7.2f} "
+                  f"{latency['p99_ms'] or float('nan'):>7.2f} {messages:>10.1f} {str(leader if leader is not None else '-'):>6}", flush=True)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,208 @@
+import zmq
+import time
+import json
+import random
+import argparse
+import itertools
+import multiprocessing
+
+from common import port_map, Histogram
+from main import Cluster
+from codec import CODECS, codec_of
+
+
+"""
+Load generator and benchmark runner: starts a cluster for every consistency level and cluster size, waits until it is
+ready, drives it with one or more load processes and reports the throughput and the latency percentiles of each
+operation, as a table and as machine-readable json results (--output) to track regressions.
+
+The load is either:
+- closed loop: every load process keeps `window` requests in flight on every server, optionally paced at --rate ops/s,
+  the latency is measured from the moment a request is sent.
+- open loop: the requests are sent on a Poisson schedule at --rate ops/s whatever the number of requests in flight,
+  the latency is measured from the scheduled time, so the queueing of a saturated cluster is part of it.
+Each request is a set with probability --write-ratio and a get otherwise, on a key drawn uniformly or from a Zipf
+distribution (--distribution zipf --zipf-s 0.99, key0 is the hottest), the values of the sets are --value-size bytes.
+
+Example:
+    python bench/loadgen.py --levels linearizability sequential eventual --servers 3 5 --mode open --rate 2000 --output results.json
+"""
+
+
+class KeySampler:
+    def __init__(self, rng, num_keys, distribution, zipf_s):
+        self.rng = rng
+        self.keys = [f"key{i}" for i in range(num_keys)]
+        self.cum_weights = None
+        if distribution == "zipf":
+            self.cum_weights = list(itertools.accumulate(1 / (i + 1) ** zipf_s for i in range(num_keys)))
+
+    def sample(self):
+        if self.cum_weights is None:
+            return self.rng.choice(self.keys)
+        return self.rng.choices(self.keys, cum_weights=self.cum_weights)[0]
+
+
+def load(api_ports, args, seed, rate, results):
+    """
+    One load process. It reports its histograms per operation, the number of responses received during the measure,
+    and the number of requests still unanswered at the end.
+    """
+    context = zmq.Context()
+    poller = zmq.Poller()
+    sockets = []
+    for port in api_ports:
+        socket = context.socket(zmq.DEALER)
+        socket.connect(f"tcp://localhost:{port}")
+        poller.register(socket, zmq.POLLIN)
+        sockets.append(socket)
+    codec = CODECS[args.codec]
+    rng = random.Random(seed)
+    sampler = KeySampler(rng, args.keys, args.distribution, args.zipf_s)
+    value = "x" * args.value_size if args.value_size else 1
+    histograms = {"get": Histogram(), "set": Histogram()}
+    sent = {} # request_id -> (type, start of the latency)
+    in_flight = {socket: 0 for socket in sockets}
+    request_ids = itertools.count()
+    done = 0
+
+    def send(socket, start):
+        request_type = "set" if rng.random() < args.write_ratio else "get"
+        request_id = next(request_ids)
+        frames = codec.encode_request({"type": request_type,
+                                       "key": sampler.sample(),
+                                       "value": value if request_type == "set" else None,
+                                       "request_id": request_id})
+        socket.send_multipart([b""] + frames, copy=False)
+        sent[request_id] = (request_type, start)
+        in_flight[socket] += 1
+
+    def receive(socket, measuring):
+        frames = socket.recv_multipart(copy=False)[1:]
+        request_id, _ = codec_of(frames).decode_response(frames)
+        request_type, start = sent.pop(request_id)
+        in_flight[socket] -= 1
+        if measuring:
+            histograms[request_type].record(time.perf_counter() - start)
+        return measuring
+
+    start = time.perf_counter()
+    measure_start = start + args.warmup
+    end = measure_start + args.duration
+    next_send = start # scheduled time of the next request when the load is paced
+    now = start
+    while now < end:
+        if args.mode == "open":
+            while next_send <= now:
+                send(rng.choice(sockets), next_send)
+                next_send += rng.expovariate(rate)
+        else:
+            for socket in sockets:
+                while in_flight[socket] < args.window and (not rate or next_send <= now):
+                    send(socket, time.perf_counter())
+                    if rate:
+                        next_send += 1 / rate
+        timeout = 100 # milliseconds
+        if rate:
+            timeout = max(0, min(timeout, 1000 * (next_send - time.perf_counter())))
+        for socket in dict(poller.poll(timeout)):
+            while socket.poll(0):
+                done += receive(socket, time.perf_counter() >= measure_start)
+        now = time.perf_counter()
+
+    # the responses still in flight are not counted in the throughput, but they are waited for a bit to be reported as lost
+    drain_end = time.perf_counter() + 1
+    while sent and time.perf_counter() < drain_end:
+        for socket in dict(poller.poll(100)):
+            while socket.poll(0):
+                receive(socket, False)
+    results.put((histograms, done, len(sent)))
+    for socket in sockets:
+        socket.close(linger=0)
+    context.term()
+
+
+def run(consistency_level, num_servers, args):
+    ports = port_map(num_servers, args.base_port)
+    server_config = {"api_mode": "router", "batch_size": args.batch_size, "batch_window": args.batch_window}
+    server_config.update(json.loads(args.server_config))
+    cluster = Cluster(consistency_level, num_servers, ports, server_config, quiet=True)
+    try:
+        cluster.wait_ready()
+        api_ports = [ports[i][2] for i in ports]
+        rate = args.rate / args.processes if args.rate else 0
+        results = multiprocessing.Queue()
+        processes = [multiprocessing.Process(target=load, args=(api_ports, args, args.seed + i, rate, results))
+                     for i in range(args.processes)]
+        for process in processes:
+            process.start()
+        histograms = {"get": Histogram(), "set": Histogram()}
+        done = lost = 0
+        for _ in processes:
+            process_histograms, process_done, process_lost = results.get()
+            for operation in histograms:
+                histograms[operation].merge(process_histograms[operation])
+            done += process_done
+            lost += process_lost
+        for process in processes:
+            process.join()
+    finally:
+        cluster._destroy()
+        time.sleep(0.5) # let the ports go before the next run
+    return {"consistency_level": consistency_level,
+            "servers": num_servers,
+            "mode": args.mode,
+            "target_rate": args.rate,
+            "throughput": done / args.duration,
+            "lost": lost,
+            "operations": {operation: histogram.summary() for operation, histogram in histograms.items()},
+            "config": {"processes": args.processes, "window": args.window, "write_ratio": args.write_ratio,
+                       "keys": args.keys, "distribution": args.distribution, "zipf_s": args.zipf_s,
+                       "value_size": args.value_size, "codec": args.codec, "duration": args.duration,
+                       "server_config": server_config}}
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Throughput and latency percentiles per consistency level and cluster size.")
+    parser.add_argument("--levels", nargs="+", default=["linearizability", "sequential", "eventual", "causal"],
+                        choices=["linearizability", "sequential", "eventual", "causal"])
+    parser.add_argument("--servers", type=int, nargs="+", default=[3])
+    parser.add_argument("--mode", default="closed", choices=["closed", "open"])
+    parser.add_argument("--rate", type=float, default=0, help="target ops/s over all load processes, required in open loop, 0 for as fast as possible in closed loop")
+    parser.add_argument("--window", type=int, default=8, help="closed loop: requests in flight per server and load process")
+    parser.add_argument("--processes", type=int, default=1, help="load processes")
+    parser.add_argument("--write-ratio", type=float, default=0.5)
+    parser.add_argument("--keys", type=int, default=1000)
+    parser.add_argument("--distribution", default="uniform", choices=["uniform", "zipf"])
+    parser.add_argument("--zipf-s", type=float, default=0.99)
+    parser.add_argument("--value-size", type=int, default=0, help="bytes of the values, 0 for int values")
+    parser.add_argument("--codec", default="json", choices=list(CODECS))
+    parser.add_argument("--duration", type=float, default=10, help="seconds measured per run")
+    parser.add_argument("--warmup", type=float, default=1, help="seconds of load before the measure")
+    parser.add_argument("--batch-size", type=int, default=64)
+    parser.add_argument("--batch-window", type=float, default=1, help="milliseconds")
+    parser.add_argument("--server-config", default="{}", help="json of extra server_config settings, e.g. '{\"read_mode\": \"barrier\"}'")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--base-port", type=int, default=7600)
+    parser.add_argument("--output", help="json file to write the results to")
+    args = parser.parse_args()
+    if args.mode == "open" and not args.rate:
+        parser.error("the open loop needs a --rate")
+
+    results = []
+    print(f"{'level':<15} {'servers':>7} {'ops/s':>9} {'lost':>5} "
+          f"{'get p50':>8} {'get p99':>8} {'get p999':>8} {'set p50':>8} {'set p99':>8} {'set p999':>8}")
+    for consistency_level in args.levels:
+        for num_servers in args.servers:
+            result = run(consistency_level, num_servers, args)
+            results.append(result)
+            latencies = " ".join(f"{result['operations'][operation][p] or float('nan'):>8.2f}"
+                                 for operation in ["get", "set"] for p in ["p50_ms", "p99_ms", "p999_ms"])
+            print(f"{consistency_level:<15} {num_servers:>7} {result['throughput']:>9.0f} {result['lost']:>5} {latencies}", flush=True)
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,148 @@
+import zmq
+import time
+import json
+import random
+import argparse
+import threading
+
+from common import port_map, Histogram
+from main import SimulatedCluster
+from network import VirtualNetwork
+from client import Client
+
+
+"""
+Benchmark of the servers that join a running cluster (see "Servers join and leave" in `Server_leader`): it preloads
+--keys keys into an in-process cluster with the leader ordering, drives it with a closed loop of --window requests in
+flight per server, adds --add servers --join-at seconds in, and reports the throughput and the latency over time in
+bins of --bin seconds, with the moments every new server joined as a learner and became a voter. A new server gets a
+snapshot of the whole store in chunks of --chunk keys while the load goes on, so the bins of the join show what the
+state transfer costs the clients. With --use-new, the load also goes to the new servers once they are voters.
+
+Example:
+    python bench/membership_bench.py --keys 200000 --add 2 --duration 10 --join-at 3
+"""
+
+
+def run(args):
+    ports = port_map(args.servers, args.base_port)
+    network = VirtualNetwork(latency=args.latency, seed=args.seed)
+    server_config = {"api_mode": "router", "ordering": "leader", "snapshot_chunk": args.chunk,
+                     "batch_size": args.batch_size, "batch_window": args.batch_window}
+    server_config.update(json.loads(args.server_config))
+    cluster = SimulatedCluster(args.level, args.servers, ports, server_config, quiet=True, network=network)
+    try:
+        cluster.wait_ready()
+        with Client(ports, timeout=10, context=cluster.context, address=cluster.address) as client:
+            for start in range(0, args.keys, 1000):
+                keys = [f"key{i}" for i in range(start, min(start + 1000, args.keys))]
+                client.mset(keys, [args.value or i for i in range(len(keys))])
+
+        poller = zmq.Poller()
+        sockets = []
+
+        def add_socket(api_port):
+            socket = cluster.context.socket(zmq.DEALER)
+            socket.connect(cluster.address(api_port))
+            poller.register(socket, zmq.POLLIN)
+            sockets.append(socket)
+            in_flight[socket] = 0
+
+        in_flight = {}
+        for i in ports:
+            add_socket(ports[i][2])
+        rng = random.Random(args.seed)
+        request_ids = iter(range(1 << 62))
+        sent = {} # request_id -> time it was sent
+        bins = [] # (completed requests, latency histogram) per bin
+        events = {} # bin -> what happened in it
+        new_servers = {} # server number -> server, once it started, None once it is a voter
+
+        def join():
+            # from another thread, so that the load goes on while the servers start
+            for number in range(args.servers, args.servers + args.add):
+                cluster.add_server(number, port_map(number + 1, args.base_port)[str(number)])
+                new_servers[number] = cluster.servers[-1]
+
+        joiner = threading.Thread(target=join, daemon=True)
+        start = time.perf_counter()
+        end = start + args.duration
+
+        while time.perf_counter() < end:
+            now = time.perf_counter()
+            current = int((now - start) / args.bin)
+            while len(bins) <= current:
+                bins.append([0, Histogram()])
+            if now - start >= args.join_at and not joiner.is_alive() and not new_servers:
+                joiner.start()
+                events.setdefault(current, []).append(f"join {', '.join(map(str, range(args.servers, args.servers + args.add)))}")
+            for number, server in list(new_servers.items()):
+                if server is not None and number in server.voters and not server.joining:
+                    events.setdefault(current, []).append(f"voter {number} after {now - start - args.join_at:.2f} s")
+                    new_servers[number] = None
+                    if args.use_new:
+                        add_socket(cluster.port_number[str(number)][2])
+            for socket in sockets:
+                while in_flight[socket] < args.window:
+                    request_id = next(request_ids)
+                    request_type = "set" if rng.random() < args.write_ratio else "get"
+                    socket.send_multipart([b"", json.dumps({"type": request_type, "key": f"key{rng.randrange(args.keys)}",
+                                                             "value": request_id, "request_id": request_id}).encode()])
+                    sent[request_id] = time.perf_counter()
+                    in_flight[socket] += 1
+            for socket in dict(poller.poll(10)):
+                while socket.poll(0):
+                    reply = json.loads(socket.recv_multipart()[1])
+                    latency = time.perf_counter() - sent.pop(reply["request_id"])
+                    bins[current][0] += 1
+                    bins[current][1].record(latency)
+                    in_flight[socket] -= 1
+        counters = [server.metrics.snapshot()["counters"] for server in cluster.servers]
+        chunks = sum(counter.get("snapshot_chunks_sent", 0) for counter in counters)
+        for socket in sockets:
+            socket.close(linger=0)
+        return bins, events, chunks, [number for number, server in new_servers.items() if server is not None]
+    finally:
+        cluster._destroy()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Throughput and latency over time while servers join a loaded cluster.")
+    parser.add_argument("--level", default="sequential", choices=["linearizability", "sequential"])
+    parser.add_argument("--servers", type=int, default=3, help="servers at the start")
+    parser.add_argument("--add", type=int, default=1, help="servers that join")
+    parser.add_argument("--keys", type=int, default=100000, help="keys preloaded, every new server receives them all")
+    parser.add_argument("--value", default="", help="value of the preloaded keys, their index if empty")
+    parser.add_argument("--chunk", type=int, default=1000, help="keys per chunk of the snapshot")
+    parser.add_argument("--duration", type=float, default=10, help="seconds of load")
+    parser.add_argument("--join-at", type=float, default=3, help="seconds of load before the servers join")
+    parser.add_argument("--bin", type=float, default=0.5, help="seconds per line of the timeline")
+    parser.add_argument("--window", type=int, default=8, help="requests in flight per server")
+    parser.add_argument("--write-ratio", type=float, default=0.5)
+    parser.add_argument("--use-new", action="store_true", help="send load to the new servers once they are voters")
+    parser.add_argument("--latency", type=float, default=1, help="milliseconds between two servers")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--batch-size", type=int, default=64)
+    parser.add_argument("--batch-window", type=float, default=1, help="milliseconds")
+    parser.add_argument("--server-config", default="{}", help="json of extra server_config settings")
+    parser.add_argument("--base-port", type=int, default=11100, help="only names of inproc sockets")
+    args = parser.parse_args()
+
+    bins, events, chunks, pending = run(args)
+    print(f"{'t s':>5} {'ops/s':>7} {'p50 ms':>7} {'p99 ms':>7}  events")
+    for index, (done, histogram) in enumerate(bins):
+        latency = histogram.summary()
+        print(f"{index * args.bin:>5.1f} {done / args.bin:>7.0f} {latency['p50_ms'] or float('nan'):>7.2f} "
+              f"{latency['p99_ms'] or float('nan'):>7.2f}  {', '.join(events.get(index, []))}")
+    joined = int(args.join_at / args.bin)
+    before = [done / args.bin for done, histogram in bins[1:joined]] # the first bin warms up
+    after = [done / args.bin for done, histogram in bins[joined:-1]] # the last bin is cut short
+    if before and after:
+        print(f"before the join {sum(before) / len(before):.0f} ops/s, from the join on {sum(after) / len(after):.0f} ops/s "
+              f"(lowest bin {min(after):.0f}), {chunks} snapshot chunks sent")
+    if pending:
+        print(f"not voters at the end: {pending}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,97 @@
+import zmq
+import time
+import json
+import random
+import argparse
+
+from common import port_map, percentile
+from main import Cluster
+
+
+"""
+Read benchmark for linearizability: read latency and throughput of the "broadcast" read mode (every get goes through
+the totally ordered broadcast) against the "barrier" read mode (a get only waits for its position in the total order),
+under a read-dominated workload, for clusters of 3, 5 and 7 servers.
+
+Example:
+    python bench/read_bench.py --servers 3 5 7 --duration 10
+"""
+
+
+def run(num_servers, read_mode, args):
+    ports = port_map(num_servers, args.base_port)
+    server_config = {"api_mode": "router", "read_mode": read_mode,
+                     "batch_size": args.batch_size, "batch_window": args.batch_window}
+    cluster = Cluster("linearizability", num_servers, ports, server_config, quiet=True)
+    cluster.wait_ready()
+
+    context = zmq.Context()
+    poller = zmq.Poller()
+    sockets = []
+    for i in ports:
+        socket = context.socket(zmq.DEALER)
+        socket.connect(f"tcp://localhost:{ports[i][2]}")
+        poller.register(socket, zmq.POLLIN)
+        sockets.append(socket)
+
+    rng = random.Random(args.seed)
+    sent_at = {} # request_id -> (type, send time)
+    read_latencies = []
+    in_flight = {socket: 0 for socket in sockets}
+    next_id = 0
+    done = 0
+    try:
+        start = time.time()
+        while time.time() - start < args.duration:
+            for socket in sockets:
+                while in_flight[socket] < args.window:
+                    request_type = "set" if rng.random() < args.write_ratio else "get"
+                    socket.send_multipart([b"", json.dumps({"type": request_type,
+                                                             "key": rng.choice("ab"),
+                                                             "value": next_id if request_type == "set" else None,
+                                                             "request_id": next_id}).encode()])
+                    sent_at[next_id] = (request_type, time.perf_counter())
+                    in_flight[socket] += 1
+                    next_id += 1
+            for socket in dict(poller.poll(1000)):
+                while socket.poll(0):
+                    reply = json.loads(socket.recv_multipart()[1])
+                    request_type, sent = sent_at.pop(reply["request_id"])
+                    if request_type == "get":
+                        read_latencies.append(time.perf_counter() - sent)
+                    in_flight[socket] -= 1
+                    done += 1
+        elapsed = time.time() - start
+    finally:
+        for socket in sockets:
+            socket.close(linger=0)
+        context.term()
+        cluster._destroy()
+        time.sleep(0.5) # let the ports go before the next run
+
+    read_latencies.sort()
+    return (len(read_latencies) / elapsed, done / elapsed,
+            1000 * percentile(read_latencies, 50), 1000 * percentile(read_latencies, 99))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Linearizable read latency and throughput: broadcast vs barrier read mode.")
+    parser.add_argument("--servers", type=int, nargs="+", default=[3, 5, 7])
+    parser.add_argument("--duration", type=float, default=10, help="seconds per run")
+    parser.add_argument("--write-ratio", type=float, default=0.05)
+    parser.add_argument("--window", type=int, default=16, help="requests in flight per server")
+    parser.add_argument("--batch-size", type=int, default=64)
+    parser.add_argument("--batch-window", type=float, default=1, help="milliseconds")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--base-port", type=int, default=6500)
+    args = parser.parse_args()
+
+    print(f"{'servers':>7} {'read mode':<9} {'reads/s':>9} {'ops/s':>9} {'p50 ms':>8} {'p99 ms':>8}")
+    for num_servers in args.servers:
+        for read_mode in ["broadcast", "barrier"]:
+            reads, ops, p50, p99 = run(num_servers, read_mode, args)
+            print(f"{num_servers:>7} {read_mode:<9} {reads:>9.0f} {ops:>9.0f} {p50:>8.2f} {p99:>8.2f}", flush=True)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,68 @@
+import time
+import argparse
+
+from common import port_map
+from main import Cluster
+from client import Client
+
+
+"""
+Benchmark of the range scans: loads --keys keys into a cluster under --prefixes prefixes (user0:, user1:, ...),
+then reads back all the keys of one prefix with one get per key (the keys being known, e.g. from an index kept aside
+by the client), with an mget per --chunk keys, and with a scan of the prefix in pages of --page keys, through the
+client library with one request in flight, and reports the keys per second of each.
+
+Example:
+    python bench/scan_bench.py --levels linearizability sequential --keys 100000 --prefixes 10
+"""
+
+
+def run(consistency_level, args):
+    ports = port_map(args.servers, args.base_port)
+    server_config = {"log": "off", "codec": "binary", "api_mode": "router", "scan_page": args.page}
+    cluster = Cluster(consistency_level, args.servers, ports, server_config, quiet=True)
+    try:
+        cluster.wait_ready()
+        with Client(ports, timeout=10, session="0") as client:
+            keys = [f"user{i % args.prefixes}:{i:09d}" for i in range(args.keys)]
+            for i in range(0, args.keys, 1000):
+                client.mset(keys[i:i + 1000], list(range(i, min(i + 1000, args.keys))))
+            prefix = sorted(key for key in keys if key.startswith("user0:"))
+            start = time.perf_counter()
+            for key in prefix:
+                client.get(key)
+            gets = len(prefix) / (time.perf_counter() - start)
+            start = time.perf_counter()
+            for i in range(0, len(prefix), args.chunk):
+                client.mget(prefix[i:i + args.chunk])
+            mgets = len(prefix) / (time.perf_counter() - start)
+            start = time.perf_counter()
+            scanned = [key for key, value in client.prefix("user0:", page=args.page)]
+            scans = len(prefix) / (time.perf_counter() - start)
+            assert scanned == prefix
+        return len(prefix), gets, mgets, scans
+    finally:
+        cluster._destroy()
+        time.sleep(0.5) # let the ports go before the next run
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Keys per second of a range read with gets, mgets and a scan.")
+    parser.add_argument("--levels", nargs="+", default=["linearizability", "sequential", "eventual", "causal"],
+                        choices=["linearizability", "sequential", "eventual", "causal"])
+    parser.add_argument("--servers", type=int, default=3)
+    parser.add_argument("--keys", type=int, default=100000)
+    parser.add_argument("--prefixes", type=int, default=10, help="the keys of one prefix are read back")
+    parser.add_argument("--chunk", type=int, default=100, help="keys per mget")
+    parser.add_argument("--page", type=int, default=1000, help="keys per page of the scan, also the scan_page of the servers")
+    parser.add_argument("--base-port", type=int, default=8400)
+    args = parser.parse_args()
+
+    print(f"{'level':<15} {'keys':>6} {'get keys/s':>10} {'mget keys/s':>11} {'scan keys/s':>11}")
+    for consistency_level in args.levels:
+        count, gets, mgets, scans = run(consistency_level, args)
+        print(f"{consistency_level:<15} {count:>6} {gets:>10.0f} {mgets:>11.0f} {scans:>11.0f}", flush=True)
+
+
+if __name__ == "__main__":
+    main()
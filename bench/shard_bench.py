@@ -0,0 +1,133 @@
+import zmq
+import time
+import json
+import random
+import argparse
+import multiprocessing
+
+from common import port_map
+from main import Cluster
+from ring import HashRing
+
+
+"""
+Scaling benchmark for sharding: aggregate throughput of a cluster split into 1, 2 and 4 replica groups,
+each group running its own consistency protocol. Several load processes route every request to the group
+that owns its key, and spread the requests of a group over its replicas.
+
+Example:
+    python bench/shard_bench.py --shards 1 2 4 --replicas 3 --duration 10
+"""
+
+
+def load(groups, vnodes, args, seed, results):
+    """
+    Closed-loop load process: keeps `window` requests in flight on every server and counts the responses.
+    """
+    ring = HashRing(groups, vnodes)
+    context = zmq.Context()
+    poller = zmq.Poller()
+    sockets = {} # group -> DEALER sockets of its servers
+    in_flight = {}
+    for group in groups:
+        sockets[group] = []
+        for ports in groups[group]["port_number"].values():
+            socket = context.socket(zmq.DEALER)
+            socket.connect(f"tcp://localhost:{ports[2]}")
+            poller.register(socket, zmq.POLLIN)
+            sockets[group].append(socket)
+            in_flight[socket] = 0
+    rng = random.Random(seed)
+    keys = [f"key{i}" for i in range(args.keys)]
+    owners = {key: ring.owner(key) for key in keys}
+    next_id = 0
+    done = 0
+    start = time.time()
+    while time.time() - start < args.duration:
+        for socket in in_flight:
+            while in_flight[socket] < args.window:
+                key = rng.choice(keys)
+                request_type = "set" if rng.random() < args.write_ratio else "get"
+                target = rng.choice(sockets[owners[key]])
+                target.send_multipart([b"", json.dumps({"type": request_type,
+                                                         "key": key,
+                                                         "value": next_id,
+                                                         "request_id": next_id}).encode()])
+                in_flight[target] += 1
+                next_id += 1
+        for socket in dict(poller.poll(1000)):
+            while socket.poll(0):
+                socket.recv_multipart()
+                in_flight[socket] -= 1
+                done += 1
+    results.put(done / (time.time() - start))
+    for socket in in_flight:
+        socket.close(linger=0)
+    context.term()
+
+
+def run(num_shards, args):
+    groups = {}
+    clusters = []
+    base_port = args.base_port
+    server_config = {"api_mode": "router", "batch_size": args.batch_size, "batch_window": args.batch_window}
+    try:
+        for shard in range(num_shards):
+            ports = port_map(args.replicas, base_port)
+            base_port += 10 * args.replicas
+            groups[str(shard)] = {"port_number": ports}
+            clusters.append(Cluster(args.consistency, args.replicas, ports, server_config, quiet=True))
+        for cluster in clusters:
+            cluster.wait_ready()
+
+        # every set of a key must already be visible for the gets, so the keys are written once before the measure
+        context = zmq.Context()
+        ring = HashRing(groups, args.vnodes)
+        for i in range(args.keys):
+            key = f"key{i}"
+            socket = context.socket(zmq.REQ)
+            socket.connect(f"tcp://localhost:{groups[ring.owner(key)]['port_number']['0'][2]}")
+            socket.send_json({"type": "set", "key": key, "value": 0})
+            socket.recv()
+            socket.close()
+        context.term()
+
+        results = multiprocessing.Queue()
+        processes = [multiprocessing.Process(target=load, args=(groups, args.vnodes, args, seed, results))
+                     for seed in range(args.clients)]
+        for process in processes:
+            process.start()
+        throughput = sum(results.get() for _ in processes)
+        for process in processes:
+            process.join()
+        return throughput
+    finally:
+        for cluster in clusters:
+            cluster._destroy()
+        time.sleep(0.5) # let the ports go before the next run
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Aggregate throughput against the number of shards.")
+    parser.add_argument("--consistency", default="sequential", choices=["sequential", "linearizability", "eventual", "causal"])
+    parser.add_argument("--shards", type=int, nargs="+", default=[1, 2, 4])
+    parser.add_argument("--replicas", type=int, default=3, help="servers per shard")
+    parser.add_argument("--vnodes", type=int, default=64)
+    parser.add_argument("--clients", type=int, default=4, help="load processes")
+    parser.add_argument("--keys", type=int, default=1000)
+    parser.add_argument("--write-ratio", type=float, default=0.5)
+    parser.add_argument("--duration", type=float, default=10, help="seconds per run")
+    parser.add_argument("--window", type=int, default=8, help="requests in flight per server and load process")
+    parser.add_argument("--batch-size", type=int, default=64)
+    parser.add_argument("--batch-window", type=float, default=1, help="milliseconds")
+    parser.add_argument("--base-port", type=int, default=7100)
+    args = parser.parse_args()
+
+    print(f"{'shards':>6} {'servers':>7} {'ops/s':>9}")
+    for num_shards in args.shards:
+        throughput = run(num_shards, args)
+        print(f"{num_shards:>6} {num_shards * args.replicas:>7} {throughput:>9.0f}", flush=True)
+
+
+if __name__ == "__main__":
+    main()
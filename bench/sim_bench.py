@@ -0,0 +1,101 @@
+import zmq
+import time
+import json
+import random
+import argparse
+
+from common import port_map, Histogram
+from main import SimulatedCluster
+from network import VirtualNetwork
+
+
+"""
+Benchmark of the in-process clusters (see `SimulatedCluster` in `main.py`): for every consistency level and cluster
+size it reports how long the cluster takes to start and be ready, then drives it for --duration seconds with a
+closed loop of --window requests in flight per server, from this process, and reports the throughput, the latency
+percentiles and what the virtual network did to the messages. Without processes nor tcp, the numbers are the cost of
+the protocols themselves, and the network settings (--latency, --jitter, --reorder, --loss, in milliseconds and
+probabilities) make them run on a slower or lossy network, the same one for the same --seed.
+
+Example:
+    python bench/sim_bench.py --levels sequential eventual --servers 3 9 50 --latency 1 --jitter 1
+"""
+
+
+def run(consistency_level, num_servers, args):
+    ports = port_map(num_servers, args.base_port)
+    network = VirtualNetwork(latency=args.latency, jitter=args.jitter, reorder=args.reorder, loss=args.loss, seed=args.seed)
+    server_config = {"api_mode": "router", "batch_size": args.batch_size, "batch_window": args.batch_window}
+    server_config.update(json.loads(args.server_config))
+    start = time.perf_counter()
+    cluster = SimulatedCluster(consistency_level, num_servers, ports, server_config, quiet=True, network=network)
+    try:
+        cluster.wait_ready()
+        startup = time.perf_counter() - start
+
+        poller = zmq.Poller()
+        sockets = []
+        for i in ports:
+            socket = cluster.context.socket(zmq.DEALER)
+            socket.connect(cluster.address(ports[i][2]))
+            poller.register(socket, zmq.POLLIN)
+            sockets.append(socket)
+        rng = random.Random(args.seed)
+        histogram = Histogram()
+        sent = {} # request_id -> time it was sent
+        in_flight = {socket: 0 for socket in sockets}
+        request_id = done = 0
+        end = time.perf_counter() + args.duration
+        while time.perf_counter() < end:
+            for socket in sockets:
+                while in_flight[socket] < args.window:
+                    request_type = "set" if rng.random() < args.write_ratio else "get"
+                    socket.send_multipart([b"", json.dumps({"type": request_type, "key": f"key{rng.randrange(args.keys)}",
+                                                             "value": request_id, "request_id": request_id}).encode()])
+                    sent[request_id] = time.perf_counter()
+                    in_flight[socket] += 1
+                    request_id += 1
+            for socket in dict(poller.poll(100)):
+                while socket.poll(0):
+                    reply = json.loads(socket.recv_multipart()[1])
+                    histogram.record(time.perf_counter() - sent.pop(reply["request_id"]))
+                    in_flight[socket] -= 1
+                    done += 1
+        for socket in sockets:
+            socket.close(linger=0)
+        return startup, done / args.duration, histogram.summary(), network.stats()
+    finally:
+        cluster._destroy()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Startup time and throughput of in-process clusters over a virtual network.")
+    parser.add_argument("--levels", nargs="+", default=["linearizability", "sequential", "eventual", "causal"],
+                        choices=["linearizability", "sequential", "eventual", "causal"])
+    parser.add_argument("--servers", type=int, nargs="+", default=[3, 9, 50])
+    parser.add_argument("--duration", type=float, default=5, help="seconds of load per run")
+    parser.add_argument("--window", type=int, default=8, help="requests in flight per server")
+    parser.add_argument("--write-ratio", type=float, default=0.5)
+    parser.add_argument("--keys", type=int, default=1000)
+    parser.add_argument("--latency", type=float, default=0, help="milliseconds")
+    parser.add_argument("--jitter", type=float, default=0, help="milliseconds")
+    parser.add_argument("--reorder", type=float, default=0, help="probability, breaks the FIFO channels the total order relies on")
+    parser.add_argument("--loss", type=float, default=0, help="probability")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--batch-size", type=int, default=64)
+    parser.add_argument("--batch-window", type=float, default=1, help="milliseconds")
+    parser.add_argument("--server-config", default="{}", help="json of extra server_config settings")
+    parser.add_argument("--base-port", type=int, default=10000, help="only names of inproc sockets")
+    args = parser.parse_args()
+
+    print(f"{'level':<15} {'servers':>7} {'startup s':>9} {'ops/s':>7} {'p50 ms':>7} {'p99 ms':>7} {'messages':>9} {'dropped':>7} {'reordered':>9}")
+    for consistency_level in args.levels:
+        for num_servers in args.servers:
+            startup, throughput, latency, network = run(consistency_level, num_servers, args)
+            print(f"{consistency_level:<15} {num_servers:>7} {startup:>9.3f} {throughput:>7.0f} "
+                  f"{latency['p50_ms'] or float('nan'):>7.2f} {latency['p99_ms'] or float('nan'):>7.2f} "
+                  f"{network['delivered']:>9} {network['dropped']:>7} {network['reordered']:>9}", flush=True)
+
+
+if __name__ == "__main__":
+    main()
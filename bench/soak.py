@@ -0,0 +1,76 @@
+import zmq
+import time
+import json
+import argparse
+
+from common import port_map, rss_kb
+from main import Cluster
+
+
+"""
+Soak benchmark for the totally ordered broadcast: it keeps writing to a small set of keys on every server
+and reports the resident memory of each server process, which should stay flat over millions of writes.
+
+Example:
+    python bench/soak.py --consistency sequential --servers 3 --writes 1000000
+"""
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Soak benchmark: RSS of the servers under a long stream of writes.")
+    parser.add_argument("--consistency", default="sequential", choices=["sequential", "linearizability"])
+    parser.add_argument("--servers", type=int, default=3)
+    parser.add_argument("--writes", type=int, default=1000000, help="total number of writes")
+    parser.add_argument("--keys", type=int, default=100, help="number of distinct keys, kept small so the store itself does not grow")
+    parser.add_argument("--window", type=int, default=64, help="requests in flight per server")
+    parser.add_argument("--batch-size", type=int, default=64)
+    parser.add_argument("--batch-window", type=float, default=1, help="milliseconds")
+    parser.add_argument("--report", type=int, default=100000, help="print a line every this many writes")
+    parser.add_argument("--base-port", type=int, default=6100)
+    args = parser.parse_args()
+
+    ports = port_map(args.servers, args.base_port)
+    server_config = {"api_mode": "router", "batch_size": args.batch_size, "batch_window": args.batch_window}
+    cluster = Cluster(args.consistency, args.servers, ports, server_config, quiet=True)
+    cluster.wait_ready()
+
+    context = zmq.Context()
+    poller = zmq.Poller()
+    sockets = []
+    for i in ports:
+        socket = context.socket(zmq.DEALER)
+        socket.connect(f"tcp://localhost:{ports[i][2]}")
+        poller.register(socket, zmq.POLLIN)
+        sockets.append(socket)
+
+    try:
+        print(f"{'writes':>10} {'seconds':>9} {'writes/s':>9} " + " ".join(f"{'rss' + str(i) + ' KB':>10}" for i in ports))
+        in_flight = {socket: 0 for socket in sockets}
+        sent = done = 0
+        next_report = args.report
+        start = time.time()
+        while done < args.writes:
+            for socket in sockets:
+                while in_flight[socket] < args.window and sent < args.writes:
+                    socket.send_multipart([b"", json.dumps({"type": "set",
+                                                             "key": f"k{sent % args.keys}",
+                                                             "value": sent,
+                                                             "request_id": sent}).encode()])
+                    in_flight[socket] += 1
+                    sent += 1
+            for socket in dict(poller.poll(1000)):
+                while socket.poll(0):
+                    socket.recv_multipart()
+                    in_flight[socket] -= 1
+                    done += 1
+            if done >= next_report:
+                elapsed = time.time() - start
+                rss = " ".join(f"{rss_kb(process.pid):>10}" for process in cluster.processes.values())
+                print(f"{done:>10} {elapsed:>9.1f} {done / elapsed:>9.0f} {rss}", flush=True)
+                next_report += args.report
+    finally:
+        cluster._destroy()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,63 @@
+import time
+import random
+import argparse
+import multiprocessing
+
+from common import rss_kb
+from storage import STORAGES
+
+
+"""
+Storage benchmark: memory per key and put/get throughput of the dict and arena storage engines,
+for 1M and 10M small keys. Each run fills a fresh engine in its own process, so the memory is the growth
+of the resident set of that process.
+
+Example:
+    python bench/storage_bench.py --keys 1000000 10000000 --value-size 0
+"""
+
+
+def value_of(i, value_size):
+    return i if value_size == 0 else str(i).rjust(value_size, "x")[:value_size]
+
+
+def run(storage, num_keys, args, results):
+    rss_before = rss_kb(multiprocessing.current_process().pid)
+    store = STORAGES[storage]()
+    start = time.perf_counter()
+    for i in range(num_keys):
+        store.put(f"key{i}", value_of(i, args.value_size))
+    put_time = time.perf_counter() - start
+    rss_after = rss_kb(multiprocessing.current_process().pid)
+
+    rng = random.Random(args.seed)
+    keys = [f"key{rng.randrange(num_keys)}" for _ in range(args.gets)]
+    start = time.perf_counter()
+    for key in keys:
+        store.get(key)
+    get_time = time.perf_counter() - start
+    results.put((1024 * (rss_after - rss_before) / num_keys, num_keys / put_time, args.gets / get_time))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Memory per key and throughput of the storage engines.")
+    parser.add_argument("--keys", type=int, nargs="+", default=[1000000, 10000000])
+    parser.add_argument("--storages", nargs="+", default=list(STORAGES), choices=list(STORAGES))
+    parser.add_argument("--value-size", type=int, default=0, help="bytes of the string values, 0 for int values")
+    parser.add_argument("--gets", type=int, default=1000000, help="random gets after the store is filled")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    print(f"{'keys':>9} {'storage':<7} {'bytes/key':>9} {'puts/s':>9} {'gets/s':>9}")
+    for num_keys in args.keys:
+        for storage in args.storages:
+            results = multiprocessing.Queue()
+            process = multiprocessing.Process(target=run, args=(storage, num_keys, args, results))
+            process.start()
+            bytes_per_key, puts, gets = results.get()
+            process.join()
+            print(f"{num_keys:>9} {storage:<7} {bytes_per_key:>9.1f} {puts:>9.0f} {gets:>9.0f}", flush=True)
+
+
+if __name__ == "__main__":
+    main()
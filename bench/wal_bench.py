@@ -0,0 +1,96 @@
+import os
+import sys
+import time
+import shutil
+import argparse
+import tempfile
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from durability import Durability, FSYNC_POLICIES
+from storage import DictStorage
+
+
+"""
+Durability benchmark: write throughput of the write-ahead log under each fsync policy, against an in-memory store
+without a log, and the restart time from a snapshot plus the log tail against a replay of the whole log.
+The log is driven directly, the way the delivery thread of a server does (one append per delivered batch).
+
+Example:
+    python bench/wal_bench.py --writes 200000 --batch 64 --keys 10000
+"""
+
+
+def write(directory, policy, args):
+    """
+    Apply args.writes writes in batches of args.batch, logged with the given policy (None for no log).
+    Returns the writes per second.
+    """
+    store = DictStorage()
+    durability = None
+    if policy is not None:
+        durability = Durability(directory, fsync=policy, snapshot_every=args.snapshot_every)
+        durability.recover(store)
+    start = time.perf_counter()
+    for timestamp, first in enumerate(range(0, args.writes, args.batch), 1):
+        writes = [(f"key{i % args.keys}", i) for i in range(first, min(first + args.batch, args.writes))]
+        if durability is not None:
+            durability.append(timestamp, 0, writes, store)
+        for key, value in writes:
+            store.put(key, value)
+    elapsed = time.perf_counter() - start
+    if durability is not None:
+        durability.close()
+    return args.writes / elapsed
+
+
+def restart(directory):
+    """
+    Seconds to recover the store from the directory.
+    """
+    start = time.perf_counter()
+    durability = Durability(directory)
+    store = DictStorage()
+    durability.recover(store)
+    elapsed = time.perf_counter() - start
+    durability.close()
+    return elapsed, store.size()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Write overhead per fsync policy and restart time of the write-ahead log.")
+    parser.add_argument("--writes", type=int, default=200000)
+    parser.add_argument("--batch", type=int, default=64, help="writes per delivered batch")
+    parser.add_argument("--keys", type=int, default=10000, help="distinct keys")
+    parser.add_argument("--op-writes", type=int, default=5000, help="writes for the op policy, which fsyncs every write")
+    parser.add_argument("--snapshot-every", type=int, default=50000, help="writes between two snapshots")
+    args = parser.parse_args()
+
+    root = tempfile.mkdtemp(prefix="wal_bench-")
+    try:
+        print(f"{'fsync':<9} {'writes':>8} {'writes/s':>10} {'slowdown':>9}")
+        baseline = write(None, None, args)
+        print(f"{'no log':<9} {args.writes:>8} {baseline:>10.0f} {1:>8.1f}x", flush=True)
+        for policy in FSYNC_POLICIES:
+            writes = args.writes
+            if policy == "op":
+                args.writes = min(args.writes, args.op_writes)
+            throughput = write(f"{root}/{policy}", policy, args)
+            print(f"{policy:<9} {args.writes:>8} {throughput:>10.0f} {baseline / throughput:>8.1f}x", flush=True)
+            args.writes = writes
+
+        # the batch directory has snapshots and a short tail, a directory without snapshots replays the whole log
+        snapshot_every = args.snapshot_every
+        args.snapshot_every = args.writes + 1
+        write(f"{root}/log-only", "batch", args)
+        args.snapshot_every = snapshot_every
+        print()
+        print(f"{'restart from':<20} {'keys':>8} {'seconds':>9}")
+        for name, directory in [("snapshot + tail", f"{root}/batch"), ("whole log", f"{root}/log-only")]:
+            elapsed, keys = restart(directory)
+            print(f"{name:<20} {keys:>8} {elapsed:>9.3f}", flush=True)
+    finally:
+        shutil.rmtree(root)
+
+
+if __name__ == "__main__":
+    main()
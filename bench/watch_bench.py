@@ -0,0 +1,110 @@
+import zmq
+import time
+import argparse
+import threading
+import multiprocessing
+
+from common import port_map, percentile
+from main import Cluster
+from client import Client
+
+
+"""
+Benchmark of the change streams (see the watch port in `Server`): --writes sets of the keys of a prefix, whose values
+are their send times, through the client library with one request in flight, while watchers (threads of one process,
+each with its own client and watch of the prefix) receive their changes. It reports the writes per second, the share
+of the changes delivered to the watchers, and the latency from the write to its notification. With --slow a
+subscriber that never reads its socket is added: the server drops its changes once watch_hwm of them are queued,
+and the writes and the other watchers are not held up.
+
+Example:
+    python bench/watch_bench.py --watchers 0 1 10 100 --writes 5000 --slow
+"""
+
+
+def watchers(ports, count, writes, ready, results):
+    latencies, delivered = [], []
+
+    def watch():
+        with Client(ports, timeout=10) as client, client.watch("key:") as changes:
+            ready.put(1)
+            seen = set()
+            while len(seen) < writes:
+                change = changes.next(5)
+                if change is None:
+                    break
+                key, value, position = change
+                latencies.append(time.time() - value)
+                seen.add(key)
+            delivered.append(len(seen))
+
+    threads = [threading.Thread(target=watch) for _ in range(count)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    results.put((sum(delivered), sorted(latencies)))
+
+
+def run(consistency_level, num_watchers, args):
+    ports = port_map(args.servers, args.base_port, watch=True)
+    server_config = {"log": "off", "codec": "binary", "api_mode": "router", "watch_hwm": args.hwm}
+    cluster = Cluster(consistency_level, args.servers, ports, server_config, quiet=True)
+    context = zmq.Context()
+    slow = None
+    try:
+        cluster.wait_ready()
+        if args.slow:
+            slow = context.socket(zmq.SUB)
+            slow.setsockopt(zmq.RCVHWM, 1)
+            slow.setsockopt(zmq.SUBSCRIBE, b"")
+            for i in ports:
+                slow.connect(f"tcp://localhost:{ports[i][3]}")
+        ready, results = multiprocessing.Queue(), multiprocessing.Queue()
+        process = None
+        if num_watchers:
+            process = multiprocessing.Process(target=watchers, args=(ports, num_watchers, args.writes, ready, results))
+            process.start()
+            for _ in range(num_watchers):
+                ready.get()
+        time.sleep(0.5) # the subscriptions reach the servers
+        with Client(ports, timeout=10) as client:
+            start = time.perf_counter()
+            for i in range(args.writes):
+                client.set(f"key:{i}", time.time())
+            rate = args.writes / (time.perf_counter() - start)
+        delivered, latencies = 0, []
+        if process is not None:
+            delivered, latencies = results.get()
+            process.join()
+        share = 100 * delivered / (num_watchers * args.writes) if num_watchers else float("nan")
+        return rate, share, 1000 * percentile(latencies, 50), 1000 * percentile(latencies, 99)
+    finally:
+        if slow is not None:
+            slow.close(linger=0)
+        context.term()
+        cluster._destroy()
+        time.sleep(0.5) # let the ports go before the next run
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Writes per second and notification latency with watchers of the changes.")
+    parser.add_argument("--levels", nargs="+", default=["sequential"],
+                        choices=["linearizability", "sequential", "eventual", "causal"])
+    parser.add_argument("--watchers", type=int, nargs="+", default=[0, 1, 10, 100])
+    parser.add_argument("--servers", type=int, default=3)
+    parser.add_argument("--writes", type=int, default=5000)
+    parser.add_argument("--hwm", type=int, default=1000, help="watch_hwm of the servers")
+    parser.add_argument("--slow", action="store_true", help="add a subscriber that never reads")
+    parser.add_argument("--base-port", type=int, default=8600)
+    args = parser.parse_args()
+
+    print(f"{'level':<15} {'watchers':>8} {'writes/s':>8} {'delivered %':>11} {'p50 ms':>7} {'p99 ms':>7}")
+    for consistency_level in args.levels:
+        for num_watchers in args.watchers:
+            rate, share, p50, p99 = run(consistency_level, num_watchers, args)
+            print(f"{consistency_level:<15} {num_watchers:>8} {rate:>8.0f} {share:>11.1f} {p50:>7.1f} {p99:>7.1f}", flush=True)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,50 +1,683 @@
 import zmq
+import zmq.asyncio
 import sys
+import json
 import time
 import random
+import heapq
+import asyncio
+import itertools
+from collections import defaultdict, deque
 
-if __name__ == '__main__':
-    client_number, server_number, requests, port_number = sys.argv[1:]
-    # client_number = int(client_number)
-    # server_number = int(server_number)
-    port_number = eval(port_number)
-    requests = eval(requests)
-    # print(requests)
-    
+from codec import CODECS, MULTI_KEY, codec_of, render, from_json
+from ring import HashRing
 
-    context = zmq.Context()
-    socket = context.socket(zmq.REQ)
-    socket.connect(f"tcp://localhost:{port_number[server_number][2]}")
-    print(f"Client {client_number} is connected to the server {server_number}")
 
-    start_time = time.time()
+REQUEST_FIELDS = ["type", "key", "value", "ttl"] # the fields of a request of a test configuration sent to the server
+
+
+def tcp_address(port):
+    return f"tcp://localhost:{port}"
+
+
+def connect(context, topology, server_number, socket_type, address=tcp_address):
+    """
+    Connect to the cluster. The topology is either the port_number dict of a single replica group,
+    or a sharded cluster {"groups": {group: {"port_number": dict}}, "vnodes": int} in which case the client
+    connects to the server server_number of every group and routes each request to the group that owns its key.
+    The address gives the endpoint of an api port, an inproc address for a cluster running in this process.
+    Returns the function that gives the socket of a key, and all the sockets.
+    """
+    if "groups" not in topology:
+        socket = context.socket(socket_type)
+        socket.connect(address(topology[server_number][2]))
+        return (lambda key: socket), [socket]
+
+    ring = HashRing(topology["groups"], topology.get("vnodes", 64))
+    sockets = {}
+    for group in topology["groups"]:
+        sockets[group] = context.socket(socket_type)
+        sockets[group].connect(address(topology["groups"][group]["port_number"][server_number][2]))
+    first = next(iter(sockets.values())) # for the requests without a key
+    return (lambda key: first if key is None else sockets[ring.owner(key)]), list(sockets.values())
+
+
+def split(route, request, sockets=()):
+    """
+    The (socket, request) pairs that make a request. The keys of an mget or an mset are sent to the groups that own
+    them in a sharded cluster, one request per group, so the request is only atomic within each group.
+    The keys of an atomic_mset must all belong to the same group. A scan is sent to every socket, the keys of its
+    range are spread over the groups.
+    """
+    if request["type"] == "scan":
+        return [(socket, request) for socket in sockets]
+    if request["type"] not in MULTI_KEY:
+        return [(route(request["key"]), request)]
+    values = request["value"] if request["type"] != "mget" else [None] * len(request["key"])
+    parts = {} # socket -> (keys, values)
+    for key, value in zip(request["key"], values):
+        keys, part_values = parts.setdefault(route(key), ([], []))
+        keys.append(key)
+        part_values.append(value)
+    if request["type"] == "atomic_mset" and len(parts) > 1:
+        raise ValueError("The keys of an atomic_mset must belong to the same group.")
+    return [(socket, {"type": request["type"], "key": keys, "value": part_values if request["type"] != "mget" else None})
+            for socket, (keys, part_values) in parts.items()]
 
+
+def run_sequential(route, sockets, client_number, requests, codec):
+    """
+    Send the requests one by one through REQ sockets, waiting for each response before sending the next request.
+    """
     for request in requests:
         if request["type"] == "sleep": # we emulate a slow network by introducing delay
-            duration = random.random() 
+            duration = random.random()
             print(f"Client {client_number} is sleeping for {duration} seconds")
             time.sleep(duration)
         else:
-            socket.send_json({"type": request["type"],
-                                "key": request["key"], 
-                                "value": request["value"]})
-            print(f"Client {client_number} sent request: {request}, waiting for response...")
-            response = socket.recv_string()
-            # while 1:
-            #     response = socket.recv_string(zmq.NOBLOCK)
-            #     if response == "ping":
-            #         socket.send_string("pong")
-            #     else:
-            #         socket.send_string("gotcha")
-            #         break
-            
-            # the feedback will be displayed in green color!
-            print(f"\033[32mClient {client_number} received response: {response}\033[0m")
+            for socket, request in split(route, request, sockets):
+                socket.send_multipart(codec.encode_request({field: request[field] for field in REQUEST_FIELDS
+                                                            if field in request}), copy=False)
+                print(f"Client {client_number} sent request: {request}, waiting for response...")
+                frames = socket.recv_multipart(copy=False)
+                _, response = codec_of(frames).decode_response(frames)
+                # while 1:
+                #     response = socket.recv_string(zmq.NOBLOCK)
+                #     if response == "ping":
+                #         socket.send_string("pong")
+                #     else:
+                #         socket.send_string("gotcha")
+                #         break
+
+                # the feedback will be displayed in green color!
+                print(f"\033[32mClient {client_number} received response: {render(response)}\033[0m")
+
+
+def run_pipelined(route, sockets, client_number, requests, window, codec):
+    """
+    Send the requests through DEALER sockets with up to `window` requests in flight.
+    Each request carries a request_id, so the responses can come back in any order.
+    A sleep request waits for all the requests in flight before sleeping.
+    """
+    in_flight = {} # request_id -> request
+    next_id = 0
+    poller = zmq.Poller()
+    for socket in sockets:
+        poller.register(socket, zmq.POLLIN)
+
+    def receive():
+        for socket in dict(poller.poll()):
+            while socket.poll(0):
+                frames = socket.recv_multipart(copy=False)[1:]
+                request_id, response = codec_of(frames).decode_response(frames)
+                request = in_flight.pop(request_id)
+                print(f"\033[32mClient {client_number} received response to {request}: {render(response)}\033[0m")
+
+    for request in requests:
+        if request["type"] == "sleep":
+            while in_flight:
+                receive()
+            duration = random.random()
+            print(f"Client {client_number} is sleeping for {duration} seconds")
+            time.sleep(duration)
+        else:
+            for socket, request in split(route, request, sockets):
+                while len(in_flight) >= window:
+                    receive()
+                socket.send_multipart([b""] + codec.encode_request({**{field: request[field] for field in REQUEST_FIELDS
+                                                                       if field in request},
+                                                                    "request_id": next_id}), copy=False)
+                print(f"Client {client_number} sent request {next_id}: {request}")
+                in_flight[next_id] = request
+                next_id += 1
+
+    while in_flight:
+        receive()
+
+
+class Client:
+    """
+    Client library of the key-value store:
+
+        with Client(port_number) as client:
+            client.set("a", 1)
+            client.mset(["b", "c"], [2, 3])
+            print(client.get("a"), client.mget(["b", "c"]))
+            print(list(client.scan("a", "c"))) # [("a", 1), ("b", 2)]
+
+    The topology is the one of `connect`. The client keeps a DEALER socket to every server of the cluster (of every
+    group of a sharded cluster) and sends each request to a replica of the group that owns its key, the one with
+    the lowest latency observed so far weighted by its requests in flight, and a random one for an EXPLORE share
+    of the requests so that the estimates stay fresh. This suits the clusters whose servers all answer every
+    request, and the local reads of sequential and eventual consistency go to the fastest replica.
+    A request that is not answered within timeout seconds, or that cannot be sent because the replica is down,
+    is retried on another replica up to `retries` times, then TimeoutError is raised.
+
+    A local read on another replica may not see a write yet. With `session` the client sticks to one replica per
+    group (the given server number, or True for the first one chosen) for read-your-writes and monotonic reads,
+    which causal consistency only gives on one server; the retries then stay on it. See `pin` and `unpin`.
+    With the binary codec (default) a get returns the value; with the json codec the requests return the text
+    form of the responses (see `render`). A Client is not thread safe, like its sockets, see `AsyncClient`.
+    """
+    EWMA = 0.2 # weight of the last latency in the estimate of a replica
+    EXPLORE = 0.05 # share of the requests sent to a random replica
+
+    def __init__(self, topology, codec="binary", timeout=1.0, retries=2, session=None, context=None, address=tcp_address):
+        self.codec = CODECS[codec]
+        self.timeout = timeout
+        self.retries = retries
+        self.session = session
+        self.own_context = context is None
+        self.context = self._context(context)
+        self.address = address
+
+        if "groups" in topology:
+            groups = {group: topology["groups"][group]["port_number"] for group in topology["groups"]}
+            self.ring = HashRing(topology["groups"], topology.get("vnodes", 64))
+        else:
+            groups = {None: topology}
+            self.ring = None
+        self.servers = {group: [] for group in groups}
+        self.sockets = {} # (group, server) -> socket
+        self.ports = {} # (group, server) -> its ports
+        for group, port_number in groups.items():
+            for server in port_number:
+                self.add_server(server, port_number[server], group)
+
+        self.latency = {} # (group, server) -> moving average of the latency of its answers in seconds
+        self.in_flight = defaultdict(int) # (group, server) -> requests waiting for an answer
+        self.pinned = {} # group -> server of the session
+        self.request_ids = itertools.count()
+        self.rng = random.Random()
+
+    def _context(self, context):
+        return context or zmq.Context()
+
+    def get(self, key):
+        return self._execute({"type": "get", "key": key, "value": None})
+
+    def set(self, key, value, ttl=None):
+        """
+        With a ttl (milliseconds), the key expires that long after the write.
+        """
+        request = {"type": "set", "key": key, "value": value}
+        if ttl is not None:
+            request["ttl"] = ttl
+        return self._execute(request)
+
+    def mget(self, keys):
+        return self._execute({"type": "mget", "key": list(keys), "value": None})
+
+    def mset(self, keys, values):
+        return self._execute({"type": "mset", "key": list(keys), "value": list(values)})
+
+    def atomic_mset(self, keys, values):
+        return self._execute({"type": "atomic_mset", "key": list(keys), "value": list(values)})
+
+    def scan(self, start=None, end=None, limit=None, page=1000):
+        """
+        Iterator over the (key, value) of the string keys in [start, end) in order, at most limit of them, a bound that
+        is None is open. The keys are fetched page by page, a request of at most `page` keys each (the servers cap
+        it at their scan_page), from every group of a sharded cluster, whose pages are merged. Every page is read
+        with the consistency level of the cluster, but not the whole range: a write may land between two pages.
+        It needs the binary codec.
+        """
+        if self.codec.name == "json":
+            raise ValueError("A scan needs the binary codec.")
+        pages = [self._scan_pages(group, start, end, limit, page) for group in self.servers]
+        return itertools.islice(heapq.merge(*pages, key=lambda item: item[0]), limit)
+
+    def prefix(self, prefix, limit=None, page=1000):
+        """
+        The scan of the keys that start with prefix.
+        """
+        return self.scan(*prefix_range(prefix), limit, page)
+
+    def _scan_pages(self, group, start, end, limit, page):
+        while limit is None or limit > 0:
+            response = self._send(group, {"type": "scan", "key": [start, end], "value": page if limit is None else min(page, limit)})
+            yield from zip(response["key"], response["value"])
+            start = response["next"]
+            if start is None:
+                return
+            if limit is not None:
+                limit -= len(response["key"])
+
+    def watch(self, prefix="", tokens=None):
+        """
+        A `Watch` of the changes of the keys that start with prefix (every key by default), from now, or from the
+        tokens of a previous watch to resume it. The servers need a watch port, see `Server`, and the binary codec.
+        """
+        if self.codec.name == "json":
+            raise ValueError("A watch needs the binary codec.")
+        return Watch(self, prefix, tokens)
+
+    def add_server(self, server, ports, group=None):
+        """
+        Send requests to a new replica of a group (the only group of a cluster that is not sharded), e.g. once
+        it joined the cluster, see `Cluster.add_server`.
+        """
+        if (group, str(server)) in self.sockets:
+            return
+        socket = self.context.socket(zmq.DEALER)
+        socket.setsockopt(zmq.IMMEDIATE, 1) # nothing is queued for a server that is down, see _send
+        socket.setsockopt(zmq.LINGER, 0)
+        socket.connect(self.address(ports[2]))
+        self.sockets[(group, str(server))] = socket
+        self.ports[(group, str(server))] = ports
+        self.servers[group].append(str(server))
+
+    def remove_server(self, server, group=None):
+        """
+        Stop sending requests to a replica, e.g. before it leaves the cluster.
+        """
+        self.servers[group].remove(str(server))
+        self.sockets.pop((group, str(server))).close(linger=0)
+        del self.ports[(group, str(server))]
+        if self.pinned.get(group) == str(server):
+            del self.pinned[group]
+
+    def pin(self, server=True):
+        """
+        Start a session: from now on the requests of a group all go to the given server, or to the replica chosen
+        for its next request if server is True.
+        """
+        self.session = server
+        self.pinned = {}
+
+    def unpin(self):
+        self.session = None
+        self.pinned = {}
+
+    def close(self):
+        for socket in self.sockets.values():
+            socket.close(linger=0)
+        if self.own_context:
+            self.context.term()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def _parts(self, request):
+        """
+        The (group, request) pairs that make a request, like `split` does with sockets.
+        """
+        if self.ring is None:
+            return [(None, request)]
+        if request["type"] not in MULTI_KEY:
+            return [(self.ring.owner(request["key"]), request)]
+        parts = {}
+        for operation in split(self.ring.owner, request):
+            parts[operation[0]] = operation[1]
+        return list(parts.items())
+
+    def _result(self, request, responses):
+        """
+        The value of a get, the values of an mget in the order of its keys, None for a write.
+        """
+        if self.codec.name == "json":
+            return " ".join(render(response) for response in responses)
+        if request["type"] == "get":
+            return responses[0]["value"]
+        if request["type"] == "mget":
+            values = {}
+            for response in responses:
+                values.update(zip(response["key"], response["value"]))
+            return [values[key] for key in request["key"]]
+        return None
+
+    def _choose(self, group, tried):
+        if self.session is not None and self.session is not False:
+            if group not in self.pinned:
+                self.pinned[group] = self._best(group, []) if self.session is True else str(self.session)
+            return self.pinned[group]
+        return self._best(group, tried)
+
+    def _best(self, group, tried):
+        candidates = [server for server in self.servers[group] if server not in tried] or self.servers[group]
+        if self.rng.random() < self.EXPLORE:
+            return self.rng.choice(candidates)
+        # a replica never measured has no latency yet, so it is tried first
+        return min(candidates, key=lambda server: self.latency.get((group, server), 0) * (1 + self.in_flight[(group, server)]))
+
+    def _observe(self, group, server, seconds):
+        last = self.latency.get((group, server))
+        self.latency[(group, server)] = seconds if last is None else (1 - self.EWMA) * last + self.EWMA * seconds
+
+    def _penalize(self, group, server): # the replica did not answer in time
+        self.latency[(group, server)] = max(2 * self.latency.get((group, server), 0), self.timeout)
+
+    def _connect_wait(self, group, server):
+        """
+        Milliseconds to wait for the socket of a replica to be connected: a socket is not writable until then, so a
+        request to a replica that is down fails over instead of being queued. A replica that did not answer in time
+        is only tried again once connected, so exploring it costs nothing while it is down.
+        """
+        return 0 if self.latency.get((group, server), 0) >= self.timeout else 1000 * self.timeout
+
+    def _encode(self, request, request_id):
+        return [b""] + self.codec.encode_request(dict(request, request_id=request_id))
+
+    def _decode(self, frames):
+        frames = frames[1:]
+        return codec_of(frames).decode_response(frames)
+
+    def _execute(self, request):
+        return self._result(request, [self._send(group, part) for group, part in self._parts(request)])
+
+    def _send(self, group, request, replica=None):
+        """
+        The response to a request, sent to the given replica or to the chosen one of the group.
+        """
+        tried = []
+        for attempt in range(self.retries + 1):
+            server = replica or self._choose(group, tried)
+            tried.append(server)
+            socket = self.sockets[(group, server)]
+            request_id = next(self.request_ids)
+            start = time.perf_counter()
+            self.in_flight[(group, server)] += 1
+            try:
+                response = None
+                if socket.poll(self._connect_wait(group, server), zmq.POLLOUT):
+                    socket.send_multipart(self._encode(request, request_id))
+                    response = self._wait(socket, request_id, start + self.timeout)
+            finally:
+                self.in_flight[(group, server)] -= 1
+            if response is not None:
+                self._observe(group, server, time.perf_counter() - start)
+                return self._checked(response)
+            self._penalize(group, server)
+        raise TimeoutError(f"The {request['type']} request is not answered after {self.retries + 1} attempts")
+
+    def _checked(self, response):
+        """
+        The response, unless the server found the arguments of the request invalid (the binary codec only, the json
+        codec renders it as "error:..."), then ValueError is raised: the request would fail again on any replica.
+        """
+        if isinstance(response, dict) and response["type"] == "error":
+            raise ValueError(response["value"])
+        return response
+
+    def _wait(self, socket, request_id, deadline):
+        while 1:
+            remaining = deadline - time.perf_counter()
+            if remaining <= 0 or not socket.poll(1000 * remaining):
+                return None
+            reply_id, response = self._decode(socket.recv_multipart())
+            if reply_id == request_id: # otherwise a late answer to a request that timed out
+                return response
+
+
+class AsyncClient(Client):
+    """
+    The asyncio interface of `Client`: the same methods return awaitables, e.g. `await client.get("a")`, and many
+    requests can be in flight at once, e.g. with asyncio.gather, the load of a replica counts in its choice.
+    It must be used from one event loop. The context of an in-process cluster is shadowed by an asyncio context.
+    """
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.futures = {} # request_id -> future of its response
+        self.readers = {} # socket -> the task that reads it, started by the first request
+
+    def _context(self, context):
+        return zmq.asyncio.Context.shadow(context) if context is not None else zmq.asyncio.Context()
+
+    def close(self):
+        for reader in self.readers.values():
+            reader.cancel()
+        super().close()
+
+    def remove_server(self, server, group=None):
+        reader = self.readers.pop(self.sockets.get((group, str(server))), None)
+        if reader is not None:
+            reader.cancel()
+        super().remove_server(server, group)
+
+    async def _reader(self, socket):
+        while 1:
+            reply_id, response = self._decode(await socket.recv_multipart())
+            future = self.futures.pop(reply_id, None)
+            if future is not None and not future.done():
+                future.set_result(response)
+
+    def _start_readers(self):
+        for socket in self.sockets.values(): # the new replicas too
+            if socket not in self.readers:
+                self.readers[socket] = asyncio.ensure_future(self._reader(socket))
+
+    async def _execute(self, request):
+        self._start_readers()
+        responses = await asyncio.gather(*[self._send(group, part) for group, part in self._parts(request)])
+        return self._result(request, responses)
+
+    async def scan(self, start=None, end=None, limit=None, page=1000):
+        """
+        The list of the (key, value) of the scan (see `Client.scan`), the groups of a sharded cluster are read concurrently.
+        """
+        if self.codec.name == "json":
+            raise ValueError("A scan needs the binary codec.")
+        self._start_readers()
+        pages = await asyncio.gather(*[self._scan_group(group, start, end, limit, page) for group in self.servers])
+        return list(itertools.islice(heapq.merge(*pages, key=lambda item: item[0]), limit))
+
+    async def _scan_group(self, group, start, end, limit, page):
+        items = []
+        while limit is None or len(items) < limit:
+            count = page if limit is None else min(page, limit - len(items))
+            response = await self._send(group, {"type": "scan", "key": [start, end], "value": count})
+            items.extend(zip(response["key"], response["value"]))
+            start = response["next"]
+            if start is None:
+                break
+        return items
+
+    def watch(self, prefix="", tokens=None):
+        raise ValueError("A watch needs a Client, its changes are received synchronously.")
+
+    async def _send(self, group, request, replica=None):
+        tried = []
+        for attempt in range(self.retries + 1):
+            server = replica or self._choose(group, tried)
+            tried.append(server)
+            request_id = next(self.request_ids)
+            future = asyncio.get_running_loop().create_future()
+            self.futures[request_id] = future
+            start = time.perf_counter()
+            self.in_flight[(group, server)] += 1
+            try:
+                socket = self.sockets[(group, server)]
+                if not await socket.poll(self._connect_wait(group, server), zmq.POLLOUT):
+                    raise asyncio.TimeoutError
+                await socket.send_multipart(self._encode(request, request_id))
+                response = await asyncio.wait_for(future, start + self.timeout - time.perf_counter())
+                self._observe(group, server, time.perf_counter() - start)
+                return self._checked(response)
+            except asyncio.TimeoutError:
+                self._penalize(group, server)
+            finally:
+                self.futures.pop(request_id, None)
+                self.in_flight[(group, server)] -= 1
+        raise TimeoutError(f"The {request['type']} request is not answered after {self.retries + 1} attempts")
+
+
+class Watch:
+    """
+    The changes of the keys that start with a prefix, pushed by the servers (see `Server._watch_publisher`):
+
+        with client.watch("user:") as watch:
+            for key, value, (timestamp, id) in watch: # a removed key has the value None
+                ...
+            tokens = watch.tokens # to resume with client.watch("user:", tokens)
+
+    The watch subscribes to the watch port of one replica per group, the one chosen for a request or the one of its
+    token, and gives the changes of every group in the order the replica applied them, with the timestamp and the id
+    of their write. A change the replica dropped on its way (the subscriber was too slow) is detected by the counts
+    of the changes, and fetched with "changes" requests from the token of the last change received, as are the
+    changes made before the subscription took effect, and, on a resume, the changes made since the tokens as soon as
+    the watch is created. When the replica no longer keeps the changes after a token (a resume after too long, a slow
+    subscriber, another run of the replica), the next call to `next` raises LookupError: the keys must be
+    read again, e.g. with `Client.prefix`, and the watch goes on from the changes made after the error.
+    A Watch uses the sockets of its client, it must be closed before the client.
+    """
+    def __init__(self, client, prefix, tokens=None):
+        self.client = client
+        self.prefix = prefix
+        self.servers = {} # group -> the replica watched
+        self.sockets = {} # socket -> group
+        self.tokens = {} # group -> token of the last change returned, to resume from
+        self.received = {} # group -> token of the last change received
+        self.counts = {} # group -> count of the changes of the prefix in the last notification, None to catch up
+        self.pending = deque() # (group, token, change) received, not returned yet
+        self.lost = None # the LookupError of a resume, raised by the first next
+        self.poller = zmq.Poller()
+        try:
+            for group in client.servers:
+                token = (tokens or {}).get(group)
+                server = token.split("-")[0] if token is not None else None
+                if server not in client.servers[group]: # a token of a replica that left is lost anyway
+                    server = client._choose(group, [])
+                if len(client.ports[(group, server)]) < 4:
+                    raise ValueError(f"The server {server} has no watch port.")
+                socket = client.context.socket(zmq.SUB)
+                socket.setsockopt(zmq.LINGER, 0)
+                socket.setsockopt(zmq.SUBSCRIBE, prefix.encode())
+                socket.connect(client.address(client.ports[(group, server)][3]))
+                self.poller.register(socket, zmq.POLLIN)
+                self.sockets[socket] = group
+                self.servers[group] = server
+                self.counts[group] = None
+                if token is None: # from now
+                    token = self._request(group, None)["next"]
+                    self.tokens[group] = self.received[group] = token
+                    continue
+                self.tokens[group] = self.received[group] = token
+                try: # the changes made while we were away, no notification will tell about them
+                    self._catch_up(group)
+                except LookupError as error:
+                    self.lost = error
+        except BaseException:
+            self.close()
+            raise
+
+    def next(self, timeout=None):
+        """
+        The next change (key, value, (timestamp, id)), None if there is none within timeout seconds.
+        """
+        if self.lost is not None:
+            error, self.lost = self.lost, None
+            raise error
+        deadline = None if timeout is None else time.perf_counter() + timeout
+        while not self.pending:
+            remaining = None if deadline is None else max(deadline - time.perf_counter(), 0)
+            ready = self.poller.poll(None if remaining is None else 1000 * remaining)
+            if not ready and remaining is not None:
+                return None
+            for socket, _ in ready:
+                frames = socket.recv_multipart()[1:] # after the topic
+                self._receive(self.sockets[socket], codec_of(frames).decode_message(frames))
+        group, token, change = self.pending.popleft()
+        self.tokens[group] = token
+        return change
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        return self.next()
+
+    def close(self):
+        for socket in self.sockets:
+            socket.close(linger=0)
+        self.sockets = {}
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def _request(self, group, token):
+        response = self.client._send(group, {"type": "changes", "key": self.prefix, "value": token}, self.servers[group])
+        if "next" not in response:
+            raise ValueError(f"The server {self.servers[group]} has no watch port.")
+        return response
+
+    def _receive(self, group, message):
+        stream, _, seq = message["token"].rpartition(":")
+        count = dict(message["counts"]).get(self.prefix)
+        last_stream, _, last_seq = self.received[group].rpartition(":")
+        if count is None or self.counts[group] is None or count != self.counts[group] + 1 or stream != last_stream:
+            self.counts[group] = count
+            self._catch_up(group) # up to this change at least
+            return
+        self.counts[group] = count
+        if int(seq) <= int(last_seq): # caught up already
+            return
+        _, key, value = message["operations"][0]
+        self.received[group] = message["token"]
+        self.pending.append((group, message["token"], (key, value, (message["timestamp"], message["id"]))))
+
+    def _catch_up(self, group):
+        while 1:
+            response = self._request(group, self.received[group])
+            if response["lost"]:
+                self.pending = deque(item for item in self.pending if item[0] != group)
+                self.tokens[group] = self.received[group] = response["next"]
+                self.counts[group] = None
+                raise LookupError(f"The changes after the token of the group {group} are no longer kept by the server "
+                                  f"{self.servers[group]}, the keys must be read again.")
+            stream = response["next"].rpartition(":")[0]
+            for key, value, (seq, timestamp, id) in zip(response["key"], response["value"], response["changes"]):
+                self.pending.append((group, f"{stream}:{seq}", (key, value, (timestamp, id))))
+            self.received[group] = response["next"]
+            if not response["more"]:
+                return
+
+
+def prefix_range(prefix):
+    """
+    The range [start, end) of the string keys that start with prefix, end is None if no string follows them all.
+    """
+    for i in range(len(prefix) - 1, -1, -1):
+        if ord(prefix[i]) < sys.maxunicode:
+            return prefix, prefix[:i] + chr(ord(prefix[i]) + 1)
+    return prefix, None
+
+
+def run(client_number, server_number, requests, topology, window=1, codec=CODECS["json"], context=None, address=tcp_address):
+    """
+    Connect to the cluster and send all the requests, one at a time if the window is 1, pipelined otherwise.
+    """
+    context = context or zmq.Context()
+    route, sockets = connect(context, topology, server_number, zmq.REQ if window == 1 else zmq.DEALER, address)
+    print(f"Client {client_number} is connected to the server {server_number}")
+
+    start_time = time.time()
+
+    if window == 1:
+        run_sequential(route, sockets, client_number, requests, codec)
+    else:
+        run_pipelined(route, sockets, client_number, requests, window, codec)
 
     end_time = time.time()
     print(f"\033[91mClient {client_number} has finished all the requests in {end_time - start_time} seconds\033[0m")
-    
-
+    for socket in sockets:
+        socket.close()
 
 
+if __name__ == '__main__':
+    client_number, server_number, requests, port_number = sys.argv[1:5]
+    # the window is the number of requests in flight, a window larger than 1 needs a server in "router" api mode
+    window = int(sys.argv[5]) if len(sys.argv) > 5 else 1
+    codec = CODECS[sys.argv[6] if len(sys.argv) > 6 else "json"]
+    # client_number = int(client_number)
+    # server_number = int(server_number)
+    port_number = json.loads(port_number)
+    requests = from_json(requests)
+    # print(requests)
 
+    run(client_number, server_number, requests, port_number, window, codec)
@@ -0,0 +1,334 @@
+import json
+import base64
+import struct
+
+
+"""
+Wire formats of the messages exchanged by the servers and the clients. There are three kinds of messages:
+- message: between servers, {"timestamp": int, "id": int, "ack": 0 or 1, "sync": 1 (optional), "operations": [[type, key, value], ...],
+  "deps": [[server, count], ...] (optional, the causal dependencies of the message), and any other field the protocol
+  of a server needs, e.g. the term of the leader-based ordering}
+- request: from a client, {"type": str, "key": str, "value": any, "request_id": int (only for pipelined clients),
+  "ttl": int (optional, milliseconds after which the key of a set expires)}
+- response: to a client, {"type": str, "key": str, "value": any}, the value is the one read (get) or None (set),
+  or {"type": "error", "key": the key of the request, "value": why} for a request whose arguments are invalid
+The multi-key requests and responses (mget, mset, atomic_mset) have the list of the keys as key and the list of the
+values as value (None for an mget request and an mset response).
+A scan request has the bounds [start, end] of its range as key and the number of keys it wants as value, and its
+response the keys and the values of a page like an mget, and "next": the key the range goes on from, None at its end.
+A changes request has a prefix as key and a resume token as value, and its response the keys and the values of the
+changes after the token like an mget (None for a removed key), "changes": [[seq, timestamp, id], ...] their positions,
+"next": the token to go on from, "more" and "lost" (see `Server._changes`).
+
+Every message is a list of ZeroMQ frames. The json codec sends a single json frame and renders the responses
+as the original strings (e.g. "success" or "a:10"), it is the default and is handy for debugging.
+The binary codec sends a fixed-width header frame followed by one key frame and one value frame per operation,
+so large values are never copied into a json document. The first byte of a binary header is MAGIC, which is
+never the first byte of a json document, so the receiver detects the codec of every message (`codec_of`) and a
+server answers each client with the codec of its request.
+A bytes value, which a client of the binary codec can write, travels in a json document as {"$bytes": base64}
+(see `to_json`), e.g. between the servers of the json codec.
+"""
+
+
+MAGIC = 0xB7
+VERSION = 1
+
+# kinds of binary messages
+MESSAGE = 1
+REQUEST = 2
+RESPONSE = 3
+
+# flags of binary messages
+FLAG_ACK = 1
+FLAG_REQUEST_ID = 2
+FLAG_SYNC = 4
+FLAG_DEPS = 8
+FLAG_EXTRA = 16
+
+# the fields of a message that the binary header and frames carry, the other ones travel as a json frame (FLAG_EXTRA)
+MESSAGE_FIELDS = {"timestamp", "id", "ack", "sync", "operations", "deps"}
+
+# magic, version, kind, flags, timestamp, id (sender id of a message, request id of a request or a response), number of operations
+HEADER = struct.Struct("!BBBBqqI")
+# op code, key type, value type, one per operation after the header
+OPERATION = struct.Struct("!BBB")
+INT64 = struct.Struct("!q")
+# server, count, one per dependency in the last frame of a message with FLAG_DEPS
+DEPENDENCY = struct.Struct("!iq")
+
+OPCODES = {"set": 1, "get": 2, "cpu": 3, "ping": 4, "mget": 5, "mset": 6, "atomic_mset": 7, "join": 8, "leave": 9, "promote": 10,
+           "ttl": 11, "expire": 12, "evict": 13, "scan": 14, "changes": 15,
+           "error": 16, "stats": 17}
+OPNAMES = {code: name for name, code in OPCODES.items()}
+# requests on a list of keys, the binary codec sends them as one operation per key
+MULTI_KEY = ["mget", "mset", "atomic_mset"]
+# changes of the members of a cluster (see `Server_leader`), the key is a server number and the value of a join its ports,
+# a promote is only an entry of the log
+MEMBERSHIP = ["join", "leave", "promote"]
+# operations of the memory-bounded store (see `Server`): the ttl of the key of the set just before it, in milliseconds in
+# a request and as the deadline in milliseconds since the epoch between the servers, the expiry of a key at a deadline,
+# and the eviction of a key
+EXPIRY = ["ttl", "expire", "evict"]
+
+# requests that only read, answered from the local store by the levels that read locally
+READS = ["get", "mget", "scan"]
+
+# types of the keys and values
+NONE = 0
+INT = 1
+STR = 2
+BYTES = 3
+JSON = 4 # anything else json can represent (float, bool, list, dict, very large int)
+
+
+def render(response):
+    """
+    The text form of a response, as the json codec sends it.
+    """
+    if isinstance(response, str): # already rendered by the json codec
+        return response
+    if response["type"] == "error":
+        return f"error:{response['value']}"
+    if response["type"] in ["set", "mset", "atomic_mset"]:
+        return "success"
+    if response["type"] in MEMBERSHIP:
+        return "success" if response["value"] is None else f"{response['type']}:{response['value']}"
+    if response["type"] in ["mget", "scan"]:
+        text = " ".join(f"{key}:{value}" for key, value in zip(response["key"], response["value"]))
+        return text if response.get("next") is None else f"{text} next:{response['next']}"
+    if response["type"] == "changes" and "next" in response:
+        pairs = [f"{key}:{value}" for key, value in zip(response["key"], response["value"])]
+        return " ".join(["lost"] * response["lost"] + pairs + [f"next:{response['next']}"])
+    return f"{response['key'] if response['key'] is not None else response['type']}:{response['value']}"
+
+
+def expand(request):
+    """
+    The single-key operations [(type, key, value), ...] of a request: one get per key of an mget,
+    one set per key of an mset or an atomic_mset (the last value of a repeated key), and the request itself otherwise,
+    followed by its ttl for a set with a ttl.
+    """
+    if request["type"] == "mget":
+        return [("get", key, None) for key in request["key"]]
+    if request["type"] in MULTI_KEY:
+        return [("set", key, value) for key, value in dict(zip(request["key"], request["value"])).items()]
+    if request["type"] == "set" and request.get("ttl") is not None:
+        return [("set", request["key"], request["value"]), ("ttl", request["key"], request["ttl"])]
+    return [(request["type"], request["key"], request["value"])]
+
+
+def _json_default(value):
+    if isinstance(value, (bytes, bytearray, memoryview)):
+        return {"$bytes": base64.b64encode(value).decode()}
+    raise TypeError(f"Object of type {type(value).__name__} is not JSON serializable")
+
+
+def _json_object(value):
+    if len(value) == 1 and "$bytes" in value and isinstance(value["$bytes"], str):
+        return base64.b64decode(value["$bytes"])
+    return value
+
+
+def to_json(value):
+    """
+    The json document of a value that may hold bytes, as {"$bytes": base64}, which `from_json` reads back as bytes.
+    """
+    return json.dumps(value, default=_json_default).encode()
+
+
+def from_json(data):
+    return json.loads(data, object_hook=_json_object)
+
+
+def _buffer(frame):
+    return memoryview(frame) # works for both bytes and zmq.Frame (received with copy=False)
+
+
+def encode_value(value):
+    """
+    (type, bytes) of a key or a value, shared by the binary codec and the compact storage engine.
+    """
+    if value is None:
+        return NONE, b""
+    if type(value) is int and -2**63 <= value < 2**63:
+        return INT, INT64.pack(value)
+    if isinstance(value, str):
+        return STR, value.encode()
+    if isinstance(value, (bytes, bytearray, memoryview)):
+        return BYTES, value
+    return JSON, to_json(value)
+
+
+def decode_value(value_type, buffer):
+    if value_type == NONE:
+        return None
+    if value_type == INT:
+        return INT64.unpack(buffer)[0]
+    if value_type == STR:
+        return str(buffer, "utf-8")
+    if value_type == BYTES:
+        return bytes(buffer)
+    if value_type == JSON:
+        return from_json(bytes(buffer))
+    raise ValueError(f"Unknown value type {value_type}")
+
+
+class JSONCodec:
+    """
+    The original format: one json frame per message.
+    """
+    name = "json"
+
+    def encode_message(self, message):
+        return [to_json(message)]
+
+    def decode_message(self, frames):
+        return from_json(bytes(_buffer(frames[0])))
+
+    def encode_request(self, request):
+        return [to_json(request)]
+
+    def decode_request(self, frames):
+        return from_json(bytes(_buffer(frames[0])))
+
+    def encode_response(self, response, request_id=None):
+        if request_id is None:
+            return [render(response).encode()]
+        # pipelined client, tag the response so it can be matched out of order
+        return [json.dumps({"request_id": request_id, "response": render(response)}).encode()]
+
+    def decode_response(self, frames):
+        """
+        Returns (request_id, response), the response is the text form.
+        """
+        body = bytes(_buffer(frames[0])).decode()
+        if body.startswith("{"):
+            reply = json.loads(body)
+            return reply["request_id"], reply["response"]
+        return None, body
+
+
+class BinaryCodec:
+    """
+    Versioned binary format: [header + operation descriptors, key 0, value 0, key 1, value 1, ...].
+    """
+    name = "binary"
+
+    def _encode(self, kind, flags, timestamp, id, operations):
+        header = [HEADER.pack(MAGIC, VERSION, kind, flags, timestamp, id, len(operations))]
+        frames = [None]
+        for operation, key, value in operations:
+            key_type, key_frame = encode_value(key)
+            value_type, value_frame = encode_value(value)
+            header.append(OPERATION.pack(OPCODES[operation], key_type, value_type))
+            frames.append(key_frame)
+            frames.append(value_frame)
+        frames[0] = b"".join(header)
+        return frames
+
+    def _decode(self, frames):
+        buffer = _buffer(frames[0])
+        magic, version, kind, flags, timestamp, id, count = HEADER.unpack_from(buffer)
+        if magic != MAGIC or version != VERSION:
+            raise ValueError(f"Unsupported binary message version {version}")
+        operations = []
+        for i in range(count):
+            opcode, key_type, value_type = OPERATION.unpack_from(buffer, HEADER.size + i * OPERATION.size)
+            operations.append((OPNAMES[opcode],
+                               decode_value(key_type, _buffer(frames[1 + 2 * i])),
+                               decode_value(value_type, _buffer(frames[2 + 2 * i]))))
+        return kind, flags, timestamp, id, operations
+
+    def _operations(self, request): # of a request or a response
+        if request["type"] not in MULTI_KEY:
+            return expand(request) if request["type"] == "set" else [(request["type"], request["key"], request["value"])]
+        if not request["key"]:
+            raise ValueError(f"An {request['type']} needs at least one key in the binary codec")
+        values = request["value"] if request["value"] is not None else [None] * len(request["key"])
+        return [(request["type"], key, value) for key, value in zip(request["key"], values)]
+
+    def _from_operations(self, operations): # the inverse of _operations
+        operation, key, value = operations[0]
+        if operation not in MULTI_KEY:
+            if len(operations) > 1: # a set with a ttl
+                return {"type": operation, "key": key, "value": value, "ttl": operations[1][2]}
+            return {"type": operation, "key": key, "value": value}
+        return {"type": operation, "key": [key for _, key, _ in operations], "value": [value for _, _, value in operations]}
+
+    def encode_message(self, message):
+        flags = (FLAG_ACK if message.get("ack") else 0) | (FLAG_SYNC if message.get("sync") else 0)
+        if "deps" in message:
+            flags |= FLAG_DEPS
+        extra = {field: value for field, value in message.items() if field not in MESSAGE_FIELDS}
+        if extra:
+            flags |= FLAG_EXTRA
+        frames = self._encode(MESSAGE, flags, message["timestamp"], message["id"], message.get("operations", []))
+        if "deps" in message:
+            frames.append(b"".join(DEPENDENCY.pack(server, count) for server, count in message["deps"]))
+        if extra:
+            frames.append(to_json(extra))
+        return frames
+
+    def decode_message(self, frames):
+        kind, flags, timestamp, id, operations = self._decode(frames)
+        message = {"timestamp": timestamp, "id": id, "ack": 1 if flags & FLAG_ACK else 0}
+        if not flags & FLAG_ACK:
+            message["operations"] = operations
+        if flags & FLAG_SYNC:
+            message["sync"] = 1
+        if flags & FLAG_DEPS:
+            frame = frames[-2] if flags & FLAG_EXTRA else frames[-1]
+            message["deps"] = [list(dependency) for dependency in DEPENDENCY.iter_unpack(_buffer(frame))]
+        if flags & FLAG_EXTRA:
+            message.update(from_json(bytes(_buffer(frames[-1]))))
+        return message
+
+    def encode_request(self, request):
+        request_id = request.get("request_id")
+        flags = FLAG_REQUEST_ID if request_id is not None else 0
+        return self._encode(REQUEST, flags, 0, request_id or 0, self._operations(request))
+
+    def decode_request(self, frames):
+        kind, flags, timestamp, id, operations = self._decode(frames)
+        request = self._from_operations(operations)
+        if flags & FLAG_REQUEST_ID:
+            request["request_id"] = id
+        return request
+
+    def encode_response(self, response, request_id=None):
+        flags = FLAG_REQUEST_ID if request_id is not None else 0
+        if response["type"] == "scan" and "next" in response: # the key the range goes on from, then a get per key of the page
+            operations = [("scan", response["next"], None)] + [("get", key, value) for key, value in zip(response["key"], response["value"])]
+        elif response["type"] == "changes" and "next" in response: # the token and the positions, then a set per change
+            position = {field: response[field] for field in ["lost", "more", "changes"]}
+            operations = [("changes", response["next"], position)] + [("set", key, value) for key, value in zip(response["key"], response["value"])]
+        else:
+            operations = self._operations(response)
+        return self._encode(RESPONSE, flags, 0, request_id or 0, operations)
+
+    def decode_response(self, frames):
+        """
+        Returns (request_id, response), the response is a dict.
+        """
+        kind, flags, timestamp, id, operations = self._decode(frames)
+        if operations[0][0] == "scan" and operations[0][2] is None:
+            response = {"type": "scan", "key": [key for _, key, _ in operations[1:]],
+                        "value": [value for _, _, value in operations[1:]], "next": operations[0][1]}
+        elif operations[0][0] == "changes" and isinstance(operations[0][2], dict):
+            response = {"type": "changes", "key": [key for _, key, _ in operations[1:]],
+                        "value": [value for _, _, value in operations[1:]], "next": operations[0][1], **operations[0][2]}
+        else:
+            response = self._from_operations(operations)
+        return id if flags & FLAG_REQUEST_ID else None, response
+
+
+CODECS = {"json": JSONCodec(), "binary": BinaryCodec()}
+
+
+def codec_of(frames):
+    """
+    The codec a message was encoded with.
+    """
+    first = _buffer(frames[0])
+    return CODECS["binary"] if len(first) and first[0] == MAGIC else CODECS["json"]
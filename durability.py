@@ -0,0 +1,297 @@
+import os
+import json
+import mmap
+import time
+import zlib
+import struct
+import threading
+
+from codec import STR, JSON, encode_value, decode_value, to_json, from_json
+
+
+"""
+Optional durability layer of a server: an append-only log of the applied writes, plus periodic snapshots of the store.
+
+The data directory of a server holds:
+- log-<first seq>.wal: segments of the write-ahead log, every record is
+  [length, crc32, seq, timestamp, id] followed by the entries of the keys written by one applied batch.
+- snapshot-<seq>.snap: the whole store after the record seq, written by a background thread and loaded with mmap,
+  [magic, version, seq, clock, count, length of the entries] followed by an entry per key.
+An entry is [key type, value type, key length, value length, key, value] in the encoding of the binary codec
+(`encode_value`), so that every value the store holds (bytes, None, ...) comes back as it was written, and a removed
+key has the value type REMOVED_TYPE. A record or a snapshot may end with the state of the server beside its store
+(e.g. the deadlines of the keys), an entry with the key type STATE_TYPE whose value is bytes-safe json (`to_json`):
+the changes of the state made by the record, or the whole state for a snapshot. The records of the logs written
+before, a json list of [key, value] where a removed key has the value null, and the snapshots of version 1, two json
+lists, and of version 2, without a state, are still read.
+
+On restart, the latest snapshot is loaded and only the records of the log after it are replayed.
+A torn record at the end of the log (crash in the middle of a write) fails its crc and ends the replay.
+"""
+
+
+RECORD = struct.Struct("!IIqqi") # length of the payload, crc32 of the payload, seq, timestamp, id
+SNAPSHOT_MAGIC = b"KVSN"
+SNAPSHOT_VERSION = 3
+SNAPSHOT_HEADER = struct.Struct("!4sBqqIQ") # magic, version, seq, clock, number of keys, length of the entries
+ENTRY = struct.Struct("!BBII") # key type, value type, key length, value length
+REMOVED_TYPE = 255 # value type of a removed key
+STATE_TYPE = 254 # key type of the entry of the state of the server
+
+REMOVED = object() # the value of a removed key in the writes of a batch, None is a value like the others
+
+FSYNC_POLICIES = ["op", "batch", "interval"]
+
+
+def encode_entries(items, state=None):
+    """
+    The entries of the (key, value) items, the value of a removed key is REMOVED, followed by the entry of the state
+    if there is one.
+    """
+    parts = []
+    for key, value in items:
+        key_type, key_bytes = encode_value(key)
+        value_type, value_bytes = (REMOVED_TYPE, b"") if value is REMOVED else encode_value(value)
+        parts += [ENTRY.pack(key_type, value_type, len(key_bytes), len(value_bytes)), key_bytes, value_bytes]
+    if state is not None:
+        state_bytes = to_json(state)
+        parts += [ENTRY.pack(STATE_TYPE, JSON, 0, len(state_bytes)), state_bytes]
+    return b"".join(parts)
+
+
+def decode_entries(buffer):
+    """
+    The (key, value) items of the entries in buffer and the state that ends them, None if there is none.
+    """
+    unpack, size, end = ENTRY.unpack_from, ENTRY.size, len(buffer)
+    items, state = [], None
+    offset = 0
+    while offset < end:
+        key_type, value_type, key_length, value_length = unpack(buffer, offset)
+        offset += size
+        if key_type == STATE_TYPE:
+            state = from_json(buffer[offset + key_length:offset + key_length + value_length])
+            offset += key_length + value_length
+            continue
+        key = buffer[offset:offset + key_length]
+        key = key.decode() if key_type == STR else decode_value(key_type, key) # most keys are strings
+        offset += key_length
+        value = REMOVED if value_type == REMOVED_TYPE else decode_value(value_type, buffer[offset:offset + value_length])
+        offset += value_length
+        items.append((key, value))
+    return items, state
+
+
+def _fsync_directory(directory):
+    fd = os.open(directory, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+class Durability:
+    """
+    The write-ahead log and the snapshots of one server. It is thread safe.
+    fsync is the group-fsync policy of the log:
+    - "op": one record and one fsync per written key, the reply of a write always follows its fsync
+    - "batch": one record and one fsync per applied batch
+    - "interval": one record per applied batch, a background thread calls fsync every fsync_interval milliseconds,
+      so a crash can lose the writes of the last interval
+    A snapshot is taken once snapshot_every writes have been logged since the previous one.
+    state is a function that returns the whole state of the server beside its store, as json, for the snapshots: it is
+    called with the lock of the store held, like `append`. None if the server has no such state.
+    """
+    def __init__(self, directory, fsync="batch", fsync_interval=10, snapshot_every=100000, state=None):
+        if fsync not in FSYNC_POLICIES:
+            raise ValueError("The fsync policy must be one of the following: op, batch, interval.")
+        self.directory = directory
+        self.fsync = fsync
+        self.fsync_interval = fsync_interval
+        self.snapshot_every = snapshot_every
+        self.state = state
+        os.makedirs(directory, exist_ok=True)
+
+        self.lock = threading.Lock()
+        self.seq = 0 # seq of the last logged record
+        self.clock = 0 # highest timestamp logged
+        self.since_snapshot = 0 # writes logged since the last snapshot
+        self.log = None
+        self.dirty = False # written but not fsynced yet, for the interval policy
+        self.snapshot_thread = None
+
+    def _files(self, prefix, suffix):
+        """
+        The (seq, path) of the files with the given prefix and suffix, sorted by seq.
+        """
+        files = []
+        for name in os.listdir(self.directory):
+            if name.startswith(prefix) and name.endswith(suffix):
+                files.append((int(name[len(prefix):-len(suffix)]), os.path.join(self.directory, name)))
+        return sorted(files)
+
+    def recover(self, store, restore=None):
+        """
+        Load the latest snapshot into the store (see `storage.py`) and replay the log after it, then start a new log segment.
+        restore(timestamp, id, writes, state) is called with the state of the snapshot (timestamp and id None, no writes),
+        then with every replayed record once its writes reached the store, so that the server rebuilds its state beside
+        the store. The state is None if there is none.
+        Returns whether anything was recovered and the lamport clock to restart from.
+        """
+        recovered = False
+        snapshots = self._files("snapshot-", ".snap")
+        if snapshots:
+            self.seq, self.clock, state = self._load_snapshot(snapshots[-1][1], store)
+            recovered = True
+            if restore is not None:
+                restore(None, None, [], state)
+        for first_seq, path in self._files("log-", ".wal"):
+            for seq, timestamp, id, writes, state in self._read_log(path):
+                if seq <= self.seq: # already in the snapshot
+                    continue
+                recovered = True
+                for key, value in writes:
+                    if value is REMOVED: # e.g. it expired
+                        store.delete(key)
+                    else:
+                        store.put(key, value)
+                if restore is not None:
+                    restore(timestamp, id, writes, state)
+                self.seq, self.clock = seq, max(self.clock, timestamp)
+                self.since_snapshot += len(writes)
+        self._open_segment()
+        if self.fsync == "interval":
+            threading.Thread(target=self._fsync_daemon, daemon=True).start()
+        return recovered, self.clock
+
+    def _load_snapshot(self, path, store):
+        with open(path, "rb") as f:
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+                magic, version, seq, clock, count, length = SNAPSHOT_HEADER.unpack_from(data)
+                if magic != SNAPSHOT_MAGIC or version not in [1, 2, SNAPSHOT_VERSION]:
+                    raise ValueError(f"{path} is not a snapshot of version {SNAPSHOT_VERSION}")
+                if version == 1: # the json lists of the keys and of the values
+                    keys = json.loads(data[SNAPSHOT_HEADER.size:SNAPSHOT_HEADER.size + length])
+                    values = json.loads(data[SNAPSHOT_HEADER.size + length:])
+                    items, state = list(zip(keys, values)) if len(keys) == len(values) else [], None
+                else: # the entries of version 2 have no state
+                    items, state = decode_entries(data[SNAPSHOT_HEADER.size:SNAPSHOT_HEADER.size + length])
+        if len(items) != count:
+            raise ValueError(f"{path} is truncated")
+        for key, value in items:
+            store.put(key, value)
+        return seq, clock, state
+
+    def _read_log(self, path):
+        with open(path, "rb") as f:
+            data = f.read()
+        offset = 0
+        while offset + RECORD.size <= len(data):
+            length, crc, seq, timestamp, id = RECORD.unpack_from(data, offset)
+            payload = data[offset + RECORD.size:offset + RECORD.size + length]
+            if len(payload) < length or zlib.crc32(payload) != crc: # torn write at the end of the log
+                return
+            if payload[:1] == b"[": # a json record of a log written before, never the type of a key
+                writes, state = [(key, REMOVED if value is None else value) for key, value in json.loads(payload)], None
+            else:
+                writes, state = decode_entries(payload)
+            yield seq, timestamp, id, writes, state
+            offset += RECORD.size + length
+
+    def _open_segment(self): # must be called with the lock held (or before any other thread uses the log)
+        if self.log is not None:
+            self.log.flush()
+            os.fsync(self.log.fileno())
+            self.log.close()
+        self.log = open(os.path.join(self.directory, f"log-{self.seq + 1:020d}.wal"), "ab")
+        _fsync_directory(self.directory)
+
+    def _write_record(self, timestamp, id, writes, state=None):
+        self.seq += 1
+        payload = encode_entries(writes, state)
+        self.log.write(RECORD.pack(len(payload), zlib.crc32(payload), self.seq, timestamp, id) + payload)
+
+    def _sync(self):
+        self.log.flush()
+        os.fsync(self.log.fileno())
+
+    def append(self, timestamp, id, writes, store, state=None):
+        """
+        Log the writes [(key, value), ...] of a batch before it is applied to the store, the value of a removed key is
+        REMOVED, and state, the changes of the state of the server beside its store that go with them (see `recover`).
+        The caller must hold the lock of the store, so that a snapshot taken here matches the logged records.
+        Nothing is logged once the log is closed.
+        """
+        with self.lock:
+            if self.log is None:
+                return
+            if self.since_snapshot >= self.snapshot_every:
+                self._snapshot(store)
+            if self.fsync == "op": # the state goes with the last write
+                records = [[write] for write in writes] or [[]]
+                for i, record in enumerate(records):
+                    self._write_record(timestamp, id, record, state if i == len(records) - 1 else None)
+                    self._sync()
+            else:
+                self._write_record(timestamp, id, writes, state)
+                if self.fsync == "batch":
+                    self._sync()
+                else:
+                    self.log.flush()
+                    self.dirty = True
+            self.clock = max(self.clock, timestamp)
+            self.since_snapshot += len(writes)
+
+    def _fsync_daemon(self):
+        while 1:
+            time.sleep(self.fsync_interval / 1000)
+            with self.lock:
+                if self.log is None: # closed
+                    return
+                if self.dirty:
+                    self._sync()
+                    self.dirty = False
+
+    def _snapshot(self, store): # must be called with the lock held
+        """
+        Copy the store, start a new log segment and write the snapshot in the background.
+        """
+        if self.snapshot_thread is not None:
+            self.snapshot_thread.join() # at most one snapshot is written at a time
+        items = store.iterate() # a copy, consumed by the snapshot thread
+        state = self.state() if self.state is not None else None # a copy too
+        seq, clock = self.seq, self.clock
+        self._open_segment()
+        self.since_snapshot = 0
+        self.snapshot_thread = threading.Thread(target=self._write_snapshot, args=(items, state, seq, clock), daemon=True)
+        self.snapshot_thread.start()
+
+    def _write_snapshot(self, items, state, seq, clock):
+        path = os.path.join(self.directory, f"snapshot-{seq:020d}.snap")
+        items = list(items)
+        entries = encode_entries(items, state)
+        with open(path + ".tmp", "wb") as f:
+            f.write(SNAPSHOT_HEADER.pack(SNAPSHOT_MAGIC, SNAPSHOT_VERSION, seq, clock, len(items), len(entries)))
+            f.write(entries)
+            f.flush()
+            os.fsync(f.fileno())
+        os.rename(path + ".tmp", path)
+        _fsync_directory(self.directory)
+        # everything up to seq is in the snapshot now, the older snapshots and log segments can go
+        for old_seq, old_path in self._files("snapshot-", ".snap"):
+            if old_seq < seq:
+                os.remove(old_path)
+        segments = self._files("log-", ".wal")
+        for (first_seq, old_path), (next_first_seq, _) in zip(segments, segments[1:]):
+            if next_first_seq <= seq + 1:
+                os.remove(old_path)
+
+    def close(self):
+        with self.lock:
+            if self.log is None:
+                return
+            if self.snapshot_thread is not None:
+                self.snapshot_thread.join()
+            self._sync()
+            self.log.close()
+            self.log = None
@@ -0,0 +1,142 @@
+import random
+import threading
+from array import array
+
+
+"""
+Structures of the memory-bounded store (see "ttl" and max_keys in `Server`): the timing wheel that finds the keys
+whose ttl is over without scanning the store, and the sample of the keys by recency that picks the keys to evict.
+Neither decides anything by itself: the server removes a key at the position of its expire or evict operation in the
+order of the writes, so that every replica removes the same keys.
+"""
+
+
+class TimingWheel:
+    """
+    Hierarchical timing wheel of one timer per key. Time is counted in ticks of `tick` milliseconds, and the wheel has
+    `levels` levels of 2 ** bits slots: a slot of level 0 holds the timers of one tick, a slot of level l the timers
+    of 2 ** (bits * l) ticks. A timer goes to the lowest level whose range reaches it, and when the wheel enters the
+    span of a slot of a higher level, its timers move down to the slots of their own ticks, so that every timer moves
+    at most `levels` times whatever its delay and advancing by a tick only looks at the timers due then.
+    The default covers 256 ** 4 ticks, 13 years with ticks of 100 milliseconds.
+    The wheel is not thread safe, the server uses it with kv_store_lock held.
+    """
+    def __init__(self, tick=100, bits=8, levels=4, now=0):
+        self.tick = tick
+        self.bits = bits
+        self.mask = (1 << bits) - 1
+        self.levels = levels
+        self.current = now // tick # the last tick advanced to
+        self.wheels = [{} for _ in range(levels)] # level -> slot -> set of the keys of its timers, only the non-empty slots
+        self.timers = {} # key -> tick * levels + level of its timer, the slot follows from them
+
+    def __len__(self):
+        return len(self.timers)
+
+    def _place(self, key, tick):
+        level = min(max(tick - self.current, 1).bit_length() - 1, self.bits * self.levels - 1) // self.bits
+        slot = (tick >> (self.bits * level)) & self.mask
+        self.wheels[level].setdefault(slot, set()).add(key)
+        self.timers[key] = tick * self.levels + level
+
+    def schedule(self, key, when):
+        """
+        Fire the timer of the key once the wheel is advanced to the time when (milliseconds) or later, instead of its
+        current timer. A time that is already past fires at the next tick.
+        """
+        if key in self.timers:
+            self.cancel(key)
+        self._place(key, max(-(-when // self.tick), self.current + 1))
+
+    def cancel(self, key):
+        timer = self.timers.pop(key, None)
+        if timer is None:
+            return
+        tick, level = divmod(timer, self.levels)
+        slot = (tick >> (self.bits * level)) & self.mask
+        keys = self.wheels[level][slot]
+        keys.discard(key)
+        if not keys:
+            del self.wheels[level][slot]
+
+    def advance(self, now):
+        """
+        Move the wheel to the time now (milliseconds), returns the keys whose timers fired, which are removed.
+        """
+        target = now // self.tick
+        if not self.timers:
+            self.current = max(self.current, target)
+            return []
+        due = []
+        while self.current < target:
+            self.current += 1
+            tick = self.current
+            for level in range(self.levels - 1, 0, -1): # the higher levels first, their timers may be due at this tick
+                if tick & ((1 << (self.bits * level)) - 1) == 0:
+                    keys = self.wheels[level].pop((tick >> (self.bits * level)) & self.mask, ())
+                    for key in keys:
+                        self._place(key, self.timers[key] // self.levels)
+            keys = self.wheels[0].pop(tick & self.mask, ())
+            for key in keys:
+                del self.timers[key]
+            due.extend(keys)
+            if not self.timers:
+                self.current = target
+        return due
+
+
+class LruSample:
+    """
+    Approximate LRU, in the manner of Redis: every key has the time of its last access on a logical clock, and the
+    victim is the least recently used key of `samples` keys drawn at random, instead of the exact least recently used
+    one, which would need a linked list through every key. The keys are kept in a list, so a random key is an index,
+    and a removed key is replaced by the last one. It costs about 80 bytes per key.
+    It is thread safe: the reads touch their keys from the client handler while the writes are applied elsewhere.
+    """
+    def __init__(self, samples=5, seed=None):
+        self.samples = samples
+        self.keys = []
+        self.positions = {} # key -> its index in keys
+        self.stamps = array("q") # time of the last access of keys[i]
+        self.clock = 0
+        self.rng = random.Random(seed)
+        self.lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.keys)
+
+    def touch(self, key):
+        with self.lock:
+            self.clock += 1
+            position = self.positions.get(key)
+            if position is None:
+                self.positions[key] = len(self.keys)
+                self.keys.append(key)
+                self.stamps.append(self.clock)
+            else:
+                self.stamps[position] = self.clock
+
+    def _discard(self, key): # must be called with the lock held
+        position = self.positions.pop(key, None)
+        if position is None:
+            return
+        last, stamp = self.keys.pop(), self.stamps.pop()
+        if position < len(self.keys):
+            self.keys[position], self.stamps[position] = last, stamp
+            self.positions[last] = position
+
+    def discard(self, key):
+        with self.lock:
+            self._discard(key)
+
+    def victim(self):
+        """
+        Remove and return the least recently used key of a random sample, None if there is no key.
+        """
+        with self.lock:
+            if not self.keys:
+                return None
+            sample = [self.rng.randrange(len(self.keys)) for _ in range(self.samples)]
+            key = self.keys[min(sample, key=self.stamps.__getitem__)]
+            self._discard(key)
+            return key
@@ -0,0 +1,87 @@
+from bisect import bisect_left, bisect_right
+
+
+"""
+Ordered index of the keys of a store (see "scan" in `Server`): the stores of `storage.py` are hash maps, which cannot
+list the keys of a range or a prefix, so the server keeps the keys in order next to them, updated with every write
+that adds or removes a key.
+"""
+
+
+class OrderedIndex:
+    """
+    The keys in order, as a list of sorted blocks of `block` to 2 * `block` keys (fewer for the last ones after deletes)
+    and the first key of every block: a key is found with a bisection over the first keys then one in its block, and
+    inserting or deleting it only moves the keys of its block, instead of the whole list of keys. A key costs a slot
+    of its block, 8 bytes, the key itself is the object of the store.
+    Only the string keys are indexed, the order of keys of different types is undefined.
+    The index is not thread safe, the server uses it with kv_store_lock held.
+    """
+    def __init__(self, block=512):
+        self.block = block
+        self.blocks = [] # sorted lists of keys, every key of a block is before the keys of the next block
+        self.firsts = [] # first key of every block
+        self.count = 0
+
+    def __len__(self):
+        return self.count
+
+    def _locate(self, key): # the block where the key is or would go, the blocks must not be empty
+        return max(bisect_right(self.firsts, key) - 1, 0)
+
+    def add(self, key):
+        if type(key) is not str:
+            return
+        if not self.blocks:
+            self.blocks.append([key])
+            self.firsts.append(key)
+            self.count += 1
+            return
+        i = self._locate(key)
+        block = self.blocks[i]
+        j = bisect_left(block, key)
+        if j < len(block) and block[j] == key:
+            return
+        block.insert(j, key)
+        self.firsts[i] = block[0]
+        self.count += 1
+        if len(block) > 2 * self.block:
+            self.blocks[i:i + 1] = [block[:self.block], block[self.block:]]
+            self.firsts.insert(i + 1, block[self.block])
+
+    def discard(self, key):
+        if type(key) is not str or not self.blocks:
+            return
+        i = self._locate(key)
+        block = self.blocks[i]
+        j = bisect_left(block, key)
+        if j == len(block) or block[j] != key:
+            return
+        del block[j]
+        self.count -= 1
+        if not block:
+            del self.blocks[i], self.firsts[i]
+            return
+        self.firsts[i] = block[0]
+        if len(block) < self.block // 2 and i + 1 < len(self.blocks): # merged into the next block, split again if too large
+            block.extend(self.blocks.pop(i + 1))
+            del self.firsts[i + 1]
+            if len(block) > 2 * self.block:
+                self.blocks[i:i + 1] = [block[:self.block], block[self.block:]]
+                self.firsts.insert(i + 1, block[self.block])
+
+    def range(self, start=None, end=None):
+        """
+        Iterator over the keys in [start, end) in order, a bound that is None is open. The index must not change
+        while it is consumed.
+        """
+        if not self.blocks:
+            return
+        i = 0 if start is None else self._locate(start)
+        j = 0 if start is None else bisect_left(self.blocks[i], start)
+        for block in self.blocks[i:]:
+            for key in block[j:] if j else block:
+                if end is not None and key >= end:
+                    return
+                yield key
+            j = 0
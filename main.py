@@ -1,10 +1,16 @@
 import zmq
+import os
 import sys
 import time
 import threading
 import subprocess
 import json
 
+import client
+from codec import CODECS, to_json, from_json
+from server import server_class
+from network import VirtualNetwork
+
 
 """
 Here we implement distributed key-value store server with different consistency levels. The consistency schemes we implement are:
@@ -24,7 +30,7 @@ class Cluster:
 
     Furthermore, each server need another socket to communicate with the clients.
     """
-    def __init__(self, consistency_level, num_servers, port_number):
+    def __init__(self, consistency_level, num_servers, port_number, server_config=None, quiet=False):
         """
         consistency_level: str
             The consistency level of the servers in the cluster. It can be one of the following:
@@ -39,6 +45,11 @@ class Cluster:
             {0: (5000, 5011, 5012)} means that the server 0 has three ports: 
             - 5000 for sending messages and 
             - 5011 for receiving messages.
+            A fourth port is optional, the watch port where the server publishes the changes of its keys (see `Client.watch`).
+        server_config: dict
+            Optional settings passed to every server, for example {"api_mode": "router"}.
+        quiet: bool
+            Discard the output of the servers, the benchmarks use it to keep the prints off the measurement.
         """
 
         if consistency_level not in ["sequential", "eventual", "causal", "linearizability"]:
@@ -49,67 +60,276 @@ class Cluster:
         self.num_servers = num_servers
         self.consistency_level = consistency_level
         self.servers = []
-        self.port_number = port_number
-        self.processes = []
-
-        for i in port_number:
-            server_process = subprocess.Popen(['python', 
-                                               "server.py", 
-                                               str(i), 
-                                               str(port_number),
-                                               consistency_level],
-                            )
-            self.processes.append(server_process)
+        self.port_number = dict(port_number) # it follows the servers that join and leave
+        self.processes = {} # server number -> process
+        self.server_config = server_config or {}
+        self.quiet = quiet
+        self.context = None # shared by the servers and their clients in an in-process cluster
+        self._start(quiet)
+
+    def _start(self, quiet):
+        for i in self.port_number:
+            self._spawn(i, self.server_config)
+
+    def _spawn(self, i, config):
+        server_process = subprocess.Popen(['python', 
+                                           os.path.join(os.path.dirname(os.path.abspath(__file__)), "server.py"), 
+                                           str(i), 
+                                           json.dumps(self.port_number),
+                                           self.consistency_level,
+                                           json.dumps(config)],
+                                           stdout=subprocess.DEVNULL if self.quiet else None,
+                        )
+        self.processes[i] = server_process
+
+    def address(self, port):
+        """
+        The endpoint a client connects to for an api port or a watch port.
+        """
+        return f"tcp://localhost:{port}"
+
+    def _failure(self, i): # why the server i is not running, None if it is
+        process = self.processes[i]
+        return None if process.poll() is None else f"exited with the code {process.returncode}"
+
+    def _request(self, i, request, timeout):
+        """
+        Send a request to the server i and return its text response, None if it does not answer within timeout seconds.
+        """
+        context = self.context or zmq.Context()
+        socket = context.socket(zmq.REQ)
+        try:
+            socket.connect(self.address(self.port_number[i][2]))
+            socket.send_json(request)
+            return socket.recv_string() if socket.poll(1000 * timeout) else None
+        finally:
+            socket.close(linger=0)
+            if context is not self.context:
+                context.term()
+
+    def wait_ready(self, timeout=10):
+        """
+        Probe every server with a "ping" request until it answers that it is connected to all the servers of the cluster,
+        instead of sleeping for a fixed time. Raises TimeoutError if the cluster is still not ready after timeout seconds.
+        """
+        context = self.context or zmq.Context()
+        deadline = time.monotonic() + timeout
+        try:
+            for i in self.port_number:
+                while 1:
+                    failure = self._failure(i)
+                    if failure is not None:
+                        raise RuntimeError(f"Server {i} {failure}")
+                    if time.monotonic() > deadline:
+                        raise TimeoutError(f"Server {i} is not ready after {timeout} seconds")
+                    # a new REQ socket per probe, a server that is not listening yet never answers the previous one
+                    socket = context.socket(zmq.REQ)
+                    socket.connect(self.address(self.port_number[i][2]))
+                    socket.send_json({"type": "ping", "key": None, "value": None})
+                    ready = socket.poll(100) and int(socket.recv_string().split(":")[1]) == self.num_servers
+                    socket.close(linger=0)
+                    if ready:
+                        break
+        finally:
+            if context is not self.context:
+                context.term()
+
+    def add_server(self, i, ports):
+        """
+        Start the server i on the ports (recv, send, api), it joins the running cluster as a learner and becomes a
+        voter once it caught up (see `Server_leader`), which `wait_member` waits for. The clients keep using the
+        other servers meanwhile. Only the leader ordering of linearizability and sequential consistency supports it.
+        """
+        if self.server_config.get("ordering") != "leader" or self.consistency_level not in ["linearizability", "sequential"]:
+            raise ValueError("The servers can only join a cluster of linearizability or sequential consistency with the leader ordering.")
+        self.port_number[str(i)] = list(ports)
+        self.num_servers += 1
+        self._spawn(str(i), dict(self.server_config, join=True))
+
+    def wait_member(self, i, timeout=30):
+        """
+        Wait until the server i is a voter, raises TimeoutError if it is not after timeout seconds.
+        """
+        deadline = time.monotonic() + timeout
+        while time.monotonic() < deadline:
+            failure = self._failure(str(i))
+            if failure is not None:
+                raise RuntimeError(f"Server {i} {failure}")
+            stats = self._request(str(i), {"type": "stats", "key": None, "value": None}, 0.5)
+            if stats is not None and json.loads(stats.split(":", 1)[1])["gauges"].get("voter"):
+                return
+            time.sleep(0.05)
+        raise TimeoutError(f"Server {i} is not a voter after {timeout} seconds")
+
+    def remove_server(self, i, timeout=10):
+        """
+        Ask the server i to leave the cluster and stop it once it left.
+        """
+        if self._request(str(i), {"type": "leave", "key": int(i), "value": None}, timeout) is None:
+            raise TimeoutError(f"Server {i} has not left after {timeout} seconds")
+        self.port_number.pop(str(i))
+        self.num_servers -= 1
+        self._stop(str(i))
+
+    def _stop(self, i):
+        self.processes.pop(i).kill()
 
     def _destroy(self):
-        for process in self.processes:
+        for process in self.processes.values():
             process.kill()
 
 
+class SimulatedCluster(Cluster):
+    """
+    A cluster whose servers run as threads of this process, on inproc sockets instead of tcp ports, so it starts in
+    milliseconds, never clashes with the ports in use, and the messages between its servers go through a virtual
+    network (see `network.py`) that can delay, reorder and drop them deterministically from a seed.
+    The ports of port_number are only names. The clients must connect with the context of the cluster, to the
+    address of an api port, and close their sockets before _destroy, which stops the network and, if the network
+    owns the context, terminates it and closes the sockets of the servers, so the cluster releases everything.
+    """
+    def __init__(self, consistency_level, num_servers, port_number, server_config=None, quiet=False, network=None):
+        """
+        network: VirtualNetwork
+            The network of the servers, a perfect network (no latency nor loss) by default.
+        quiet: bool
+            Turn the logs of the servers off, unless server_config sets them.
+        """
+        self.network = network or VirtualNetwork()
+        super().__init__(consistency_level, num_servers, port_number, server_config, quiet)
+
+    def _start(self, quiet):
+        self.context = self.network.context
+        for i in self.port_number:
+            self._spawn(i, self.server_config)
+
+    def _spawn(self, i, config):
+        config = dict(config)
+        if self.quiet:
+            config.setdefault("log", "off")
+        # through json like the config of a server process, so that the servers never share a mutable setting
+        self.servers.append(server_class(self.consistency_level, config)(i, self.port_number[i], json.loads(json.dumps(self.port_number)),
+                                                                         json.loads(json.dumps(config)), network=self.network))
+
+    def address(self, port):
+        return self.network.address(port)
+
+    def _failure(self, i):
+        return None
+
+    def _stop(self, i): # its threads only end with the context, it no longer takes part meanwhile
+        pass
+
+    def _destroy(self):
+        self.network.stop()
+        if self.network.own_context:
+            # term returns once every socket is closed, and the servers close theirs as their threads see the termination
+            threading.Thread(target=self.context.term, daemon=True).start()
+            for server in self.servers:
+                server.close()
+
+
 
 if __name__ == '__main__':
     test_path = sys.argv[1] # get the path of test configuration file
     with open(test_path, 'r') as f:
-        test = json.load(f)
+        test = from_json(f.read()) # a {"$bytes": base64} value is bytes
 
     """
     The test configuration file should have the following format:
     - num_servers: int
     - consistency_level: str
     - port_number: dict
+    - groups: dict (instead of num_servers and port_number, to shard the keyspace over independent replica groups)
+        e.g. {"0": {"port_number": dict}, "1": {"port_number": dict}}, every group is a cluster of its own
+        and the clients send each request to the group that owns its key on a consistent hashing ring
+    - vnodes: int (optional, number of points of each group on the ring, 64 by default)
+    - server_config: dict (optional), e.g. {"api_mode": "router", "codec": "binary"}
     - clients: list of dict of each client's configuration
         e.g. {"client_number": int, "requests": list of dict of each request's configuration, "server_number": int}
         - client_number: int (its clinet id)
         - requests: list of dict of each request's configuration
             e.g. {"type": str, "key": str, "value": int}
-            - type: str (get or set)
-            - key: str
-            - value: int
-        - server_number: int (the server id to which the client is connected)  
+            - type: str (get, set, mget, mset, atomic_mset, scan or sleep)
+            - key: str (a list of keys for mget, mset and atomic_mset, [start, end] for scan)
+            - value: int (a list of values for mset and atomic_mset, the number of keys wanted for scan),
+              {"$bytes": base64} for a bytes value, which needs the binary codec
+            - ttl: int (optional, milliseconds after which the key of a set is removed)
+        - server_number: int (the server id to which the client is connected, in every group of a sharded cluster)  
+        - window: int (optional, number of requests in flight, larger than 1 needs "api_mode": "router")
+        - codec: str (optional, "json" or "binary", the wire format of its requests)
+    - timeout: int (optional, seconds to wait for the clients to finish, 60 by default)
+    - network: dict (optional), run the servers and the clients inside this process over a virtual network
+        instead of as processes on tcp ports, e.g. {"latency": 1, "jitter": 1, "reorder": 0, "loss": 0, "seed": 0}
+        (milliseconds and probabilities, see `network.py`), {} for a perfect network
     """
 
-    cluster = Cluster(test["consistency_level"], test["num_servers"], test["port_number"])
-
-    time.sleep(2) # wait for the servers to be ready
+    if "network" in test: # every replica group has a network of its own, on a context shared with the clients
+        context = zmq.Context()
+        new_cluster = lambda *args: SimulatedCluster(*args, network=VirtualNetwork(**test["network"], context=context))
+    else:
+        new_cluster = Cluster
+    if "groups" in test:
+        clusters = [new_cluster(test["consistency_level"], len(group["port_number"]), group["port_number"], test.get("server_config"))
+                    for group in test["groups"].values()]
+        topology = {"groups": test["groups"], "vnodes": test.get("vnodes", 64)}
+    else:
+        clusters = [new_cluster(test["consistency_level"], test["num_servers"], test["port_number"], test.get("server_config"))]
+        topology = test["port_number"]
+    addresses = {ports[2]: cluster.address(ports[2]) for cluster in clusters for ports in cluster.port_number.values()}
 
     client_processes = []
 
     try:
-        for client in test["clients"]:
+        for cluster in clusters:
+            cluster.wait_ready()
+
+        for client_config in test["clients"]:
+            if "network" in test: # a thread per client, they share the context of the servers
+                client_thread = threading.Thread(target=client.run,
+                                                 args=(client_config["client_number"],
+                                                       str(client_config["server_number"]),
+                                                       client_config["requests"],
+                                                       topology,
+                                                       client_config.get("window", 1),
+                                                       CODECS[client_config.get("codec", "json")],
+                                                       context,
+                                                       lambda port: addresses[port]),
+                                                 daemon=True)
+                client_thread.start()
+                client_processes.append(client_thread)
+                continue
             client_process = subprocess.Popen(['python', 
-                                            "client.py", 
-                                            str(client["client_number"]), 
-                                            str(client["server_number"]),
-                                            str(client["requests"]),
-                                            str(test["port_number"])]
+                                            os.path.join(os.path.dirname(os.path.abspath(__file__)), "client.py"), 
+                                            str(client_config["client_number"]), 
+                                            str(client_config["server_number"]),
+                                            to_json(client_config["requests"]).decode(),
+                                            json.dumps(topology),
+                                            str(client_config.get("window", 1)),
+                                            client_config.get("codec", "json")]
                                             )
             client_processes.append(client_process)
 
-        time.sleep(20) # wait for the clients to finish
+        deadline = time.monotonic() + test.get("timeout", 60)
+        for process in client_processes:
+            if isinstance(process, threading.Thread):
+                process.join(timeout=max(0, deadline - time.monotonic()))
+                finished = not process.is_alive()
+            else:
+                try:
+                    process.wait(timeout=max(0, deadline - time.monotonic()))
+                    finished = True
+                except subprocess.TimeoutExpired:
+                    finished = False
+            if not finished:
+                print(f"A client has not finished after {test.get('timeout', 60)} seconds")
+                break
     finally:
         for process in client_processes:
-            process.kill()
-        cluster._destroy()
+            if not isinstance(process, threading.Thread): # the client threads are daemons
+                process.kill()
+        for cluster in clusters:
+            cluster._destroy()
     
         
     
@@ -0,0 +1,77 @@
+import zlib
+import hashlib
+
+
+"""
+Merkle tree over the versions of the keys of a replica, used by the anti-entropy of the eventual servers.
+The keys are spread over fanout ** depth leaves by a hash of the key, so every leaf covers a range of the key hashes.
+The digest of a leaf is the sum (mod 2^64) of the digests of its (key, version) entries, so that a write updates it
+in O(1) instead of rehashing the whole leaf, and the digest of an inner node is the sum of the digests of its leaves.
+Two replicas compare their trees from the root down and only descend into the nodes that differ, so the number of
+digests and entries they exchange grows with their divergence, not with the number of keys.
+"""
+
+
+MASK = (1 << 64) - 1
+
+
+def entry_digest(key, version):
+    """
+    64-bit digest of a key at a version, the same in every process (unlike `hash` of a str).
+    """
+    timestamp, id = version
+    return int.from_bytes(hashlib.blake2b(f"{key}\0{timestamp}\0{id}".encode(), digest_size=8).digest(), "big")
+
+
+class MerkleTree:
+    """
+    The tree is not thread safe, the server updates and reads it with the lock of its versions held.
+    The nodes of a level are numbered from 0, level 0 is the root and level depth the leaves.
+    """
+    def __init__(self, depth=3, fanout=16):
+        self.depth = depth
+        self.fanout = fanout
+        self.num_leaves = fanout ** depth
+        self.leaves = [0] * self.num_leaves # digest of every leaf
+        self.keys = {} # leaf -> set of the keys in it, only for the non-empty leaves
+
+    def leaf(self, key):
+        return zlib.crc32(str(key).encode()) % self.num_leaves
+
+    def update(self, key, old_version, new_version):
+        """
+        Replace the version of a key, old_version is empty if the key had none.
+        """
+        leaf = self.leaf(key)
+        digest = self.leaves[leaf]
+        if old_version:
+            digest -= entry_digest(key, old_version)
+        else:
+            self.keys.setdefault(leaf, set()).add(key)
+        self.leaves[leaf] = (digest + entry_digest(key, new_version)) & MASK
+
+    def remove(self, key, version):
+        """
+        Remove a key at its version, e.g. once it expired.
+        """
+        leaf = self.leaf(key)
+        self.leaves[leaf] = (self.leaves[leaf] - entry_digest(key, version)) & MASK
+        self.keys[leaf].discard(key)
+        if not self.keys[leaf]:
+            del self.keys[leaf]
+
+    def digests(self, level, nodes):
+        """
+        The digests of the given nodes of a level.
+        """
+        span = self.fanout ** (self.depth - level) # leaves under a node of the level
+        return [sum(self.leaves[node * span:(node + 1) * span]) & MASK for node in nodes]
+
+    def root(self):
+        return self.digests(0, [0])[0]
+
+    def children(self, nodes):
+        return [node * self.fanout + child for node in nodes for child in range(self.fanout)]
+
+    def leaf_keys(self, leaves):
+        return [key for leaf in leaves for key in self.keys.get(leaf, ())]
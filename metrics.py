@@ -0,0 +1,157 @@
+import json
+import time
+import bisect
+import threading
+
+
+"""
+Low-overhead instrumentation of a server: counters, gauges and fixed-bucket histograms kept in a `Metrics` registry.
+Updating a metric is a lock-protected addition (and a bisect for a histogram), nothing is formatted or written on the
+hot path. The whole registry is read with `snapshot`, which a server returns for a "stats" request and can dump
+periodically to a file as json lines.
+"""
+
+
+# upper bounds of the buckets of the latency histograms, in milliseconds
+LATENCY_BUCKETS = [0.01, 0.02, 0.05, 0.1, 0.2, 0.5, 1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000, 5000, 10000]
+# upper bounds of the buckets of the size histograms (e.g. operations per batch)
+SIZE_BUCKETS = [1, 2, 4, 8, 16, 32, 64, 128, 256, 512, 1024, 2048, 4096]
+
+
+class Counter:
+    def __init__(self):
+        self.value = 0
+        self.lock = threading.Lock()
+
+    def inc(self, n=1):
+        with self.lock:
+            self.value += n
+
+    def read(self):
+        return self.value
+
+
+class Gauge:
+    """
+    A value that is either set by the hot path, or computed by a function when the registry is read (no hot path cost).
+    """
+    def __init__(self, function=None):
+        self.value = 0
+        self.function = function
+
+    def set(self, value):
+        self.value = value
+
+    def read(self):
+        return self.function() if self.function is not None else self.value
+
+
+class Histogram:
+    """
+    Counts of the observed values per bucket, a percentile is the upper bound of its bucket (or the max if lower).
+    """
+    def __init__(self, bounds=LATENCY_BUCKETS):
+        self.bounds = bounds
+        self.counts = [0] * (len(bounds) + 1) # the last bucket holds the values above the last bound
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+        self.lock = threading.Lock()
+
+    def observe(self, value):
+        i = bisect.bisect_left(self.bounds, value)
+        with self.lock:
+            self.counts[i] += 1
+            self.count += 1
+            self.total += value
+            if value > self.max:
+                self.max = value
+
+    def _percentile(self, counts, count, maximum, p):
+        seen = 0
+        for bound, n in zip(self.bounds, counts):
+            seen += n
+            if seen >= count * p / 100:
+                return min(bound, maximum)
+        return maximum
+
+    def read(self):
+        with self.lock:
+            counts, count, total, maximum = list(self.counts), self.count, self.total, self.max
+        if not count:
+            return {"count": 0}
+        return {"count": count,
+                "mean": total / count,
+                "p50": self._percentile(counts, count, maximum, 50),
+                "p99": self._percentile(counts, count, maximum, 99),
+                "p999": self._percentile(counts, count, maximum, 99.9),
+                "max": maximum,
+                "buckets": [[bound, n] for bound, n in zip(self.bounds + ["inf"], counts) if n]}
+
+
+class TimedLock:
+    """
+    A lock that records in a histogram how long, in milliseconds, it is held each time.
+    """
+    def __init__(self, histogram):
+        self.lock = threading.Lock()
+        self.histogram = histogram
+        self.acquired = 0.0 # only written by the holder
+
+    def __enter__(self):
+        self.lock.acquire()
+        self.acquired = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        held = time.perf_counter() - self.acquired
+        self.lock.release()
+        self.histogram.observe(1000 * held)
+
+
+class Metrics:
+    """
+    Registry of the metrics of a server, created on first use by name.
+    """
+    def __init__(self):
+        self.counters = {}
+        self.gauges = {}
+        self.histograms = {}
+        self.lock = threading.Lock()
+
+    def counter(self, name):
+        if name not in self.counters:
+            with self.lock:
+                self.counters.setdefault(name, Counter())
+        return self.counters[name]
+
+    def gauge(self, name, function=None):
+        if name not in self.gauges:
+            with self.lock:
+                self.gauges.setdefault(name, Gauge(function))
+        return self.gauges[name]
+
+    def histogram(self, name, bounds=LATENCY_BUCKETS):
+        if name not in self.histograms:
+            with self.lock:
+                self.histograms.setdefault(name, Histogram(bounds))
+        return self.histograms[name]
+
+    def snapshot(self):
+        with self.lock:
+            counters, gauges, histograms = dict(self.counters), dict(self.gauges), dict(self.histograms)
+        return {"time": time.time(),
+                "counters": {name: counter.read() for name, counter in counters.items()},
+                "gauges": {name: gauge.read() for name, gauge in gauges.items()},
+                "histograms": {name: histogram.read() for name, histogram in histograms.items()}}
+
+    def dump(self, path, interval, extra=None):
+        """
+        Append a snapshot as a json line to the file every interval seconds, forever (run it in a daemon thread).
+        """
+        while 1:
+            time.sleep(interval)
+            snapshot = self.snapshot()
+            snapshot.update(extra or {})
+            with open(path, "a") as f:
+                f.write(json.dumps(snapshot) + "\n")
@@ -0,0 +1,141 @@
+import zmq
+import time
+import heapq
+import random
+import itertools
+import threading
+
+
+"""
+Virtual network of the clusters that run inside one process (see `SimulatedCluster` in `main.py`).
+A server of such a cluster hands its broadcasts to the network instead of a PUB socket, and the network thread
+pushes a copy of every message to the inproc PULL socket of every server of the cluster, after a latency, unless it
+drops it. The fate of a message only depends on the seed, on its link (sender, receiver) and on its position among
+the messages of the link, so two runs with the same seed give the same fate to the n-th message of every link,
+whatever the scheduling of the threads: an ordering bug found with a seed can be replayed with it.
+"""
+
+
+NAMES = itertools.count() # every network has its own inproc addresses, so many clusters can live in one process
+
+
+class VirtualNetwork:
+    """
+    The settings are in milliseconds for the durations:
+    - latency: one-way delay of every message between two servers, 0 by default.
+    - jitter: a random delay in [0, jitter] added to the latency of every message, the messages of a link stay in order.
+    - reorder: probability that a message is held back reorder_delay more (5 by default) without holding back the
+      messages sent after it on its link, which overtake it. The channels are no longer FIFO.
+    - loss: probability that a message is dropped.
+    - seed: of the fates of the messages.
+    The servers and the clients of the network share its context, its own one unless one is given (several clusters
+    can share a context, e.g. for a client to reach all the groups of a sharded cluster).
+    A server receives its own broadcasts at once and in order, like through the loopback of its PUB socket.
+    Another model of the network can be plugged in by overriding `_fate`.
+    """
+    def __init__(self, latency=0, jitter=0, reorder=0, reorder_delay=5, loss=0, seed=0, context=None):
+        self.latency = latency
+        self.jitter = jitter
+        self.reorder = reorder
+        self.reorder_delay = reorder_delay
+        self.loss = loss
+        self.seed = seed
+        self.own_context = context is None
+        self.context = context or zmq.Context()
+        if self.own_context:
+            self.context.set(zmq.MAX_SOCKETS, 65536) # a few sockets per server, the default 1023 is 200 servers
+        self.name = f"network-{next(NAMES)}"
+
+        self.servers = [] # numbers of the attached servers, a broadcast is delivered to all of them
+        self.links = {} # (sender, receiver) -> (number of messages sent on the link, delivery time of its last in order message)
+        self.queue = [] # (delivery time, seq, receiver, frames) of the messages in flight
+        self.seq = itertools.count() # to keep the order of the messages delivered at the same time
+        self.ready = threading.Condition()
+        self.running = True
+        self.delivered = self.dropped = self.reordered = 0
+
+        self.thread = threading.Thread(target=self._deliver, daemon=True)
+        self.thread.start()
+
+    def address(self, port):
+        """
+        The inproc address that replaces a tcp port of a server.
+        """
+        return f"inproc://{self.name}-{port}"
+
+    def attach(self, server_number):
+        """
+        Add a server to the network, returns the address its PULL socket binds to receive the messages.
+        """
+        with self.ready:
+            self.servers.append(server_number)
+        return f"inproc://{self.name}-server-{server_number}"
+
+    def _fate(self, sender, receiver, index):
+        """
+        The delay in milliseconds of the index-th message of the link (None if it is dropped), and whether it is reordered.
+        """
+        rng = random.Random(f"{self.seed}-{sender}-{receiver}-{index}")
+        if rng.random() < self.loss:
+            return None, False
+        delay = self.latency + rng.uniform(0, self.jitter)
+        if rng.random() < self.reorder:
+            return delay + self.reorder_delay, True
+        return delay, False
+
+    def send(self, sender, frames, receiver=None):
+        """
+        Broadcast the frames of a message of a server to every server, or send them to the given receiver only,
+        from any thread.
+        """
+        frames = [bytes(frame) for frame in frames] # they are sent later, by the network thread
+        now = time.monotonic()
+        with self.ready:
+            for receiver in (self.servers if receiver is None else [receiver]):
+                count, last = self.links.get((sender, receiver), (0, 0))
+                delay, reordered = (0, False) if receiver == sender else self._fate(sender, receiver, count)
+                if delay is None:
+                    self.dropped += 1
+                    self.links[(sender, receiver)] = (count + 1, last)
+                    continue
+                delivery = now + delay / 1000
+                if reordered:
+                    self.reordered += 1
+                else:
+                    delivery = last = max(delivery, last)
+                self.links[(sender, receiver)] = (count + 1, last)
+                heapq.heappush(self.queue, (delivery, next(self.seq), receiver, frames))
+            self.ready.notify()
+
+    def _deliver(self):
+        sockets = {} # receiver -> PUSH socket to its PULL socket, only used by this thread
+        while 1:
+            with self.ready:
+                while self.running and (not self.queue or self.queue[0][0] > time.monotonic()):
+                    self.ready.wait(self.queue[0][0] - time.monotonic() if self.queue else None)
+                if not self.running:
+                    break
+                due = []
+                while self.queue and self.queue[0][0] <= time.monotonic():
+                    due.append(heapq.heappop(self.queue))
+            for delivery, seq, receiver, frames in due:
+                if receiver not in sockets:
+                    sockets[receiver] = self.context.socket(zmq.PUSH)
+                    sockets[receiver].setsockopt(zmq.SNDHWM, 0) # never block the other links on a slow server
+                    sockets[receiver].connect(f"inproc://{self.name}-server-{receiver}")
+                sockets[receiver].send_multipart(frames, copy=False)
+                self.delivered += 1
+        for socket in sockets.values():
+            socket.close(linger=0)
+
+    def stats(self):
+        return {"delivered": self.delivered, "dropped": self.dropped, "reordered": self.reordered, "in_flight": len(self.queue)}
+
+    def stop(self):
+        """
+        Stop delivering the messages, the ones in flight are lost.
+        """
+        with self.ready:
+            self.running = False
+            self.ready.notify()
+        self.thread.join()
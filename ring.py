@@ -0,0 +1,42 @@
+import bisect
+import hashlib
+
+
+"""
+Consistent hashing of the keyspace onto independent replica groups (shards). Every group runs its own consistency
+protocol, so adding a group adds capacity instead of adding broadcast and ack traffic to a single group.
+"""
+
+
+def _hash(value):
+    return int.from_bytes(hashlib.md5(str(value).encode()).digest()[:8], "big")
+
+
+class HashRing:
+    """
+    Each group is placed at `vnodes` points of a ring of 64-bit hashes, and a key belongs to the group of the first
+    point at or after the hash of the key. With enough virtual nodes the groups get similar shares of the keyspace,
+    and adding or removing a group only moves the keys of its own points.
+    """
+    def __init__(self, groups, vnodes=64):
+        self.vnodes = vnodes
+        self.points = [] # sorted (hash, group) pairs
+        self.hashes = [] # the hashes of the points, for bisect
+        for group in groups:
+            self.add(group)
+
+    def add(self, group):
+        self.points.extend((_hash(f"{group}#{i}"), group) for i in range(self.vnodes))
+        self.points.sort()
+        self.hashes = [point for point, _ in self.points]
+
+    def remove(self, group):
+        self.points = [(point, owner) for point, owner in self.points if owner != group]
+        self.hashes = [point for point, _ in self.points]
+
+    def owner(self, key):
+        """
+        The group that owns the key.
+        """
+        i = bisect.bisect_left(self.hashes, _hash(key))
+        return self.points[i % len(self.points)][1]
@@ -1,127 +1,1020 @@
+import os
 import zmq
+import zmq.utils.monitor
 import sys
 import json
 import time
+import random
+import signal
 import threading
+import itertools
 from collections import defaultdict
 import heapq
 
+from codec import CODECS, MULTI_KEY, MEMBERSHIP, EXPIRY, READS, codec_of, expand, to_json, from_json
+from durability import Durability, REMOVED
+from storage import STORAGES
+from expiry import TimingWheel, LruSample
+from index import OrderedIndex
+from metrics import Metrics, TimedLock, SIZE_BUCKETS
+from merkle import MerkleTree
+
 
 HEARTBEAT = {"ping": "pong"}
+CPU_SAMPLE_INTERVAL = 1.0 # seconds between two samples of the process CPU usage
+
+
+def topic(receiver):
+    """
+    The first frame of a message of a server that sends to a single server (see `Server.UNICAST`),
+    the PUB socket only sends a message to the servers subscribed to its topic. None is for every server.
+    """
+    return b"*" if receiver is None else f"{receiver}.".encode()
+
 
 class Server:
     """
     This class represents a server in the cluster. It is responsible for handling the requests from the clients and other servers.
     It will handle the following requests from the clients:
-    - set(key, value)
+    - set(key, value), with an optional ttl
     - get(key)
+    - mget(keys), mset(keys, values) and atomic_mset(keys, values), each answered with a single reply
+    - scan([start, end], limit), the keys in [start, end) in order and their values, a page of at most scan_page keys
+      per request, with the key the range goes on from for the next page (see `_scan`)
 
     It will handle the following message from the other servers:
     - broadcast message
     - broadcast acknoledgement
+
+    The store can be used as a cache. A set with a ttl (milliseconds) carries the deadline of its key, the time the
+    server that received it expires it at, so that every replica gives the key the same deadline, and a timing wheel
+    (see `expiry.py`) finds the keys past their deadlines every expiry_tick milliseconds without scanning the store.
+    With max_keys, the least recently used keys (approximately, see `LruSample`) are evicted once the store holds more.
+    A key is only removed by an expire or an evict operation applied like the writes, see `_write`: the levels with a
+    total order order them like the writes (see `Server_total_order._housekeep`), the other levels expire the keys
+    on every replica at their deadlines.
+
+    A server with a fourth port in port_number, its watch port, publishes the changes of its store there, in the order
+    it applies them: every applied write is a change (see `_publish`), sent on an XPUB socket with its key as the topic,
+    so a client subscribes to a key or a prefix, with the timestamp and the id of its write (its lamport timestamp, its
+    index in the log of the leader ordering, its version in causal consistency) and a resume token. The last
+    watch_buffer changes are kept in a ring, from which a "changes" request gets the changes after a token.
     """
-    def __init__(self, server_number, port_number, contacts):
+    UNICAST = False # whether the messages start with a topic frame, so that a message can be sent to a single server
+    DYNAMIC = False # whether servers can join and leave the running cluster, the join and leave requests are unsupported otherwise
+    EVICTION = False # whether the store can be bounded with max_keys, the evictions need the order of the writes
+
+    def __init__(self, server_number, port_number, contacts, config=None, network=None):
         """
         The server need to initialize the key-value store and the sockets for sending and receiving messages.
         The contacts contains port numbers of the other servers in the cluster.
+        The network is None for a server process listening on tcp ports, or the `VirtualNetwork` (see `network.py`)
+        of a cluster running inside one process: the ports are then only names of inproc sockets, and the messages
+        to the other servers go through the network instead of a PUB socket.
+        The config contains the optional settings of the server (see `server_config` in the test configuration file):
+        - api_mode: "rep" (default) serves one client request at a time,
+          "router" serves many clients and many in-flight requests per client, replies can be sent out of order.
+        - codec: "json" (default) or "binary", the wire format of the messages this server sends to the other servers.
+          The received messages are decoded with the codec they were sent with, and the clients are answered with their own codec.
+        - data_dir: if given, the applied writes are logged and the store is snapshotted under data_dir/server-<number>,
+          and a restarted server recovers its store, the deadlines of its keys and its lamport clock from there
+          (see `durability.py`).
+        - fsync: "op", "batch" (default) or "interval", when the log is fsynced.
+        - fsync_interval: milliseconds between two fsyncs with the "interval" policy, 10 by default.
+        - snapshot_every: number of logged writes between two snapshots, 100000 by default.
+        - storage: "dict" (default) or "arena", the storage engine of the key-value store (see `storage.py`).
+        - stats_file: if given, a snapshot of the metrics (see `metrics.py`) is appended to it as a json line
+          every stats_interval seconds (10 by default), "{server}" in the path is replaced by the server number.
+        - log: "print" (default) prints every operation, "sampled" prints a json line for a log_sample share
+          of the operations (0.01 by default), "off" prints nothing.
+        - ordering: "lamport" (default) or "leader", the total order of linearizability and sequential consistency,
+          see `Server_total_order` and `Server_leader`.
+        - join: with the leader ordering, the server is not a member of the running cluster of contacts yet and asks
+          it to join (see `Server_leader`), contacts then holds the members and the server itself.
+        - expiry_tick: milliseconds between two looks for the keys past their deadlines, 100 by default.
+        - max_keys: 0 (default) for no limit, or the number of keys above which the least recently used keys are evicted,
+          only with linearizability and sequential consistency.
+        - eviction_samples: keys sampled per eviction, 5 by default, the more the closer to an exact LRU.
+        - scan_page: largest number of keys in the reply to a scan, 1000 by default.
+        - watch_buffer: number of the last changes kept for the "changes" requests, 100000 by default.
+        - watch_hwm: changes queued for a subscriber of the watch port before the next ones are dropped for it, 1000 by default.
         """
-        # self.kv_store = defaultdict(int)
-        self.kv_store = {"a": 0, "b": 0}
-        self.kv_store_lock = threading.Lock()
-
         self.server_number = int(server_number)
-        self.recv_port, self.send_port, self.api_port = port_number
+        self.recv_port, self.send_port, self.api_port = port_number[:3]
+        self.watch_port = port_number[3] if len(port_number) > 3 else None
 
         self.contacts = contacts
+        self.config = config or {}
+        self.network = network
+
+        self.metrics = Metrics()
+        self.log_mode = self.config.get("log", "print")
+        if self.log_mode not in ["print", "sampled", "off"]:
+            raise ValueError("The log mode must be one of the following: print, sampled, off.")
+        self.log_sample = self.config.get("log_sample", 0.01)
 
-        self.context = zmq.Context()
+        storage = self.config.get("storage", "dict")
+        if storage not in STORAGES:
+            raise ValueError("The storage must be one of the following: dict, arena.")
+        self.kv_store = STORAGES[storage]() # a missing key reads as None
+        self.kv_store.put("a", 0)
+        self.kv_store.put("b", 0)
+        self.kv_store_lock = TimedLock(self.metrics.histogram("kv_store_lock_hold_ms"))
+        # the deadlines and the wheel follow the store, so they are guarded by kv_store_lock too
+        self.deadlines = {} # key -> deadline of its ttl, in milliseconds since the epoch
+        self.expiry_tick = self.config.get("expiry_tick", 100)
+        self.wheel = TimingWheel(self.expiry_tick, now=int(1000 * time.time()))
+        self.next_housekeeping = 0 # time of the next look for the keys to expire or evict, only used by the client handler
+        self.max_keys = self.config.get("max_keys", 0)
+        if self.max_keys and not self.EVICTION:
+            raise ValueError("The max_keys setting needs the total order of linearizability or sequential consistency.")
+        self.lru = LruSample(self.config.get("eviction_samples", 5)) if self.max_keys else None
+        self.index = OrderedIndex() # the keys in order for the scans, it follows the store and is guarded by kv_store_lock
+        self.scan_page = self.config.get("scan_page", 1000)
+        self.api_mode = self.config.get("api_mode", "rep")
+        if self.api_mode not in ["rep", "router"]:
+            raise ValueError("The api mode must be one of the following: rep, router.")
+        self.codec = CODECS[self.config.get("codec", "json")]
 
-        self.send_socket = self.context.socket(zmq.PUB) # to send messages to the other servers
-        self.send_socket.bind(f"tcp://*:{self.send_port}")
+        self.durability = None
+        self.recovered_clock = 0 # lamport clock to restart from, 0 unless recovered from the data directory
+        if "data_dir" in self.config:
+            self.durability = Durability(os.path.join(self.config["data_dir"], f"server-{self.server_number}"),
+                                         fsync=self.config.get("fsync", "batch"),
+                                         fsync_interval=self.config.get("fsync_interval", 10),
+                                         snapshot_every=self.config.get("snapshot_every", 100000),
+                                         state=self._state)
+            recovered, self.recovered_clock = self.durability.recover(self.kv_store, self._restore)
+            if recovered and self.log_mode != "off":
+                print(f"Server {self.server_number} recovered {self.kv_store.size()} keys at the clock {self.recovered_clock}")
+        for key, deadline in self.deadlines.items():
+            self.wheel.schedule(key, deadline)
+        for key, value in self.kv_store.iterate():
+            self.index.add(key)
+            if self.lru is not None:
+                self.lru.touch(key)
+
+        # the servers of an in-process cluster share the context of their network, inproc sockets need it
+        self.context = zmq.Context() if self.network is None else self.network.context
+
+        if self.network is None:
+            self.send_socket = self.context.socket(zmq.PUB) # to send messages to the other servers
+            self.send_socket.bind(self._bind_address(self.send_port))
         # threading.Thread(target=self._daemon).start()
 
-        self.api_socket = self.context.socket(zmq.REP) # to communicate with the clients
-        self.api_socket.bind(f"tcp://*:{self.api_port}")
-        print(f"Server {self.server_number} is ready to receive the requests from the clients")
+        # to communicate with the clients
+        self.api_socket = self.context.socket(zmq.ROUTER if self.api_mode == "router" else zmq.REP)
+        self.api_socket.bind(self._bind_address(self.api_port))
+        if self.log_mode != "off":
+            print(f"Server {self.server_number} is ready to receive the requests from the clients")
+
+        # zmq sockets are not thread safe, so the replies produced by other threads (e.g. the queue handler)
+        # are pushed through an inproc pipe and sent by the client handler thread that owns the api socket
+        self.reply_socket = self.context.socket(zmq.PULL)
+        self.reply_socket.bind(f"inproc://replies-{id(self)}") # unique even with many servers in one process
+        self.reply_push_socket = self.context.socket(zmq.PUSH)
+        self.reply_push_socket.connect(f"inproc://replies-{id(self)}")
+        self.reply_push_lock = threading.Lock()
 
-        self.recv_socket = self.context.socket(zmq.SUB) # to receive messages from the other servers
-        for contact in self.contacts:
-            recv_port = self.contacts[contact][1]
-            self.recv_socket.connect(f"tcp://localhost:{recv_port}")
-            print(f"Server {self.server_number} is connected to the server {contact}")
-        self.recv_socket.setsockopt_string(zmq.SUBSCRIBE, '')
+        self.watch_thread = None
+        if self.watch_port is not None:
+            self.stream = f"{self.server_number}-{random.getrandbits(32):08x}" # the tokens of another run of the server are lost
+            self.changes = [None] * self.config.get("watch_buffer", 100000) # (seq, timestamp, id, key, value), at seq % size
+            self.change_seq = 0 # of the last change
+            self.watching = True
+            self.watch_lock = threading.Lock() # guards the ring and change_seq
+            self.watch_ready = threading.Condition(self.watch_lock)
+            # an XPUB socket tells the subscriptions, the publisher counts the changes of each subscribed prefix
+            self.watch_socket = self.context.socket(zmq.XPUB)
+            self.watch_socket.setsockopt(zmq.SNDHWM, self.config.get("watch_hwm", 1000))
+            self.watch_socket.bind(self._bind_address(self.watch_port))
+            self.watch_thread = self._start_thread(self._watch_publisher)
 
+        if self.network is None:
+            self.recv_socket = self.context.socket(zmq.SUB) # to receive messages from the other servers
+            # the servers we are subscribed to, so that a "ping" request tells whether the cluster is ready
+            self.connected = set()
+            self.monitor_socket = self.recv_socket.get_monitor_socket(zmq.EVENT_HANDSHAKE_SUCCEEDED | zmq.EVENT_DISCONNECTED)
+            self.monitor_thread = threading.Thread(target=self._peer_monitor, daemon=True)
+            self.monitor_thread.start()
+            for contact in self.contacts:
+                recv_port = self.contacts[contact][1]
+                self.recv_socket.connect(self._connect_address(recv_port))
+                if self.log_mode != "off":
+                    print(f"Server {self.server_number} is connected to the server {contact}")
+            if self.UNICAST:
+                self.recv_socket.setsockopt(zmq.SUBSCRIBE, topic(None))
+                self.recv_socket.setsockopt(zmq.SUBSCRIBE, topic(self.server_number))
+            else:
+                self.recv_socket.setsockopt_string(zmq.SUBSCRIBE, '')
+        else:
+            # the network pushes the messages of every server, ours included, to our PULL socket
+            self.recv_socket = self.context.socket(zmq.PULL)
+            self.recv_socket.bind(self.network.attach(self.server_number))
+            self.connected = set(self.contacts)
+
+        # the recv socket is not polled: it is read by the server handler thread,
+        # and polling it here would wake up the client handler for every broadcast message
         self.poller = zmq.Poller()
-        self.poller.register(self.recv_socket, zmq.POLLIN)
         self.poller.register(self.api_socket, zmq.POLLIN)
+        self.poller.register(self.reply_socket, zmq.POLLIN)
         # self.poller.register(self.send_socket, zmq.POLLOUT)
 
-class Server_linearizability(Server):
+        self.cpu_usage = 0.0 # percentage of one core used by this process over the last sample window
+        self.cpu_thread = threading.Thread(target=self._cpu_monitor, daemon=True)
+        self.cpu_thread.start()
+
+        self.metrics.gauge("cpu_usage", lambda: round(self.cpu_usage, 1))
+        self.metrics.gauge("connected_servers", lambda: len(self.connected)) # fan-out of our broadcasts
+        self.metrics.gauge("keys", self.kv_store.size)
+        self.metrics.gauge("keys_with_ttl", lambda: len(self.deadlines))
+        if "stats_file" in self.config:
+            stats_file = self.config["stats_file"].replace("{server}", str(self.server_number))
+            self.stats_thread = threading.Thread(target=self.metrics.dump,
+                                                 args=(stats_file, self.config.get("stats_interval", 10), {"server": self.server_number}),
+                                                 daemon=True)
+            self.stats_thread.start()
+
+    def _start_thread(self, target):
+        """
+        Start a daemon thread that ends quietly when the context of the server is terminated (see `close`).
+        """
+        def run():
+            try:
+                target()
+            except zmq.ZMQError as error: # also raised as a plain ZMQError, e.g. by a new socket
+                if error.errno != zmq.ETERM:
+                    raise
+        thread = threading.Thread(target=run, daemon=True)
+        thread.start()
+        return thread
+
+    def close(self):
+        """
+        Close the sockets of a server of an in-process cluster while its context is terminated: the threads blocked on
+        the sockets end on the termination, and the sockets can then be closed from here, which lets it complete.
+        """
+        for thread in [self.api_thread, self.recv_thread]:
+            thread.join()
+        with self.reply_push_lock:
+            self.reply_push_socket.close(linger=0)
+        for socket in [self.api_socket, self.reply_socket, self.recv_socket]:
+            socket.close(linger=0)
+        if self.watch_thread is not None: # it waits for the changes, not on a socket
+            with self.watch_ready:
+                self.watching = False
+                self.watch_ready.notify()
+            self.watch_thread.join()
+            self.watch_socket.close(linger=0)
+        if self.durability is not None: # a write applied meanwhile is no longer logged
+            self.durability.close()
+
+    def _bind_address(self, port):
+        return f"tcp://*:{port}" if self.network is None else self.network.address(port)
+
+    def _connect_address(self, port):
+        return f"tcp://localhost:{port}" if self.network is None else self.network.address(port)
+
+    def _cpu_monitor(self):
+        """
+        Measure the CPU time used by the whole server process over each sample window,
+        so we can check that an idle server sits near 0% instead of spinning.
+        """
+        last_cpu, last_wall = time.process_time(), time.monotonic()
+        while 1:
+            time.sleep(CPU_SAMPLE_INTERVAL)
+            cpu, wall = time.process_time(), time.monotonic()
+            self.cpu_usage = 100 * (cpu - last_cpu) / (wall - last_wall)
+            last_cpu, last_wall = cpu, wall
+
+    def _peer_monitor(self):
+        """
+        Track the connections of the SUB socket: a server is connected once the handshake with its PUB socket is done,
+        after which our subscription reaches it and none of its broadcasts is dropped.
+        """
+        while 1:
+            event = zmq.utils.monitor.recv_monitor_message(self.monitor_socket)
+            if event["event"] == zmq.EVENT_HANDSHAKE_SUCCEEDED:
+                self.connected.add(event["endpoint"])
+            else:
+                self.connected.discard(event["endpoint"])
+
+    def _recv_request(self):
+        """
+        Receive one request from the api socket. It returns the client handle that `_reply` needs to answer it, and the request.
+        The handle is (identity, request_id, codec, received): the identity is None in "rep" mode since there is only one outstanding request,
+        the request_id is None for plain REQ clients, and received is the time the request was received at.
+        """
+        frames = self.api_socket.recv_multipart(copy=False)
+        identity = None
+        if self.api_mode == "router":
+            identity, frames = frames[0].bytes, frames[2:]
+        codec = codec_of(frames)
+        message = codec.decode_request(frames)
+        return (identity, message.get("request_id"), codec, time.perf_counter()), message
+
+    def _send_reply(self, client, response): # must be called by the client handler thread
+        identity, request_id, codec, received = client
+        frames = codec.encode_response(response, request_id)
+        if identity is not None:
+            frames = [identity, b""] + frames
+        self.api_socket.send_multipart(frames, copy=False)
+        self.metrics.histogram("reply_ms").observe(1000 * (time.perf_counter() - received))
+
+    def _reply(self, client, response):
+        """
+        Answer the request of the given client, from any thread.
+        The response is a dict {"type": ..., "key": ..., "value": ...}, see `codec.py`.
+        """
+        if threading.current_thread() is self.api_thread:
+            self._send_reply(client, response)
+            return
+        with self.reply_push_lock:
+            if not self.reply_push_socket.closed: # the server is closed, nobody would send the reply
+                self.reply_push_socket.send_pyobj((client, response))
+
+    def _client_handler(self):
+        """
+        This method is responsible for handling the requests from the clients.
+        """
+        self.api_thread = threading.current_thread() # before the first reply, _start_thread may not have returned yet
+        while 1:
+            socks = dict(self.poller.poll(self._poll_timeout()))
+            if self.reply_socket in socks:
+                while self.reply_socket.poll(0):
+                    reply = self.reply_socket.recv_pyobj()
+                    if reply is not None: # None only wakes us up, see _wake
+                        self._send_reply(*reply)
+            # handle every request that is already waiting, so that they can be batched together
+            while self.api_socket.poll(0):
+                client, message = self._recv_request()
+                # print(f"Server {self.server_number} received message: {message}")
+                self.metrics.counter(f"requests.{message['type']}").inc()
+                if message["type"] == "cpu":
+                    self._reply(client, {"type": "cpu", "key": None, "value": round(self.cpu_usage, 1)})
+                elif message["type"] == "ping": # readiness probe, answers the number of servers we are connected to
+                    self._reply(client, {"type": "ping", "key": None, "value": len(self.connected)})
+                elif message["type"] == "stats":
+                    self._reply(client, {"type": "stats", "key": None, "value": json.dumps(self.metrics.snapshot())})
+                elif self._invalid(message) is not None: # it would fail once ordered, on every replica
+                    self._reply(client, {"type": "error", "key": message["key"], "value": self._invalid(message)})
+                elif message["type"] in MULTI_KEY and not message["key"]: # no operation would carry its reply
+                    self._reply(client, {"type": message["type"], "key": [], "value": [] if message["type"] == "mget" else None})
+                elif message["type"] == "changes" and self.watch_port is not None:
+                    self._reply(client, self._changes(message["key"], message["value"]))
+                elif (message["type"] in EXPIRY # the expiries come from the servers
+                      or message["type"] == "changes" # no watch port
+                      or (message["type"] in MEMBERSHIP and not self.DYNAMIC)):
+                    self._reply(client, {"type": message["type"], "key": message["key"], "value": "unsupported"})
+                else:
+                    self._handle_request(client, message)
+            self._after_poll()
+
+    def _handle_request(self, client, message):
+        raise NotImplementedError
+
+    def _invalid(self, message):
+        """
+        Why the arguments of a request cannot be served, None if they can: they are checked when the request arrives,
+        since an operation that fails to apply would end the thread that applies it.
+        """
+        if message["type"] == "scan":
+            bounds, limit = message["key"], message["value"]
+            if (not isinstance(bounds, list) or len(bounds) != 2
+                    or any(bound is not None and not isinstance(bound, str) for bound in bounds)):
+                return "The bounds of a scan must be a list [start, end] of strings or nulls."
+            if limit is not None and (type(limit) is not int or limit < 1):
+                return "The limit of a scan must be a positive integer."
+        if message["type"] == "set" and message.get("ttl") is not None:
+            if type(message["ttl"]) is not int or message["ttl"] < 0:
+                return "The ttl of a set must be a non-negative integer of milliseconds."
+        return None
+
+    def _persist(self, timestamp, id, writes, state=None):
+        """
+        Log the writes [(key, value), ...] of a batch, if the server is durable, the value of a removed key is REMOVED,
+        with the changes of the state they make (see `_restore`), e.g. {"deadlines": [[key, deadline], ...]}.
+        It must be called with kv_store_lock held, in the same hold as the writes are applied, and before the state
+        changes, so that a snapshot never misses a logged write. Every applied write goes through here, so the writes
+        are also published to the watchers from here.
+        """
+        if self.durability is not None and (writes or state):
+            self.durability.append(timestamp, id, writes, self.kv_store, state)
+        if self.watch_port is not None and writes:
+            self._publish(timestamp, id, writes)
+
+    def _state(self): # must be called with kv_store_lock held
+        """
+        The state of the server beside its store saved with a snapshot: the deadlines of the keys.
+        """
+        return {"deadlines": list(self.deadlines.items())}
+
+    def _restore(self, timestamp, id, writes, state):
+        """
+        Rebuild the state beside the store from a snapshot (no writes) or a logged record (see `Durability.recover`):
+        a set or a removal ends the ttl of its key, then the deadlines of the state are set.
+        """
+        for key, value in writes:
+            self.deadlines.pop(key, None)
+        self.deadlines.update((key, deadline) for key, deadline in (state or {}).get("deadlines", []))
+
+    def _publish(self, timestamp, id, writes): # must be called with kv_store_lock held, so the changes are in the order of the writes
+        """
+        Add the writes to the ring of the changes, for the publisher (see `_watch_publisher`): it never waits for the
+        subscribers, so a slow one never holds up the writes.
+        """
+        with self.watch_ready:
+            for key, value in writes:
+                self.change_seq += 1
+                self.changes[self.change_seq % len(self.changes)] = (self.change_seq, timestamp, id, key,
+                                                                     None if value is REMOVED else value)
+            self.watch_ready.notify()
+
+    def _watch_publisher(self):
+        """
+        Publish the changes on the watch port, one message per change: the key as the topic, then the message
+        {"timestamp", "id", "operations": [["set", key, value]], "token", "counts"} in the codec of the server.
+        counts has [prefix, count] for every subscribed prefix of the key, the number of changes of the prefix published
+        since it was subscribed, so that a subscriber finds out that a change was dropped on its way (the PUB socket
+        drops the changes for a subscriber that has watch_hwm changes queued) and gets it with a "changes" request.
+        If the ring goes round before the publisher reads some changes, every count skips one.
+        """
+        published = 0 # seq of the last change published
+        subscriptions = {} # prefix -> count
+        size = len(self.changes)
+        while 1:
+            with self.watch_ready:
+                self.watch_ready.wait_for(lambda: self.change_seq > published or not self.watching)
+                if not self.watching:
+                    return
+                first = max(published + 1, self.change_seq - size + 1)
+                changes = [self.changes[seq % size] for seq in range(first, self.change_seq + 1)]
+            while self.watch_socket.poll(0): # (un)subscriptions, the last unsubscription of a prefix only
+                event = self.watch_socket.recv()
+                if event[:1] == b"\x01":
+                    subscriptions.setdefault(event[1:], 0)
+                elif event[:1] == b"\x00":
+                    subscriptions.pop(event[1:], None)
+            if first > published + 1:
+                for prefix in subscriptions:
+                    subscriptions[prefix] += 1
+            published = changes[-1][0]
+            for seq, timestamp, id, key, value in changes:
+                topic = str(key).encode()
+                counts = []
+                for prefix in subscriptions:
+                    if topic.startswith(prefix):
+                        subscriptions[prefix] += 1
+                        counts.append([prefix.decode(errors="replace"), subscriptions[prefix]])
+                if not counts: # nobody subscribed to it
+                    continue
+                message = {"timestamp": timestamp, "id": id, "ack": 0, "operations": [("set", key, value)],
+                           "token": f"{self.stream}:{seq}", "counts": counts}
+                self.watch_socket.send_multipart([topic] + self.codec.encode_message(message), copy=False)
+                self.metrics.counter("changes_published").inc()
+
+    def _changes(self, prefix, token):
+        """
+        The response to a changes request: the changes of the keys that start with prefix after the token, at most
+        scan_page of them, in the order they were applied, like a scan page with "changes": [[seq, timestamp, id], ...]
+        the position of each change, "next": the token to go on from and "more": whether there are more changes.
+        Without a token, or with a token whose next changes are no longer in the ring ("lost"), there is no change and
+        next is the token of the current position: the client reads the keys again, then goes on from there.
+        A token that is not one of ours, e.g. malformed, is lost too.
+        """
+        prefix = "" if prefix is None else str(prefix) # like the topics of the changes
+        try:
+            stream, _, seq = token.rpartition(":")
+            seq = int(seq)
+        except (AttributeError, ValueError): # None or not a token
+            stream, seq = None, -1
+        size = len(self.changes)
+        keys, values, changes = [], [], []
+        with self.watch_lock:
+            last = self.change_seq
+        lost = token is not None and (stream != self.stream or not max(last - size, 0) <= seq <= last)
+        seq = last if token is None or lost else seq
+        while seq < last and len(keys) < self.scan_page:
+            with self.watch_lock: # a chunk at a time, the writes wait for the lock
+                if seq < self.change_seq - size: # the ring went round meanwhile
+                    return self._changes(None, None) | {"lost": True}
+                chunk = [self.changes[i % size] for i in range(seq + 1, min(seq + 1000, last) + 1)]
+            for seq, timestamp, id, key, value in chunk:
+                if str(key).startswith(prefix):
+                    keys.append(key)
+                    values.append(value)
+                    changes.append([seq, timestamp, id])
+                    if len(keys) == self.scan_page:
+                        break
+        return {"type": "changes", "key": keys, "value": values, "changes": changes, "next": f"{self.stream}:{seq}",
+                "more": seq < last, "lost": lost}
+
+    def _operations(self, message):
+        """
+        The operations of a request (see `expand`), where the ttl of a set is replaced by its deadline.
+        """
+        if message.get("ttl") is None:
+            return expand(message)
+        now = int(1000 * time.time())
+        return [(operation, key, now + value if operation == "ttl" else value) for operation, key, value in expand(message)]
+
+    def _logged(self, operations): # must be called with kv_store_lock held
+        """
+        The writes [(key, value), ...] and the state to log (see `_persist`) for the operations of a batch, computed
+        before `_write` applies them so that they are logged first: the set keys, the keys that an expire or an evict
+        removes, and the deadlines of the keys that have one after the batch.
+        Whether an expire removes its key depends on the deadline of the key after the operations before it.
+        """
+        writes = []
+        deadlines = {} # key -> its deadline after the operations so far, None if it has none
+        for operation, key, value in operations:
+            if operation == "set":
+                writes.append((key, value))
+                deadlines[key] = None
+            elif operation == "ttl":
+                deadlines[key] = value
+            elif operation == "evict" or (operation == "expire" and deadlines.get(key, self.deadlines.get(key)) == value):
+                writes.append((key, REMOVED))
+                deadlines[key] = None
+        deadlines = [[key, deadline] for key, deadline in deadlines.items() if deadline is not None]
+        return writes, {"deadlines": deadlines} if deadlines else None
+
+    def _write(self, operation, key, value): # must be called with kv_store_lock held
+        """
+        Apply a write to the store: a set, the ttl that follows the set of a key with a ttl, the expiry of a key at
+        a deadline, which only removes it if the deadline is still its own (it was not set again since), or the eviction
+        of a key. The writes are logged before, see `_logged`.
+        """
+        if operation == "set":
+            if self.kv_store.get(key) is None: # a new key, the index is only looked up for them
+                self.index.add(key)
+            self.kv_store.put(key, value)
+            if key in self.deadlines: # a set without a ttl keeps the key, its ttl follows it otherwise
+                del self.deadlines[key]
+                self.wheel.cancel(key)
+            if self.lru is not None:
+                self.lru.touch(key)
+            return
+        if operation == "ttl":
+            first = not self.deadlines
+            self.deadlines[key] = value
+            self.wheel.schedule(key, value)
+            if first: # the client handler may be waiting without a timeout, it must see the deadline once woken up
+                self._wake()
+            return
+        if operation == "expire" and self.deadlines.get(key) != value:
+            return
+        self._remove(key)
+        self.metrics.counter("expired_keys" if operation == "expire" else "evicted_keys").inc()
+
+    def _wake(self):
+        """
+        Wake the client handler up from its poll, from any thread, so that it computes its timeout again.
+        """
+        with self.reply_push_lock:
+            if not self.reply_push_socket.closed:
+                self.reply_push_socket.send_pyobj(None)
+
+    def _remove(self, key): # must be called with kv_store_lock held
+        self.kv_store.delete(key)
+        self.index.discard(key)
+        if self.deadlines.pop(key, None) is not None:
+            self.wheel.cancel(key)
+        if self.lru is not None:
+            self.lru.discard(key)
+
+    def _touch(self, keys, values):
+        """
+        Tell the LRU that the keys were read, the missing ones (value None) are not in it.
+        """
+        if self.lru is not None:
+            for key, value in zip(keys, values):
+                if value is not None:
+                    self.lru.touch(key)
+
+    def _scan(self, bounds, limit): # must be called with kv_store_lock held
+        """
+        The response to a scan: the keys of the index in [start, end) (bounds, None for an open bound) in order and
+        their values, at most limit and at most scan_page of them, and the first key of the range after them, None if
+        there is none, from which the client asks for the next page. A scan does not count as an access for the LRU,
+        so that scanning the store does not make all its keys recent.
+        """
+        start, end = bounds
+        limit = self.scan_page if limit is None else min(limit, self.scan_page)
+        keys = list(itertools.islice(self.index.range(start, end), limit + 1))
+        next = keys.pop() if len(keys) > limit else None
+        return {"type": "scan", "key": keys, "value": [self.kv_store.get(key) for key in keys], "next": next}
+
+    def _local_read(self, client, message):
+        """
+        Answer a get, an mget or a scan from the local store, the keys of an mget or a page of a scan are read together
+        under the store lock, so that they never show a part of a multi-key write.
+        """
+        if message["type"] == "scan":
+            with self.kv_store_lock:
+                response = self._scan(message["key"], message["value"])
+            self._reply(client, response)
+            self._log_operation("scan", response["key"], response["value"])
+        elif message["type"] == "mget":
+            with self.kv_store_lock:
+                values = [self.kv_store.get(key) for key in message["key"]]
+            self._touch(message["key"], values)
+            self._reply(client, {"type": "mget", "key": message["key"], "value": values})
+            self._log_operation("mget", message["key"], values)
+        else:
+            value = self.kv_store.get(message["key"])
+            self._touch([message["key"]], [value])
+            self._reply(client, {"type": "get", "key": message["key"], "value": value})
+            self._log_operation("get", message["key"], value)
+
+    def _log_operation(self, operation, key, value):
+        """
+        Log an operation answered to a client, according to the log mode.
+        """
+        if self.log_mode == "print":
+            if operation in ["set", "mset", "atomic_mset"]:
+                print(f"Server {self.server_number} set the value of the key {key} to {value}")
+            else:
+                print(f"Server {self.server_number} got the value of the key {key} as {value}")
+        elif self.log_mode == "sampled" and random.random() < self.log_sample:
+            print(json.dumps({"time": time.time(), "server": self.server_number,
+                              "operation": operation, "key": key, "value": value}, default=str))
+
+    def _send_message(self, message, receiver=None): # the caller must own the send socket
+        """
+        Send a message to every server (ourselves included), or only to the receiver if the server is UNICAST.
+        """
+        frames = self.codec.encode_message(message)
+        if self.network is not None:
+            self.network.send(self.server_number, frames, receiver)
+        elif self.UNICAST:
+            self.send_socket.send_multipart([topic(receiver)] + frames, copy=False)
+        else:
+            self.send_socket.send_multipart(frames, copy=False)
+        self.metrics.counter("messages_sent").inc()
+
+    def _recv_message(self):
+        frames = self.recv_socket.recv_multipart(copy=False)
+        if self.UNICAST and self.network is None:
+            frames = frames[1:]
+        self.metrics.counter("messages_received").inc()
+        return codec_of(frames).decode_message(frames)
+
+    def _housekeeping_due(self):
+        return bool(self.deadlines) or (self.max_keys and self.kv_store.size() > self.max_keys)
+
+    def _poll_timeout(self): # in milliseconds, None to wait until a socket is ready
+        if not self.deadlines and not self.max_keys: # the first deadline wakes us up
+            return None
+        return max(0, 1000 * (self.next_housekeeping - time.monotonic()))
+
+    def _after_poll(self): # called by the client handler after each poll
+        if self._housekeeping_due() and time.monotonic() >= self.next_housekeeping:
+            self.next_housekeeping = time.monotonic() + self.expiry_tick / 1000
+            self._housekeep()
+
+    def _housekeep(self):
+        """
+        Expire the keys past their deadlines, and evict the keys over max_keys, every expiry_tick milliseconds.
+        """
+        raise NotImplementedError
+
+
+class Server_total_order(Server):
     """
-    This class represents a server in the cluster with linearizability consistency level.
+    This class holds the totally ordered broadcast shared by the linearizability and sequential consistency levels.
+    Messages are kept in a heap sorted by (timestamp, id). Every server sends its messages with increasing timestamps,
+    and the channels are FIFO, so once we have heard a timestamp >= t from every server, no message ordered before
+    a head with timestamp t can still arrive and the head is delivered. Acks are therefore cumulative: any message
+    acknowledges everything its sender received before, and a server only sends a separate ack when it has received
+    broadcasts that none of its own messages acknowledged yet.
+    The queue handler sleeps on a condition variable and is only woken up by an enqueue or an ack that may make the head deliverable,
+    so an idle server does not burn CPU. Subclasses decide what delivering a message means by implementing `_deliver`.
+
+    A read can also be given a position in the total order without being broadcasted (see `_ordered_read`):
+    it waits in its own heap and is answered by the queue handler between the messages ordered before and after it.
     """
-    def __init__(self, server_number, port_number, contacts):
-        super().__init__(server_number, port_number, contacts)
+    EVICTION = True
+    HOUSEKEEPING_RETRY = 1 # seconds after which an expiry or an eviction that was not applied is submitted again
+    HOUSEKEEPING_LIMIT = 10000 # expire and evict operations submitted per expiry tick at most
+
+    def __init__(self, server_number, port_number, contacts, config=None, network=None):
+        super().__init__(server_number, port_number, contacts, config, network)
 
-        self.lamport_clock = 0
+        self.lamport_clock = self.recovered_clock
         self.lamport_clock_lock = threading.Lock()
 
         self.queue = [] # to store the requests
         heapq.heapify(self.queue) # to sort the requests based on the timestamp
         self.queue_lock = threading.Lock()
+        self.queue_ready = threading.Condition(self.queue_lock) # notified when the head of the queue may have become deliverable
+
+        # highest timestamp heard from each server, guarded by queue_lock
+        self.watermarks = {int(contact): 0 for contact in self.contacts}
+        self.last_received = 0 # highest timestamp of a broadcast received from another server, only used by the server handler
+        self.last_sent = 0 # timestamp of our last message, guarded by send_lock
+        self.last_sync = 0 # timestamp of our last message that the other servers acknowledge (broadcast or sync), guarded by send_lock
+
+        self.reads = [] # (timestamp, id, seq, client, request) of the ordered reads, guarded by queue_lock
+        self.read_seq = itertools.count() # to break the ties between reads with the same timestamp
+        self.highest_read = 0 # timestamp of the latest ordered read, only used by the client handler
+
+        self.pending = {} # timestamp of our own broadcast -> (clients waiting for its delivery, time it was sent)
+
+        # group commit: client operations are collected into one batch, broadcasted with a single timestamp
+        # once it holds batch_size operations or once the first operation has waited batch_window milliseconds
+        self.batch_size = self.config.get("batch_size", 1)
+        self.batch_window = self.config.get("batch_window", 0)
+        self.batch = [] # (operation, key, value) of the batch being collected, only used by the client handler
+        self.batch_clients = [] # (client, request type, number of operations) of the requests of the batch, in order
+        self.batch_started = 0
+        self.evicting = {} # key -> time of its evict operation until it is applied, only used by the client handler
 
-        self.acks = defaultdict(int) # to store number of the acknowledgements 
-        self.acks_lock = threading.Lock()
+        self.send_lock = TimedLock(self.metrics.histogram("send_lock_hold_ms")) # the PUB socket is shared by the client handler and the server handler
 
-        self.total_servers = len(self.contacts)
+        self.metrics.gauge("lamport_clock", lambda: self.lamport_clock)
+        # how far the slowest server is behind our clock, the head of the queue waits for it
+        self.metrics.gauge("clock_drift", lambda: self.lamport_clock - min(self.watermarks.values()))
+        self.metrics.gauge("queue_depth", lambda: len(self.queue))
+        self.metrics.gauge("pending_reads", lambda: len(self.reads))
+        self.metrics.gauge("pending_batches", lambda: len(self.pending))
 
-        self.api_thread = threading.Thread(target=self._client_handler)
-        self.api_thread.start()
+        self.api_thread = self._start_thread(self._client_handler)
 
-        self.recv_thread = threading.Thread(target=self._server_handler)
-        self.recv_thread.start()
+        self.recv_thread = self._start_thread(self._server_handler)
 
-        self.queue_thread = threading.Thread(target=self._queue_handler)
-        self.queue_thread.start()
+        self.queue_thread = self._start_thread(self._queue_handler)
 
 
     def _update_clock(self, timestamp=0): # if no timestamp is given, then it is a local event, just increment the clock
         with self.lamport_clock_lock:
             self.lamport_clock = max(self.lamport_clock, timestamp) + 1
+            return self.lamport_clock
 
-    def _broadcast(self, message):
-        # for contact in self.contacts:
-        #     recv_port = self.contacts[contact][0]
-        #     self.send_socket.connect(f"tcp://localhost:{recv_port}")
-        #     # print(f"Server {self.server_number} is connected to the server {contact}")
-        #     self.send_socket.send_json(message)
-        #     # print(f"Server {self.server_number} sent message to server {contact}: {message}")
-        #     self.send_socket.disconnect(f"tcp://localhost:{recv_port}")
+    def _broadcast(self, message, clients=None):
+        """
+        Stamp the message with the lamport clock and send it. The timestamp is taken under the send lock,
+        so that the messages leave in the order of their timestamps, which the cumulative acks rely on.
+        If clients is given, they wait for the delivery of the message.
+        """
+        with self.send_lock:
+            timestamp = self._update_clock()
+            message["timestamp"] = timestamp
+            if clients is not None:
+                self.pending[timestamp] = (clients, time.perf_counter()) # our own timestamps are unique, so they identify the batch
+            self._send_message(message)
+            self.last_sent = timestamp
+            if message["ack"] == 0 or message.get("sync"):
+                self.last_sync = timestamp
+
+    def _broadcast_request(self, client, message):
+        """
+        Add a client request to the current batch, the client is answered when the batch is delivered.
+        A multi-key request adds one operation per key, so it is delivered at a single position of the total order.
+        """
+        self._add_to_batch(client, message["type"], self._operations(message))
+
+    def _add_to_batch(self, client, request_type, operations):
+        if not self.batch:
+            self.batch_started = time.monotonic()
+        self.batch.extend(operations)
+        self.batch_clients.append((client, request_type, len(operations)))
+        if len(self.batch) >= self.batch_size:
+            self._flush_batch()
+
+    def _flush_batch(self):
+        """
+        Totally ordered broadcast of the current batch.
+        """
+        broadcast_message = {"operations": self.batch,
+                                "ack": 0,
+                                "id": self.server_number}
+        self._broadcast(broadcast_message, self.batch_clients)
+        self.metrics.histogram("batch_operations", SIZE_BUCKETS).observe(len(self.batch))
+        self.batch, self.batch_clients = [], []
+
+    def _poll_timeout(self):
+        timeout = super()._poll_timeout()
+        if not self.batch:
+            return timeout
+        window = max(0, self.batch_window - 1000 * (time.monotonic() - self.batch_started))
+        return window if timeout is None else min(timeout, window)
+
+    def _after_poll(self):
+        super()._after_poll()
+        if self.batch and 1000 * (time.monotonic() - self.batch_started) >= self.batch_window:
+            self._flush_batch()
+        with self.send_lock:
+            synced = self.last_sync >= self.highest_read
+        if not synced: # the reads need the other servers to send a timestamp at least as high as theirs
+            if self.batch: # the batch will be acknowledged anyway, so it does the job
+                self._flush_batch()
+            else:
+                self._broadcast({"id": self.server_number, "ack": 1, "sync": 1})
+                self.metrics.counter("syncs_sent").inc()
+
+    def _housekeeper(self):
+        """
+        Whether we submit the expiries and the evictions for the whole cluster: the server with the lowest number,
+        a lamport order makes no progress without every server anyway.
+        """
+        return self.server_number == min(self.watermarks)
 
-        self.send_socket.send_json(message)
+    def _housekeep(self):
+        """
+        If we are the housekeeper, add to the batch an expire operation for every key past its deadline and an evict
+        operation for every key over max_keys, the least recently used of a sample each, so that every server removes
+        the keys at the same position of the order. A key stays until its operation is delivered, and its operation
+        is submitted again if it is not delivered within HOUSEKEEPING_RETRY seconds, e.g. lost with a leader.
+        """
+        if not self._housekeeper():
+            return
+        now, retry = int(1000 * time.time()), 1000 * self.HOUSEKEEPING_RETRY
+        with self.kv_store_lock:
+            due = self.wheel.advance(now)
+            for key in due[self.HOUSEKEEPING_LIMIT:]: # at the next tick
+                self.wheel.schedule(key, now)
+            operations = [("expire", key, self.deadlines[key]) for key in due[:self.HOUSEKEEPING_LIMIT]]
+            for operation, key, deadline in operations:
+                self.wheel.schedule(key, now + retry)
+            if self.max_keys:
+                monotonic = time.monotonic()
+                for key, sent in list(self.evicting.items()):
+                    if self.kv_store.get(key) is None:
+                        del self.evicting[key]
+                    elif monotonic - sent >= self.HOUSEKEEPING_RETRY: # a candidate again
+                        del self.evicting[key]
+                        self.lru.touch(key)
+                over = self.kv_store.size() - self.max_keys - len(self.evicting)
+                for _ in range(min(over, self.HOUSEKEEPING_LIMIT - len(operations))):
+                    key = self.lru.victim()
+                    if key is None:
+                        break
+                    self.evicting[key] = monotonic
+                    operations.append(("evict", key, None))
+        if operations:
+            self._add_to_batch(None, "housekeeping", operations)
+
+    def _ordered_read(self, client, message):
+        """
+        Read the key at the position (timestamp, id) of the total order, where timestamp is our next clock value.
+        Every write that completed before the read arrived is ordered before it: its sender heard a timestamp at least
+        as high as the write from us before answering, so our clock is already past it. The read is answered once every
+        server has sent a timestamp at least as high as the read and everything ordered before it is delivered, so it
+        never goes through the queue nor is acknowledged. All the reads waiting at the same time share one sync message,
+        which the other servers acknowledge, unless one of our broadcasts already does it.
+        """
+        timestamp = self._update_clock()
+        self.highest_read = timestamp
+        with self.queue_ready:
+            heapq.heappush(self.reads, (timestamp, self.server_number, next(self.read_seq), client, message))
+            if self._readable():
+                self.queue_ready.notify()
+
+    def _deliverable(self): # must be called with queue_lock held
+        return bool(self.queue) and self.queue[0][0] <= min(self.watermarks.values())
 
+    def _readable(self): # must be called with queue_lock held
+        return (bool(self.reads) and self.reads[0][0] <= min(self.watermarks.values())
+                and (not self.queue or self.reads[0][:2] < self.queue[0][:2]))
 
     def _queue_handler(self):
         while 1:
-            if self.queue:
-                with self.queue_lock:
-                    timestamp, id, operation, key, value = self.queue[0]
-                    with self.acks_lock:
-                        if self.acks[(timestamp, id, operation, key, value)] == self.total_servers:
-                            timestamp, id, operation, key, value = heapq.heappop(self.queue)
-                            if operation == "set":
-                                with self.kv_store_lock:
-                                    self.kv_store[key] = value
-                                    if id == self.server_number:
-                                        self.api_socket.send_string("success")
-                                        print(f"Server {self.server_number} set the value of the key {key} to {value}")
-                            elif operation == "get":
-                                if id == self.server_number:
-                                    self.api_socket.send_string(f"{key}:{self.kv_store[key]}")
-                                    print(f"Server {self.server_number} got the value of the key {key} as {self.kv_store[key]}")
-
-            # time.sleep(1)
-                       
+            with self.queue_ready:
+                self.queue_ready.wait_for(lambda: self._deliverable() or self._readable())
+                # drain every consecutive deliverable message and read in one pass
+                delivered = []
+                while 1:
+                    if self._readable():
+                        delivered.append((None, heapq.heappop(self.reads)))
+                    elif self._deliverable(): # a read ordered before the head would be readable
+                        delivered.append((heapq.heappop(self.queue), None))
+                    else:
+                        break
+            # only this thread delivers, so the order is preserved without holding the queue lock
+            for entry, read in delivered:
+                if read is not None:
+                    timestamp, id, seq, client, request = read
+                    self._deliver_read(client, request)
+                    continue
+                timestamp, id, operations, enqueued = entry
+                clients = None
+                if id == self.server_number:
+                    clients, sent = self.pending.pop(timestamp)
+                    # from the broadcast to the delivery, i.e. the wait for every server to acknowledge it
+                    self.metrics.histogram("ack_wait_ms").observe(1000 * (time.perf_counter() - sent))
+                self._deliver(timestamp, id, operations, clients)
+                self.metrics.histogram("deliver_ms").observe(1000 * (time.perf_counter() - enqueued))
+                self.metrics.counter("delivered_operations").inc(len(operations))
+
+    def _deliver(self, timestamp, id, operations, clients):
+        """
+        Apply a delivered batch of (operation, key, value) atomically and in order.
+        If we broadcasted the batch, clients are the (client, request type, number of operations) of its requests
+        (see `_reply_batch`), otherwise clients is None.
+        """
+        raise NotImplementedError
+
+    def _deliver_read(self, client, message):
+        raise NotImplementedError
+
+    def _reply_batch(self, clients, operations, results):
+        """
+        Answer the requests of a delivered batch that we broadcasted, each request owns the next `count` operations.
+        results[i] is the value read by operations[i] or the response to a scan, unused for a set.
+        """
+        start = 0
+        for client, request_type, count in clients:
+            requested, values = operations[start:start + count], results[start:start + count]
+            start += count
+            if client is None: # our expire and evict operations
+                continue
+            if request_type in MULTI_KEY:
+                keys = [key for operation, key, value in requested]
+                if request_type == "mget":
+                    self._reply(client, {"type": "mget", "key": keys, "value": values})
+                    self._log_operation("mget", keys, values)
+                else:
+                    self._reply(client, {"type": request_type, "key": keys, "value": None})
+                    self._log_operation(request_type, keys, [value for operation, key, value in requested])
+                continue
+            operation, key, value = requested[0]
+            if operation == "set":
+                self._reply(client, {"type": "set", "key": key, "value": None})
+                self._log_operation("set", key, value)
+            elif operation == "get":
+                self._reply(client, {"type": "get", "key": key, "value": values[0]})
+                self._log_operation("get", key, values[0])
+            elif operation == "scan":
+                self._reply(client, values[0])
+                self._log_operation("scan", values[0]["key"], values[0]["value"])
+            elif operation in MEMBERSHIP:
+                self._reply(client, {"type": operation, "key": key, "value": None})
+
+    def _server_handler(self):
+        """
+        This method is responsible for handling the requests from the other servers.
+        """
+        while 1:
+            self._handle_message(self._recv_message())
+            while self.recv_socket.poll(0): # a whole burst of messages is acknowledged at once
+                self._handle_message(self._recv_message())
+            with self.send_lock:
+                acknowledged = self.last_sent >= self.last_received
+            if not acknowledged: # none of our messages piggybacked the ack
+                self._broadcast({"id": self.server_number, "ack": 1})
+                self.metrics.counter("acks_sent").inc()
+
+    def _handle_message(self, message):
+        if "ping" in message:
+            return
+        # print(f"Server {self.server_number} received message from Server {message['id']}: {message}")
+        self._update_clock(message["timestamp"])
+        if (message["ack"] == 0 or message.get("sync")) and message["id"] != self.server_number:
+            self.last_received = max(self.last_received, message["timestamp"])
+        with self.queue_ready:
+            if message["ack"] == 0:
+                # operations are [operation, key, value] lists when decoded from json
+                entry = (message["timestamp"], message["id"], [tuple(operation) for operation in message["operations"]],
+                         time.perf_counter())
+                heapq.heappush(self.queue, entry) # (timestamp, id) is unique, so the rest is never compared
+            self.watermarks[message["id"]] = message["timestamp"]
+            if self._deliverable() or self._readable():
+                self.queue_ready.notify()
+
+
+class Server_linearizability(Server_total_order):
+    """
+    This class represents a server in the cluster with linearizability consistency level.
+    The reads are totally ordered broadcast like the writes by default (read_mode "broadcast"),
+    with the read_mode "barrier" they only wait for their position in the total order (see `_ordered_read`).
+    """
+    def __init__(self, server_number, port_number, contacts, config=None, network=None):
+        self.read_mode = (config or {}).get("read_mode", "broadcast")
+        if self.read_mode not in ["broadcast", "barrier"]:
+            raise ValueError("The read mode must be one of the following: broadcast, barrier.")
+        super().__init__(server_number, port_number, contacts, config, network)
+
+    def _deliver_read(self, client, message):
+        self._local_read(client, message)
+
+    def _deliver(self, timestamp, id, operations, clients):
+        results = [] # value of the key right after each operation
+        with self.kv_store_lock:
+            self._persist(timestamp, id, *self._logged(operations)) # before the writes reach the store
+            for operation, key, value in operations:
+                if operation == "scan": # only read by the server that answers it
+                    results.append(self._scan(key, value) if clients is not None else None)
+                    continue
+                if operation != "get":
+                    self._write(operation, key, value)
+                results.append(self.kv_store.get(key))
+        if self.lru is not None: # the reads are delivered on every server
+            self._touch([key for operation, key, value in operations if operation == "get"],
+                        [result for (operation, key, value), result in zip(operations, results) if operation == "get"])
+        if clients is not None:
+            self._reply_batch(clients, operations, results)
+
     def _heartbeat(self): # keep api_socket alive
         while 1:
             self.api_socket.send_string("ping")
@@ -133,264 +1026,1200 @@ class Server_linearizability(Server):
 
             time.sleep(1)
 
-    def _client_handler(self):
-        """
-        This method is responsible for handling the requests from the clients.
-        """
-        while 1:
-            socks = dict(self.poller.poll())
-            if self.api_socket in socks:
-                message = self.api_socket.recv_json()
-                # threading.Thread(target=self._heartbeat).start()
-                # print(f"Server {self.server_number} received message: {message}")
-                self._update_clock()
-                broadcast_message = {"timestamp": self.lamport_clock,
-                                        "operation": message["type"],
-                                        "key": message["key"],
-                                        "value": message["value"],
-                                        "ack": 0,
-                                        "id": self.server_number}
-                self._broadcast(broadcast_message)
+    def _handle_request(self, client, message):
+        # threading.Thread(target=self._heartbeat).start()
+        if message["type"] in READS and self.read_mode == "barrier":
+            self._ordered_read(client, message)
+        else:
+            self._broadcast_request(client, message)
 
     def _daemon(self):
         while 1:
             self.send_socket.send_json(HEARTBEAT)
             time.sleep(0.5)
 
-    def _server_handler(self):
-        """
-        This method is responsible for handling the requests from the other servers.
-        """
-        while 1:
-            # socks = dict(self.poller.poll())
-            # if self.recv_socket in socks:
-            message = self.recv_socket.recv_json()
-            if "ping" in message:
-                continue
-            # print(message)
-            id = message["id"]
-            # print(f"Server {self.server_number} received message from Server {id}: {message}")
-            self._update_clock(message["timestamp"])
-            if message["ack"] == 1: 
-                with self.acks_lock:
-                    self.acks[(message["msg_timestamp"], message["id"], message["operation"], message["key"], message["value"])] += 1
-            else: # id is the one who broadcasted the message
-                with self.queue_lock:
-                    heapq.heappush(self.queue, (message["timestamp"], 
-                                                message["id"], 
-                                                message["operation"], 
-                                                message["key"], 
-                                                message["value"]))
-                self._update_clock()
-                ack_message = {"timestamp": self.lamport_clock, 
-                                "id": message["id"],
-                                "operation": message["operation"],
-                                "key": message["key"],
-                                "value": message["value"],
-                                "ack": 1,
-                                "msg_timestamp": message["timestamp"]}
-                self._broadcast(ack_message)
-
-
-class Server_sequential(Server):
+
+class Server_sequential(Server_total_order):
     """
     This class represents a server in the cluster with sequential consistency level.
     """
+    def _deliver(self, timestamp, id, operations, clients):
+        with self.kv_store_lock:
+            self._persist(timestamp, id, *self._logged(operations)) # before the writes reach the store
+            for operation, key, value in operations:
+                self._write(operation, key, value)
+        if clients is not None:
+            self._reply_batch(clients, operations, [None] * len(operations))
 
-    def __init__(self, server_number, port_number, contacts):
-        super().__init__(server_number, port_number, contacts)
+    def _handle_request(self, client, message):
+        if message["type"] in READS: # local read
+            self._local_read(client, message)
+        else:
+            self._broadcast_request(client, message)
 
-        self.lamport_clock = 0
-        self.lamport_clock_lock = threading.Lock()
 
-        self.queue = [] # to store the requests
-        heapq.heapify(self.queue) # to sort the requests based on the timestamp
-        self.queue_lock = threading.Lock()
+class Server_leader(Server_total_order):
+    """
+    The leader-based total order ("ordering": "leader" in server_config) of linearizability and sequential consistency,
+    in the manner of Raft, instead of the lamport clocks of `Server_total_order`: an elected leader gives every batch of
+    operations the next index of a replicated log and sends it to the followers, which acknowledge it to the leader only.
+    An entry is committed once a majority of the servers (the leader included) hold it, and every server applies the
+    committed entries in the order of the log with the `_deliver` of its consistency level. A write costs about
+    3 (N - 1) messages (the entry, the acks, the new commit index) instead of (N - 1) + (N - 1) ** 2 broadcasts and acks,
+    and a slow or dead minority of the servers no longer holds back the delivery.
 
-        self.acks = defaultdict(int) # to store number of the acknowledgements 
-        self.acks_lock = threading.Lock()
+    A server collects the operations of its clients into batches like `_broadcast_request` does and forwards every batch
+    to the leader, which appends it as one entry, so the requests of a batch stay atomic. The server answers its clients
+    when it applies the entry. The messages to a single server go through the PUB socket with a topic (`UNICAST`).
+    The servers start as followers: a follower that hears nothing from a leader for an election timeout (election_timeout
+    to twice that, in milliseconds, 500 by default) starts an election for the next term, and becomes the leader with the
+    votes of a majority, which a server only gives to one candidate per term whose log is at least as up to date as its own.
+    The leader sends its commit index after every burst of acks, and a heartbeat after heartbeat_interval milliseconds
+    (50 by default) without broadcasting. A follower that misses an entry rejects the next one, and the leader sends it
+    the entries from its last matching one again, or a snapshot of its store if its log does not reach back that far:
+    a server keeps the last log_retention (100000 by default) applied entries.
 
-        self.total_servers = len(self.contacts)
+    Servers join and leave the running cluster through the log (`DYNAMIC`). A new server is started with "join" in its
+    config and the members and itself in its contacts: it asks the members in turn to add it (see `_announce`), and its
+    join entry makes it a learner, which receives the entries but neither votes nor counts in the majority. The leader
+    streams it a snapshot of the store and of the members (see `_stream_snapshot`), then the entries committed meanwhile,
+    and once the learner holds every committed entry the leader appends a promote entry that makes it a voter. A leave
+    request removes a server at its leave entry, and a leader that leaves steps down once it applied it. Every server
+    applies a change of the members at its index in the log, like the writes, and the leader appends a change only once
+    the previous one is applied. A joining server holds the requests of its clients until its snapshot is installed.
 
-        self.api_thread = threading.Thread(target=self._client_handler)
-        self.api_thread.start()
+    A server submits its batches that are not applied yet again to every new leader, since the former one may have
+    lost them, and a leader skips a batch whose (origin, seq) is already in its log: its log holds every committed entry,
+    so a batch is never applied twice and the requests in flight at a change of leader are still answered. A server
+    that installs a snapshot answers its batches that are not applied yet with an error (see `_forget_unapplied`).
+    The log, the term, the vote and the members are only kept in memory: a restarted server catches up from the leader.
+    The reads of linearizability are entries of the log, so the barrier read mode is not supported.
+    """
+    UNICAST = True
+    DYNAMIC = True
+    MAX_RESEND = 1000 # entries sent again per rejection, the follower rejects again if it still misses some
+    STREAM_WINDOW = 8 # chunks of a snapshot in flight
+    MAX_STALLS = 20 # the stream of a snapshot is abandoned after as many stall timeouts in a row, see _stream_snapshot
 
-        self.recv_thread = threading.Thread(target=self._server_handler)
-        self.recv_thread.start()
+    def __init__(self, server_number, port_number, contacts, config=None, network=None):
+        config = config or {}
+        if isinstance(self, Server_linearizability) and config.get("read_mode", "broadcast") != "broadcast":
+            raise ValueError("The read mode must be one of the following: broadcast.")
+        self.joining = bool(config.get("join"))
+        contacts = dict(contacts) # it follows the members, the dict of the caller must not change with it
+        self.election_timeout = config.get("election_timeout", 500) / 1000
+        self.heartbeat_interval = config.get("heartbeat_interval", 50) / 1000
+        self.log_retention = config.get("log_retention", 100000)
+        self.snapshot_chunk = config.get("snapshot_chunk", 1000)
+        self.snapshot_rate = config.get("snapshot_rate", 0)
 
-        self.queue_thread = threading.Thread(target=self._queue_handler)
-        self.queue_thread.start()
+        # the state of the protocol is guarded by log_lock
+        self.log_lock = threading.Lock()
+        self.log_ready = threading.Condition(self.log_lock) # notified when the commit index moves or a snapshot arrives
+        self.stream_ready = threading.Condition(self.log_lock) # notified when a follower acknowledges a chunk of a snapshot
+        # only the voters vote and count in the majority, the learners receive the entries until they catch up
+        self.voters = {int(contact) for contact in contacts} - ({int(server_number)} if self.joining else set())
+        self.learners = set()
+        self.others = sorted(self.voters - {int(server_number)}) # the other voters
+        self.majority = len(self.voters) // 2 + 1
+        self.change_index = 0 # index of the last change of the members the leader appended
+        self.term = 0
+        self.role = "follower" # or "candidate", "leader"
+        self.leader = None # the leader of the term, once we heard from it
+        self.voted_for = None
+        self.votes = set()
+        self.log = [] # (term, origin, seq, operations) of the entries from the index log_start
+        self.log_start = 1
+        self.snapshot_term = 0 # term of the entry log_start - 1, the last one dropped from the log
+        self.commit_index = 0
+        self.matched = 0 # last index of our log known to match the log of the leader
+        self.match_index = {} # the leader's matched of every follower
+        self.resend = {} # follower -> its matched, the leader sends it the next entries again
+        self.snapshot_due = set() # followers that need a snapshot of the store
+        self.streaming = set() # followers we stream a snapshot to
+        self.stream_acks = {} # follower -> (index, chunk) of the last chunk of a snapshot it acknowledged
+        self.receiving = None # (stream, chunks received, operations) of the snapshot we receive, stream is (leader, term, index)
+        self.chunk_due = None # (index, chunk) that we acknowledge to the leader
+        self.subscriptions_due = False # the members changed, the SUB socket must follow
+        self.applied = 0 # last applied index
+        self.installing = None # (index, leader, operations) of a snapshot for the queue handler to apply, None once loaded
+        self.loading = [] # (stream, operations) of the chunks of our snapshot while we join, for the queue handler to load
+        self.loaded = (None, set()) # (stream, keys) of the chunks loaded, only used by the queue handler
+        self.unsent = [] # (origin, seq, operations) of the batches waiting for a leader
+        self.unapplied = {} # seq -> operations of our batches not applied yet, submitted again to every new leader
+        self.appended = set() # (origin, seq) of the entries of the log, only kept by the leader
+        self.forwarded = [] # (origin, seq, operations) of the batches forwarded to us
+        self.outgoing = [] # (message, receiver) to send once log_lock is released
+        self.ack_due = self.reject_due = self.commit_due = False
+        self.rejected = (None, 0) # (matched, time) of our last rejection, we do not repeat it before a heartbeat interval
+        self.election_deadline = time.monotonic() + self._election_timeout()
 
+        self.last_broadcast = 0 # time of our last broadcast, written under send_lock
+        self.apply_lock = threading.Lock() # held while the queue handler applies, so that a snapshot matches applied
+        self.batch_seq = itertools.count(time.time_ns() // 1000) # identifies our batches in the log, even across restarts
+        self.subscribed = {ports[1] for ports in contacts.values()} # send ports of the members, only used by the server handler
+        self.held = [] # (client, request) received before our snapshot is installed, only used by the client handler
 
-    def _update_clock(self, timestamp=0): # if no timestamp is given, then it is a local event, just increment the clock
-        with self.lamport_clock_lock:
-            self.lamport_clock = max(self.lamport_clock, timestamp) + 1
+        super().__init__(server_number, port_number, contacts, config, network)
 
-    def _broadcast(self, message):
-        self.send_socket.send_json(message)
+        self.metrics.gauge("term", lambda: self.term)
+        self.metrics.gauge("leader", lambda: self.leader)
+        self.metrics.gauge("commit_index", lambda: self.commit_index)
+        self.metrics.gauge("log_entries", lambda: len(self.log))
+        self.metrics.gauge("voters", lambda: len(self.voters))
+        self.metrics.gauge("learners", lambda: len(self.learners))
+        self.metrics.gauge("voter", lambda: int(self.server_number in self.voters))
+        if self.joining:
+            self.announce_thread = self._start_thread(self._announce)
 
-    def _queue_handler(self):
-        while 1:
-            if self.queue:
-                with self.queue_lock:
-                    timestamp, id, operation, key, value = self.queue[0]
-                    with self.acks_lock:
-                        if self.acks[(timestamp, id, operation, key, value)] == self.total_servers:
-                            timestamp, id, operation, key, value = heapq.heappop(self.queue)
-                            self.kv_store[key] = value
-                            if id == self.server_number:
-                                self.api_socket.send_string("success")
-                                print(f"Server {self.server_number} set the value of the key {key} to {value}")
-                       
+    def _election_timeout(self):
+        return random.uniform(1, 2) * self.election_timeout
 
-    def _client_handler(self):
+    def _housekeeper(self):
+        return self.role == "leader"
+
+    def _last_index(self): # must be called with log_lock held
+        return self.log_start + len(self.log) - 1
+
+    def _term_at(self, index): # must be called with log_lock held, None if the entry is not in the log
+        if index == self.log_start - 1:
+            return self.snapshot_term
+        if self.log_start <= index <= self._last_index():
+            return self.log[index - self.log_start][0]
+        return None
+
+    def _handle_request(self, client, message):
+        if self.joining: # our store is not the cluster's yet
+            self.held.append((client, message))
+        elif message["type"] in MEMBERSHIP: # an entry of its own, after the operations collected before it
+            if self.batch:
+                self._flush_batch()
+            self._broadcast_request(client, message)
+            if self.batch:
+                self._flush_batch()
+        else:
+            super()._handle_request(client, message)
+
+    def _poll_timeout(self):
+        timeout = super()._poll_timeout()
+        if self.held: # until the queue handler installs our snapshot
+            return 10 if timeout is None else min(timeout, 10)
+        return timeout
+
+    def _after_poll(self):
+        if self.held and not self.joining:
+            held, self.held = self.held, []
+            for client, message in held:
+                self._handle_request(client, message)
+        super()._after_poll()
+
+    def _announce(self):
         """
-        This method is responsible for handling the requests from the clients.
+        Ask the members of our contacts, one after the other, to add us to the cluster, until one of them answers:
+        it does once our join entry is applied, after which the leader streams us its snapshot.
         """
-        while 1:
-            socks = dict(self.poller.poll())
-            if self.api_socket in socks:
-                message = self.api_socket.recv_json()
-                self._update_clock()
-                if message["type"] == "get": # local read 
-                    self.api_socket.send_string(f"{message['key']}:{self.kv_store[message['key']]}")
-                    print(f"Server {self.server_number} got the value of the key {message['key']} as {self.kv_store[message['key']]}")
+        request = {"type": "join", "key": self.server_number, "value": [self.recv_port, self.send_port, self.api_port]}
+        with self.log_lock:
+            members = [self.contacts[contact][2] for contact in self.contacts if int(contact) != self.server_number]
+        for api_port in itertools.cycle(members):
+            socket = self.context.socket(zmq.REQ)
+            socket.connect(self._connect_address(api_port))
+            socket.send_json(request)
+            answered = socket.poll(10000 * self.election_timeout)
+            socket.close(linger=0)
+            if answered:
+                break
+
+    def _flush_batch(self):
+        seq = next(self.batch_seq)
+        self.pending[seq] = (self.batch_clients, time.perf_counter())
+        self.metrics.histogram("batch_operations", SIZE_BUCKETS).observe(len(self.batch))
+        operations, self.batch, self.batch_clients = self.batch, [], []
+        with self.log_lock:
+            self.unapplied[seq] = operations
+        self._submit([(self.server_number, seq, operations)])
+
+    def _submit(self, batches):
+        """
+        Append the (origin, seq, operations) batches to the log if we are the leader, otherwise forward them to the leader,
+        or keep them until we know one. The entries are sent with send_lock held, so they leave in the order of the log.
+        """
+        with self.send_lock:
+            with self.log_lock:
+                if self.role == "leader":
+                    for origin, seq, operations in batches:
+                        if (origin, seq) in self.appended: # submitted again after a change of leader
+                            continue
+                        if operations and operations[0][0] in MEMBERSHIP and self.change_index > self.applied:
+                            self.forwarded.append((origin, seq, operations)) # one change at a time, submitted again later
+                        else:
+                            self._append(origin, seq, operations)
+                elif self.leader is not None:
+                    for origin, seq, operations in batches:
+                        self.outgoing.append(({"kind": "forward", "term": self.term, "id": self.server_number, "timestamp": seq,
+                                               "ack": 0, "origin": origin, "operations": operations}, self.leader))
                 else:
-                    broadcast_message = {"timestamp": self.lamport_clock,
-                                            "operation": message["type"],
-                                            "key": message["key"],
-                                            "value": message["value"],
-                                            "ack": 0,
-                                            "id": self.server_number}
-                    self._broadcast(broadcast_message)
+                    self.unsent.extend(batches)
+                outgoing, self.outgoing = self.outgoing, []
+            self._send_all(outgoing)
+
+    def _send_all(self, outgoing): # the caller must own the send socket
+        for message, receiver in outgoing:
+            self._send_message(message, receiver)
+            if receiver is None:
+                self.last_broadcast = time.monotonic()
+
+    def _append(self, origin, seq, operations): # must be called with log_lock held, by the leader
+        self.log.append((self.term, origin, seq, operations))
+        self.appended.add((origin, seq))
+        if operations and operations[0][0] in MEMBERSHIP:
+            self.change_index = self._last_index()
+        self.outgoing.append((self._entry_message(self._last_index()), None))
+        self._advance_commit()
+
+    def _entry_message(self, index): # must be called with log_lock held
+        term, origin, seq, operations = self.log[index - self.log_start]
+        return {"kind": "append", "term": self.term, "id": self.server_number, "timestamp": index, "ack": 0,
+                "entry_term": term, "prev_term": self._term_at(index - 1), "origin": origin, "seq": seq,
+                "operations": operations, "commit": self.commit_index}
+
+    def _commit_message(self, heartbeat): # must be called with log_lock held
+        last = self._last_index()
+        return {"kind": "commit", "term": self.term, "id": self.server_number, "timestamp": last, "ack": 1,
+                "last_term": self._term_at(last), "commit": self.commit_index, "heartbeat": int(heartbeat)}
+
+    def _advance_commit(self): # must be called with log_lock held, by the leader
+        """
+        Commit up to the highest index held by a majority, if it is an entry of our term: the entries of the former
+        terms are committed with it, since a leader is only elected with the votes of servers whose logs it contains.
+        """
+        indexes = sorted([self._last_index()] + [self.match_index[follower] for follower in self.others], reverse=True)
+        index = indexes[self.majority - 1]
+        if index > self.commit_index and self._term_at(index) == self.term:
+            self.commit_index = index
+            self.commit_due = True
+            self.log_ready.notify()
 
     def _server_handler(self):
         """
-        This method is responsible for handling the requests from the other servers.
+        Handle the messages of the other servers in bursts, then send what they call for: one ack of a follower per burst
+        of entries, one commit index of the leader per burst of acks, the entries a follower misses, the heartbeats
+        and the elections.
         """
         while 1:
-            message = self.recv_socket.recv_json()
-            id = message["id"]
-            # print(f"Server {self.server_number} received message from Server {id}: {message}")
-            self._update_clock(message["timestamp"])
-            if message["ack"] == 1: 
-                with self.acks_lock:
-                    self.acks[(message["msg_timestamp"], message["id"], message["operation"], message["key"], message["value"])] += 1
-            else: # id is the one who broadcasted the message
-                with self.queue_lock:
-                    heapq.heappush(self.queue, (message["timestamp"], 
-                                                message["id"], 
-                                                message["operation"], 
-                                                message["key"], 
-                                                message["value"]))
-                self._update_clock()
-                ack_message = {"timestamp": self.lamport_clock, 
-                                "id": message["id"],
-                                "operation": message["operation"],
-                                "key": message["key"],
-                                "value": message["value"],
-                                "ack": 1,
-                                "msg_timestamp": message["timestamp"]}
-                self._broadcast(ack_message)
+            messages = []
+            if self.recv_socket.poll(500 * self.heartbeat_interval):
+                messages.append(self._recv_message())
+                while self.recv_socket.poll(0):
+                    messages.append(self._recv_message())
+            with self.log_lock:
+                for message in messages:
+                    self._handle_message(message)
+                self._tick()
+                outgoing, self.outgoing = self.outgoing, []
+                snapshots, self.snapshot_due = self.snapshot_due - self.streaming, set()
+                self.streaming |= snapshots
+                batches, self.forwarded = self.forwarded, []
+                if self.leader is not None: # our batches can go now
+                    batches, self.unsent = self.unsent + batches, []
+                subscriptions = {ports[1] for ports in self.contacts.values()} if self.subscriptions_due else None
+                self.subscriptions_due = False
+            for follower in snapshots:
+                self._start_thread(lambda follower=follower: self._stream_snapshot(follower))
+            if subscriptions is not None and self.network is None:
+                self._subscribe(subscriptions)
+            with self.send_lock:
+                self._send_all(outgoing)
+            if batches:
+                self._submit(batches)
+
+    def _handle_message(self, message): # must be called with log_lock held
+        if "ping" in message or message["id"] == self.server_number: # our own broadcasts come back
+            return
+        if message["term"] > self.term:
+            self._new_term(message["term"])
+        kind = message["kind"]
+        if kind == "forward": # appended by _submit, or forwarded again if we are no longer the leader
+            self.forwarded.append((message["origin"], message["timestamp"], [tuple(operation) for operation in message["operations"]]))
+        elif message["term"] < self.term: # from a former term, its sender learns the new one from our broadcasts
+            return
+        elif kind in ["append", "commit", "snapshot"]:
+            if self.leader != message["id"]:
+                self.role, self.leader, self.votes = "follower", message["id"], set()
+                self._resubmit()
+            self.election_deadline = time.monotonic() + self._election_timeout()
+            if kind == "append":
+                self._receive_entry(message)
+            elif kind == "commit":
+                self._receive_commit(message)
+            else:
+                self._receive_snapshot(message)
+        elif kind == "ack" and self.role == "leader" and message["id"] in self.match_index: # not from a former member
+            follower = message["id"]
+            self.match_index[follower] = max(self.match_index[follower], message["timestamp"])
+            if message["reject"]:
+                self.resend[follower] = message["timestamp"]
+            self._advance_commit()
+            if follower in self.learners and self.match_index[follower] >= self.commit_index and self.change_index <= self.applied:
+                self._append(self.server_number, 0, [("promote", follower, None)]) # the learner caught up
+        elif kind == "chunk" and self.role == "leader":
+            self.stream_acks[message["id"]] = (message["timestamp"], message["chunk"])
+            self.stream_ready.notify_all()
+        elif kind == "vote":
+            self._receive_vote(message)
+        elif kind == "voted" and self.role == "candidate" and message["granted"] and message["id"] in self.voters:
+            self.votes.add(message["id"])
+            if len(self.votes) >= self.majority:
+                self._become_leader()
+
+    def _new_term(self, term): # must be called with log_lock held
+        self.term = term
+        self.role, self.leader, self.voted_for, self.votes = "follower", None, None, set()
+        self.matched = self.commit_index # the committed entries are the only ones known to be in the log of the next leader
+
+    def _receive_entry(self, message): # must be called with log_lock held
+        index = message["timestamp"]
+        if index <= self.commit_index: # sent again, we already have it
+            self.ack_due = True
+        elif self._term_at(index - 1) != message["prev_term"]: # we missed the previous entry, or it is not the leader's
+            self.reject_due = True
+        else:
+            entry = (message["entry_term"], message["origin"], message["seq"], [tuple(operation) for operation in message["operations"]])
+            if self._term_at(index) != entry[0]: # a new entry, or one from a former leader that was never committed
+                del self.log[index - self.log_start:]
+                self.log.append(entry)
+            if index > self.matched:
+                self.matched = index
+                self.ack_due = True
+        self._follow_commit(message["commit"])
+
+    def _receive_commit(self, message): # must be called with log_lock held
+        index = message["timestamp"] # the last index of the leader
+        if self._term_at(index) == message["last_term"]: # then our log matches the leader's up to index
+            if index > self.matched:
+                self.matched = index
+                self.ack_due = True
+        elif index > self.commit_index:
+            self.reject_due = True
+        if message["heartbeat"] and self.matched > message["commit"]: # our last ack may have been lost
+            self.ack_due = True
+        self._follow_commit(message["commit"])
+
+    def _receive_snapshot(self, message): # must be called with log_lock held
+        """
+        Collect the chunks of a snapshot in order, acknowledging the last one received, and install it with the last chunk.
+        """
+        index, chunk = message["timestamp"], message["chunk"]
+        if index <= self.commit_index: # sent again, or we caught up meanwhile, the stream can end
+            self.chunk_due = (index, message["chunks"] - 1)
+            return
+        stream = (message["id"], message["term"], index) # a snapshot at the same index on another server has another order
+        if self.receiving is None or self.receiving[0] != stream:
+            if chunk != 0:
+                return
+            self.receiving = (stream, 0, [])
+        stream, received, collected = self.receiving
+        if chunk == received:
+            operations = [tuple(operation) for operation in message["operations"]]
+            if self.joining: # nobody reads our store yet, so the queue handler loads every chunk as it comes
+                self.loading.append((stream, operations))
+                self.log_ready.notify()
+            else:
+                collected.extend(operations)
+            received += 1
+            self.receiving = (stream, received, collected)
+        self.chunk_due = (index, received - 1)
+        if received < message["chunks"]:
+            return
+        self.receiving = None
+        self.log, self.log_start, self.snapshot_term = [], index + 1, message["last_term"]
+        self.matched = self.commit_index = index
+        self.installing = (index, message["id"], None if self.joining else collected)
+        self._set_members(message["members"])
+        self.ack_due = True
+        self.log_ready.notify()
+        self.metrics.counter("snapshots_installed").inc()
+
+    def _follow_commit(self, commit): # must be called with log_lock held
+        commit = min(commit, self.matched)
+        if commit > self.commit_index:
+            self.commit_index = commit
+            self.log_ready.notify()
+
+    def _receive_vote(self, message): # must be called with log_lock held
+        if self.server_number not in self.voters:
+            return
+        last = self._last_index()
+        granted = (self.voted_for in [None, message["id"]]
+                   and (message["last_term"], message["timestamp"]) >= (self._term_at(last), last))
+        if granted:
+            self.voted_for = message["id"]
+            self.election_deadline = time.monotonic() + self._election_timeout()
+        self.outgoing.append(({"kind": "voted", "term": self.term, "id": self.server_number, "timestamp": 0, "ack": 1,
+                               "granted": int(granted)}, message["id"]))
+
+    def _resubmit(self): # must be called with log_lock held
+        """
+        Submit our batches that are not applied yet again, in their order, to the new leader (see `Server_leader`).
+        """
+        ours = [(self.server_number, seq, operations) for seq, operations in sorted(self.unapplied.items())]
+        self.unsent = ours + [batch for batch in self.unsent if batch[0] != self.server_number]
+
+    def _become_leader(self): # must be called with log_lock held
+        self.role, self.leader = "leader", self.server_number
+        self.appended = {(origin, seq) for term, origin, seq, operations in self.log}
+        self.match_index = {follower: 0 for follower in self.others + sorted(self.learners)}
+        self.resend = {}
+        self.stream_acks = {}
+        self.change_index = self._last_index() # a change a former leader appended is applied before we append one
+        self.metrics.counter("terms_led").inc()
+        if self.log_mode != "off":
+            print(f"Server {self.server_number} is the leader of the term {self.term}")
+        self._append(self.server_number, 0, []) # an entry of our term, to commit the ones of the former terms
+        self._resubmit()
+
+    def _tick(self): # must be called with log_lock held
+        now = time.monotonic()
+        if self.role == "leader":
+            for follower, matched in self.resend.items():
+                if follower in self.streaming:
+                    continue
+                if matched + 1 < self.log_start or (matched == 0 and follower in self.learners): # a new server needs the members too
+                    self.snapshot_due.add(follower)
+                    continue
+                last = min(self._last_index(), matched + self.MAX_RESEND)
+                self.outgoing += [(self._entry_message(index), follower) for index in range(matched + 1, last + 1)]
+                self.metrics.counter("entries_resent").inc(last - matched)
+            self.resend = {}
+            heartbeat = now - self.last_broadcast >= self.heartbeat_interval
+            if self.commit_due or heartbeat:
+                self.outgoing.append((self._commit_message(heartbeat), None))
+                self.commit_due = False
+            return
+        reject = self.reject_due and (self.rejected[0] != self.matched or now - self.rejected[1] >= self.heartbeat_interval)
+        if reject:
+            self.rejected = (self.matched, now)
+        if (self.ack_due or reject) and self.leader is not None:
+            self.outgoing.append(({"kind": "ack", "term": self.term, "id": self.server_number, "timestamp": self.matched,
+                                   "ack": 1, "reject": int(reject)}, self.leader))
+        if self.chunk_due is not None and self.leader is not None:
+            index, chunk = self.chunk_due
+            self.outgoing.append(({"kind": "chunk", "term": self.term, "id": self.server_number, "timestamp": index,
+                                   "ack": 1, "chunk": chunk}, self.leader))
+        self.ack_due = self.reject_due = False
+        self.chunk_due = None
+        if now >= self.election_deadline and self.server_number in self.voters:
+            self._new_term(self.term + 1)
+            self.role, self.voted_for, self.votes = "candidate", self.server_number, {self.server_number}
+            self.election_deadline = now + self._election_timeout()
+            self.metrics.counter("elections").inc()
+            if len(self.votes) >= self.majority: # a single server
+                self._become_leader()
+                return
+            last = self._last_index()
+            self.outgoing.append(({"kind": "vote", "term": self.term, "id": self.server_number, "timestamp": last,
+                                   "ack": 1, "last_term": self._term_at(last)}, None))
+
+    def _stream_snapshot(self, follower):
+        """
+        Stream a snapshot of our store and of the members at the applied index to a follower that needs entries we no
+        longer have, or to a new server, in chunks of snapshot_chunk keys sent with send_lock held one at a time, so the
+        entries and the commits go out between them. At most STREAM_WINDOW chunks are in flight: the follower
+        acknowledges the last chunk it received in order, and if it acknowledges none for two heartbeat intervals
+        the chunks after the acknowledged one are sent again. The stream ends with the term, or with the follower.
+        With snapshot_rate (keys per second, 0 by default for no limit) the chunks are paced, so that a large snapshot
+        takes longer instead of taking the time of the leader away from the clients.
+        """
+        try:
+            with self.apply_lock:
+                items = list(self.kv_store.iterate())
+                deadlines = dict(self.deadlines)
+                with self.log_lock:
+                    if self.role != "leader":
+                        return
+                    term, index, last_term, members = self.term, self.applied, self._term_at(self.applied), self._members()
+            chunks = [items[start:start + self.snapshot_chunk] for start in range(0, len(items), self.snapshot_chunk)] or [[]]
+            pace = self.snapshot_chunk / self.snapshot_rate if self.snapshot_rate else 0 # seconds per chunk
+            sent = acked = -1 # the last chunk sent and the last one acknowledged
+            stalls = 0
+            begin = progress = time.monotonic() # progress is the time of the last acknowledgement or resend
+            while acked < len(chunks) - 1:
+                window = min(acked + self.STREAM_WINDOW, len(chunks) - 1)
+                with self.send_lock:
+                    while sent < window and time.monotonic() >= begin + (sent + 1) * pace:
+                        sent += 1
+                        message = {"kind": "snapshot", "term": term, "id": self.server_number, "timestamp": index, "ack": 0,
+                                   "last_term": last_term, "chunk": sent, "chunks": len(chunks),
+                                   "operations": [("set", key, value) for key, value in chunks[sent]]
+                                                 + [("ttl", key, deadlines[key]) for key, value in chunks[sent] if key in deadlines]}
+                        if sent == len(chunks) - 1:
+                            message["members"] = members
+                        self._send_message(message, follower)
+                        self.metrics.counter("snapshot_chunks_sent").inc()
+                timeout = progress + 2 * self.heartbeat_interval - time.monotonic()
+                if sent < window: # held back by the rate
+                    timeout = min(timeout, begin + (sent + 1) * pace - time.monotonic())
+                with self.stream_ready:
+                    self.stream_ready.wait_for(lambda: self.term != term or self._chunk_acked(follower, index) > acked,
+                                               max(0, timeout))
+                    if self.term != term or follower not in self.match_index:
+                        return
+                    if self._chunk_acked(follower, index) > acked:
+                        acked, stalls, progress = self._chunk_acked(follower, index), 0, time.monotonic()
+                    elif time.monotonic() - progress >= 2 * self.heartbeat_interval:
+                        sent, stalls, progress = acked, stalls + 1, time.monotonic()
+                        if stalls >= self.MAX_STALLS: # the follower rejects again if it still needs the snapshot
+                            return
+            self.metrics.counter("snapshots_sent").inc()
+        finally:
+            with self.log_lock:
+                self.streaming.discard(follower)
+
+    def _chunk_acked(self, follower, index): # must be called with log_lock held
+        acked_index, chunk = self.stream_acks.get(follower, (None, -1))
+        return chunk if acked_index == index else -1
+
+    def _members(self): # must be called with log_lock held
+        return {"voters": sorted(self.voters), "learners": sorted(self.learners), "contacts": dict(self.contacts)}
+
+    def _set_members(self, members): # must be called with log_lock held
+        self.voters, self.learners = set(members["voters"]), set(members["learners"])
+        self.contacts = dict(members["contacts"])
+        self._update_members()
+
+    def _update_members(self): # must be called with log_lock held
+        self.others = sorted(self.voters - {self.server_number})
+        self.majority = len(self.voters) // 2 + 1
+        self.subscriptions_due = True
+        if self.network is not None:
+            self.connected = set(self.contacts)
+
+    def _change_members(self, operation, number, ports):
+        """
+        Apply a change of the members, at its index in the log on every server.
+        """
+        number = int(number)
+        with self.log_lock:
+            if operation == "join":
+                self.contacts[str(number)] = ports
+                if number not in self.voters:
+                    self.learners.add(number)
+                    if self.role == "leader" and number not in self.match_index:
+                        self.match_index[number] = 0
+                        self.snapshot_due.add(number)
+            elif operation == "promote" and number in self.learners:
+                self.learners.discard(number)
+                self.voters.add(number)
+            elif operation == "leave":
+                self.voters.discard(number)
+                self.learners.discard(number)
+                self.contacts.pop(str(number), None)
+                self.match_index.pop(number, None)
+                self.resend.pop(number, None)
+                if number == self.server_number and self.role == "leader": # the others elect a leader among them
+                    self.role, self.leader = "follower", None
+            self._update_members()
+            if self.role == "leader":
+                self._advance_commit()
+        self.metrics.counter(f"members.{operation}").inc()
+        if self.log_mode != "off":
+            print(f"Server {self.server_number} applied the {operation} of the server {number}")
+
+    def _subscribe(self, send_ports): # by the server handler, which owns the recv socket
+        """
+        Connect the SUB socket to the send ports of the new members, and disconnect it from the ones of the former members.
+        """
+        for port in send_ports - self.subscribed:
+            self.recv_socket.connect(self._connect_address(port))
+        for port in self.subscribed - send_ports:
+            self.recv_socket.disconnect(self._connect_address(port))
+            self.connected.discard(self._connect_address(port).encode())
+        self.subscribed = send_ports
+
+    def _queue_handler(self):
+        """
+        Apply the committed entries in the order of the log, and the snapshots of the leader.
+        """
+        while 1:
+            with self.log_ready:
+                self.log_ready.wait_for(lambda: self.commit_index > self.applied or self.installing is not None or self.loading)
+                snapshot, self.installing = self.installing, None
+                loading, self.loading = self.loading, []
+                first = (snapshot[0] if snapshot else self.applied) + 1
+                entries = [(index,) + self.log[index - self.log_start] for index in range(first, self.commit_index + 1)]
+            with self.apply_lock:
+                for stream, operations in loading:
+                    self._load(stream, operations)
+                if snapshot is not None:
+                    self._install(*snapshot)
+                    self.joining = False # the client handler serves the requests it held
+                    self._forget_unapplied()
+                for index, term, origin, seq, operations in entries:
+                    if not operations: # the first entry of a leader
+                        continue
+                    clients = None
+                    if origin == self.server_number and seq in self.pending:
+                        clients, sent = self.pending.pop(seq)
+                        # from the batch leaving this server to its commit
+                        self.metrics.histogram("ack_wait_ms").observe(1000 * (time.perf_counter() - sent))
+                    if operations[0][0] in MEMBERSHIP: # alone in its entry
+                        self._change_members(*operations[0])
+                        if clients is not None:
+                            self._reply_batch(clients, operations, [None])
+                        continue
+                    self._deliver(index, origin, operations, clients)
+                    self.metrics.counter("delivered_operations").inc(len(operations))
+                if entries or snapshot is not None:
+                    with self.log_lock:
+                        self.applied = entries[-1][0] if entries else snapshot[0]
+                        for index, term, origin, seq, operations in entries:
+                            if origin == self.server_number:
+                                self.unapplied.pop(seq, None)
+                        self._trim()
+
+    def _forget_unapplied(self):
+        """
+        Answer the requests of our batches that are not applied yet with an error once we installed a snapshot: it may
+        hold some of them, which a new leader whose log no longer reaches back to them would append again.
+        """
+        with self.log_lock:
+            unapplied, self.unapplied = self.unapplied, {}
+        for seq, operations in unapplied.items():
+            clients, sent = self.pending.pop(seq, ([], None))
+            start = 0
+            for client, request_type, count in clients:
+                keys = [key for operation, key, value in operations[start:start + count]]
+                start += count
+                if client is not None:
+                    self._reply(client, {"type": "error", "key": keys if request_type in MULTI_KEY else keys[0],
+                                         "value": "The request may or may not be applied, the server installed a snapshot meanwhile."})
+
+    def _load(self, stream, operations):
+        """
+        Write a chunk of the snapshot we receive while we join to the store, so that its end is not a long write of the
+        whole store. A stream that starts again, e.g. from a new leader, writes the keys it covers again.
+        """
+        if self.loaded[0] != stream:
+            self.loaded = (stream, set())
+        self.loaded[1].update(key for operation, key, value in operations)
+        with self.kv_store_lock:
+            self._persist(stream[2], stream[0], *self._logged(operations))
+            for operation, key, value in operations:
+                self._write(operation, key, value)
+
+    def _install(self, index, leader, operations):
+        """
+        Replace the store with the snapshot of the leader, the sets of its keys and the ttls of the keys that have one,
+        which are None if its chunks are already loaded.
+        """
+        if operations is None: # only the keys that no chunk of the last stream covers are left to delete
+            keys, operations = self.loaded[1], []
+            self.loaded = (None, set())
+        else:
+            keys = {key for operation, key, value in operations}
+        with self.kv_store_lock:
+            removed = [key for key, value in self.kv_store.iterate() if key not in keys]
+            writes, state = self._logged(operations)
+            self._persist(index, leader, [(key, REMOVED) for key in removed] + writes, state)
+            for key in removed:
+                self._remove(key)
+            for operation, key, value in operations:
+                self._write(operation, key, value)
+
+    def _trim(self): # must be called with log_lock held
+        """
+        Drop the applied entries older than the last log_retention ones, log_retention entries at a time.
+        """
+        count = self.applied - self.log_retention - self.log_start + 1
+        if count >= self.log_retention:
+            self.snapshot_term = self._term_at(self.log_start + count - 1)
+            self.appended.difference_update((origin, seq) for term, origin, seq, operations in self.log[:count])
+            del self.log[:count]
+            self.log_start += count
+
+
+class Server_leader_linearizability(Server_leader, Server_linearizability):
+    """
+    Linearizability on the leader-based total order.
+    """
+
+
+class Server_leader_sequential(Server_leader, Server_sequential):
+    """
+    Sequential consistency on the leader-based total order.
+    """
 
 
 class Server_eventual(Server):
     """
     This class represents a server in the cluster with eventual consistency level.
+    A write is applied and answered locally, then broadcasted. Concurrent writes to the same key are resolved with the
+    last-writer-wins rule: every server keeps the write with the largest (timestamp, id, value) in `last_modified`.
+    Every server expires a key with a ttl at its deadline and keeps its write in `last_modified`, so that an older write
+    that arrives later (a delayed broadcast, an anti-entropy round) does not bring the key back, and a replica that
+    has not seen the write yet gets it from there and expires it too: the replicas converge to the key gone.
+
+    A broadcast that a server misses (a lost message, a server that was down) is repaired by anti-entropy: every
+    anti_entropy_interval seconds (1 by default, 0 disables it) a server compares the merkle tree of its versions
+    (see `merkle.py`) with the one of a random other server, through the ROUTER socket bound on its recv port,
+    and both servers merge the entries of the leaves that differ with the same last-writer-wins rule.
+    Settings (see `server_config`):
+    - anti_entropy_interval: seconds between two anti-entropy rounds.
+    - merkle_depth: depth of the tree, 3 by default (16 ** 3 leaves).
+    - drop_rate: share of the received broadcasts that are dropped on purpose, 0 by default, to test the anti-entropy.
+    - coalesce_interval: milliseconds, 0 by default. If set, the writes are still applied and answered at once, but they
+      are broadcasted as one delta every coalesce_interval milliseconds, in which a key only has its last write with its
+      own timestamp: under last-writer-wins the earlier writes of a hot key would lose everywhere anyway. The remote
+      replicas see the writes up to coalesce_interval later.
     """
-    def __init__(self, server_number, port_number, contacts):
-        super().__init__(server_number, port_number, contacts)
+    def __init__(self, server_number, port_number, contacts, config=None, network=None):
+        # before Server.__init__, which recovers them with the store (see `_restore`)
+        self.last_modified = {} # key -> (timestamp, id, value, deadline) of the write applied to it, none for the initial keys
+        self.merkle = MerkleTree((config or {}).get("merkle_depth", 3)) # over the (timestamp, id) versions of last_modified
+        self.last_modified_lock = threading.Lock()
+
+        super().__init__(server_number, port_number, contacts, config, network)
 
-        self.lamport_clock = 0
+        self.lamport_clock = self.recovered_clock
         self.lamport_clock_lock = threading.Lock()
 
-        self.last_modified = defaultdict(tuple) 
-        self.last_modified_lock = threading.Lock()
+        self.last_heard = {} # highest timestamp received from each server, only used by the server handler
+        self.metrics.gauge("lamport_clock", lambda: self.lamport_clock)
+        # how far the server we heard the least recently from is behind our clock
+        self.metrics.gauge("clock_drift", lambda: self.lamport_clock - min(self.last_heard.values(), default=self.lamport_clock))
+        self.metrics.gauge("merkle_root", self.merkle.root) # equal on all the servers once they have converged
 
-        self.api_thread = threading.Thread(target=self._client_handler)
-        self.api_thread.start()
+        self.drop_rate = self.config.get("drop_rate", 0)
+        self.coalesce_interval = self.config.get("coalesce_interval", 0)
+        self.delta = {} # key -> (timestamp, value, deadline, time of its first write since the last delta), only used by the client handler
+        self.delta_started = 0
+        self.anti_entropy_interval = self.config.get("anti_entropy_interval", 1)
+        self.anti_entropy_socket = self.context.socket(zmq.ROUTER) # to answer the anti-entropy rounds of the other servers
+        self.anti_entropy_socket.bind(self._bind_address(self.recv_port))
+        self.anti_entropy_server_thread = self._start_thread(self._anti_entropy_server)
+        if self.anti_entropy_interval:
+            self.anti_entropy_thread = self._start_thread(self._anti_entropy)
 
-        self.recv_thread = threading.Thread(target=self._server_handler)
-        self.recv_thread.start()
+        self.api_thread = self._start_thread(self._client_handler)
+
+        self.recv_thread = self._start_thread(self._server_handler)
 
 
     def _update_clock(self, timestamp=0): # if no timestamp is given, then it is a local event, just increment the clock
         with self.lamport_clock_lock:
             self.lamport_clock = max(self.lamport_clock, timestamp) + 1
+            return self.lamport_clock
 
     def _broadcast(self, message):
-        self.send_socket.send_json(message)        
+        self._send_message(message)
         self._update_clock()
 
-    def _client_handler(self):
+    def _writes(self, operations, timestamps, id):
         """
-        This method is responsible for handling the requests from the clients.
+        The writes (key, timestamp, id, value, deadline) of the sets of a message, the deadline is the one of the ttl
+        that follows the set of a key, None if there is none.
         """
-        while 1:
-            socks = dict(self.poller.poll())
-            if self.api_socket in socks:
-                message = self.api_socket.recv_json()
-                # print(f"Server {self.server_number} received message: {message}")
-                self._update_clock()
-                if message["type"] == "get": # local read 
-                    self.api_socket.send_string(f"{message['key']}:{self.kv_store[message['key']]}")
-                    print(f"Server {self.server_number} got the value of the key {message['key']} as {self.kv_store[message['key']]}")
-                elif message["type"] == "set":
-                    with self.kv_store_lock:
-                        self.kv_store[message["key"]] = message["value"]
-                    self.api_socket.send_string("success")
-                    print(f"Server {self.server_number} set the value of the key {message['key']} to {message['value']}")
-                    self._update_clock()
-                    broadcast_message = {"timestamp": self.lamport_clock,
-                                            "operation": message["type"],
-                                            "key": message["key"],
-                                            "value": message["value"],
-                                            "id": self.server_number}
-                    self._broadcast(broadcast_message)
+        deadlines = {key: value for operation, key, value in operations if operation == "ttl"}
+        return [(key, timestamp, id, value, deadlines.get(key))
+                for (operation, key, value), timestamp in zip(operations, timestamps) if operation == "set"]
+
+    def _merge(self, writes):
+        """
+        Apply the writes [(key, timestamp, id, value, deadline), ...] together, except the ones to a key that already
+        has a later write (last-writer-wins), so that an mget never sees a part of a multi-key write. Returns the number applied.
+        """
+        applied = []
+        latest = {} # key -> its write so far in writes
+        with self.last_modified_lock:
+            for key, timestamp, id, value, deadline in writes:
+                modification = (timestamp, id, value, deadline)
+                if latest.get(key, self.last_modified.get(key, ())) < modification:
+                    latest[key] = modification
+                    applied.append((key, timestamp, id, value, deadline))
+            if applied:
+                with self.kv_store_lock:
+                    # one log record per write, i.e. per (timestamp, id), a message holds a single one, applied right
+                    # after it is logged, and last_modified with it, so that a snapshot matches the logged records
+                    for (timestamp, id), group in itertools.groupby(applied, key=lambda write: write[1:3]):
+                        group = list(group)
+                        deadlines = [[key, deadline] for key, _, _, _, deadline in group if deadline is not None]
+                        self._persist(timestamp, id, [(key, value) for key, _, _, value, _ in group],
+                                      {"deadlines": deadlines} if deadlines else None)
+                        for key, timestamp, id, value, deadline in group:
+                            self.merkle.update(key, self.last_modified.get(key, ())[:2], (timestamp, id))
+                            self.last_modified[key] = (timestamp, id, value, deadline)
+                            self._write("set", key, value)
+                            if deadline is not None:
+                                self._write("ttl", key, deadline)
+        return len(applied)
+
+    def _housekeep(self):
+        """
+        Expire the keys past their deadlines, their writes stay in last_modified and in the merkle tree.
+        """
+        with self.last_modified_lock:
+            with self.kv_store_lock:
+                expired = self.wheel.advance(int(1000 * time.time()))
+                self._persist(self.lamport_clock, self.server_number, [(key, REMOVED) for key in expired])
+                for key in expired:
+                    self._write("expire", key, self.deadlines[key])
+
+    def _state(self): # must be called with last_modified_lock and kv_store_lock held
+        """
+        The deadlines and the writes of last_modified, those of the expired keys included.
+        """
+        return super()._state() | {"versions": [[key, *modification] for key, modification in self.last_modified.items()]}
+
+    def _restore(self, timestamp, id, writes, state):
+        """
+        The writes of a record go to last_modified at its (timestamp, id), with their deadlines, and the removals of
+        the expired keys leave their writes there. A snapshot has the whole of last_modified.
+        """
+        super()._restore(timestamp, id, writes, state)
+        deadlines = dict((state or {}).get("deadlines", []))
+        modifications = [(key, (timestamp, id, value, deadlines.get(key))) for key, value in writes if value is not REMOVED]
+        modifications += [(key, tuple(modification)) for key, *modification in (state or {}).get("versions", [])]
+        for key, modification in modifications:
+            self.merkle.update(key, self.last_modified.get(key, ())[:2], modification[:2])
+            self.last_modified[key] = modification
+
+    def _leaf_entries(self, leaves): # must be called with last_modified_lock held
+        return [(key,) + self.last_modified[key] for key in self.merkle.leaf_keys(leaves)]
+
+    def _handle_request(self, client, message):
+        timestamp = self._update_clock()
+        if message["type"] in READS: # local read
+            self._local_read(client, message)
+        elif message["type"] in ["set", "mset", "atomic_mset"]:
+            # all the keys of a multi-key write share its version and travel in one message
+            operations = self._operations(message)
+            writes = self._writes(operations, [timestamp] * len(operations), self.server_number)
+            self._merge(writes)
+            self._reply(client, {"type": message["type"], "key": message["key"], "value": None})
+            self._log_operation(message["type"], message["key"], message["value"])
+            if self.coalesce_interval:
+                self._coalesce(writes)
+                return
+            broadcast_message = {"timestamp": timestamp,
+                                    "operations": operations,
+                                    "ack": 0,
+                                    "id": self.server_number}
+            self._broadcast(broadcast_message)
+
+    def _coalesce(self, writes):
+        """
+        Keep the writes for the next delta, where a key only keeps its last write.
+        """
+        now = time.monotonic()
+        if not self.delta:
+            self.delta_started = now
+        for key, timestamp, id, value, deadline in writes:
+            first = now
+            if key in self.delta:
+                first = self.delta[key][3]
+                self.metrics.counter("writes_coalesced").inc()
+            self.delta[key] = (timestamp, value, deadline, first)
+
+    def _flush_delta(self):
+        """
+        Broadcast the last write of every key written since the last delta in one message, with the timestamp of every
+        write. The writes are sorted by timestamp, so that the keys of a multi-key write stay together.
+        """
+        now = time.monotonic()
+        writes = sorted(self.delta.items(), key=lambda item: item[1][0])
+        delay = self.metrics.histogram("coalesce_delay_ms") # how much later the other replicas see a key
+        operations, timestamps = [], []
+        for key, (timestamp, value, deadline, first) in writes:
+            delay.observe(1000 * (now - first))
+            operations.append(("set", key, value))
+            timestamps.append(timestamp)
+            if deadline is not None:
+                operations.append(("ttl", key, deadline))
+                timestamps.append(timestamp)
+        self.metrics.histogram("delta_keys", SIZE_BUCKETS).observe(len(writes))
+        self._broadcast({"timestamp": writes[-1][1][0],
+                         "operations": operations,
+                         "timestamps": timestamps,
+                         "ack": 0,
+                         "id": self.server_number})
+        self.delta = {}
+
+    def _poll_timeout(self):
+        timeout = super()._poll_timeout()
+        if not self.delta:
+            return timeout
+        interval = max(0, self.coalesce_interval - 1000 * (time.monotonic() - self.delta_started))
+        return interval if timeout is None else min(timeout, interval)
+
+    def _after_poll(self):
+        super()._after_poll()
+        if self.delta and 1000 * (time.monotonic() - self.delta_started) >= self.coalesce_interval:
+            self._flush_delta()
 
     def _server_handler(self):
         """
         This method is responsible for handling the requests from the other servers.
         """
         while 1:
-            message = self.recv_socket.recv_json()
+            message = self._recv_message()
+            if self.drop_rate and random.random() < self.drop_rate:
+                self.metrics.counter("messages_dropped").inc()
+                continue
             id = message["id"]
-            print(f"Server {self.server_number} received message from Server {id}: {message}")
+            if self.log_mode == "print":
+                print(f"Server {self.server_number} received message from Server {id}: {message}")
             self._update_clock(message["timestamp"])
-            modification = (message["timestamp"], message["id"], message["value"])
-            with self.last_modified_lock:
-                if self.last_modified[message["key"]] < modification:
-                    self.last_modified[message["key"]] = (message["timestamp"], message["value"])
-                    with self.kv_store_lock:
-                        self.kv_store[message["key"]] = message["value"]
+            self.last_heard[id] = max(self.last_heard.get(id, 0), message["timestamp"])
+            # a delta has the timestamp of every write, the timestamp of the message is the last one
+            timestamps = message.get("timestamps", [message["timestamp"]] * len(message["operations"]))
+            self._merge(self._writes(message["operations"], timestamps, id))
+
+    def _anti_entropy_server(self):
+        """
+        Answer the anti-entropy requests of the other servers: either the digests of some nodes of a level of our tree,
+        or our entries of some leaves, after merging the entries of the same leaves that the other server sent.
+        """
+        while 1:
+            identity, empty, data = self.anti_entropy_socket.recv_multipart()
+            request = from_json(data) # the entries may hold bytes values
+            if request["type"] == "digests":
+                with self.last_modified_lock:
+                    response = self.merkle.digests(request["level"], request["nodes"])
+            else: # "entries"
+                with self.last_modified_lock:
+                    response = self._leaf_entries(request["leaves"])
+                self.metrics.counter("anti_entropy_repaired").inc(self._merge(request["entries"]))
+            reply = to_json(response)
+            self.metrics.counter("anti_entropy_bytes").inc(len(data) + len(reply))
+            self.anti_entropy_socket.send_multipart([identity, empty, reply])
+
+    def close(self):
+        for thread in [self.anti_entropy_server_thread] + ([self.anti_entropy_thread] if self.anti_entropy_interval else []):
+            thread.join()
+        self.anti_entropy_socket.close(linger=0)
+        super().close()
+
+    def _anti_entropy_request(self, socket, request):
+        socket.send(to_json(request))
+        if not socket.poll(1000):
+            raise TimeoutError
+        return from_json(socket.recv())
+
+    def _anti_entropy(self):
+        """
+        Run an anti-entropy round with a random other server every anti_entropy_interval seconds.
+        The trees are compared level by level, only the children of the nodes that differ are compared at the next level,
+        then both servers exchange and merge their entries of the leaves that differ.
+        """
+        peers = [contact for contact in self.contacts if int(contact) != self.server_number]
+        while peers:
+            time.sleep(self.anti_entropy_interval)
+            peer = random.choice(peers)
+            # a new REQ socket per round, so that a server that does not answer does not block the next rounds
+            socket = self.context.socket(zmq.REQ)
+            socket.connect(self._connect_address(self.contacts[peer][0]))
+            try:
+                nodes = [0]
+                for level in range(self.merkle.depth + 1):
+                    theirs = self._anti_entropy_request(socket, {"type": "digests", "level": level, "nodes": nodes})
+                    with self.last_modified_lock:
+                        ours = self.merkle.digests(level, nodes)
+                    nodes = [node for node, our, their in zip(nodes, ours, theirs) if our != their]
+                    if level < self.merkle.depth:
+                        nodes = self.merkle.children(nodes)
+                self.metrics.counter("anti_entropy_rounds").inc()
+                if nodes:
+                    with self.last_modified_lock:
+                        entries = self._leaf_entries(nodes)
+                    theirs = self._anti_entropy_request(socket, {"type": "entries", "leaves": nodes, "entries": entries})
+                    self.metrics.counter("anti_entropy_leaves").inc(len(nodes))
+                    self.metrics.counter("anti_entropy_repaired").inc(self._merge(theirs))
+            except TimeoutError:
+                self.metrics.counter("anti_entropy_timeouts").inc()
+            finally:
+                socket.close(linger=0)
 
 
 class Server_causal(Server):
-    def __init__(self, server_number, port_number, contacts):
-        super().__init__(server_number, port_number, contacts)
+    """
+    This class represents a server in the cluster with causal consistency level.
+    A write is applied and answered locally right away, then broadcasted with its dependencies: the number of writes of
+    each other server applied here before it (the non-zero entries of our vector clock), while the timestamp of the
+    message is its sequence number among the writes of its sender. A server applies a remote write once it has applied
+    the previous write of the sender and all the dependencies, so a write is never visible before the writes it may
+    depend on. A write that arrives too early waits in `waiting`, indexed by the one (server, count) it is blocked on,
+    so applying a write only looks at the writes that were waiting for it instead of rescanning every buffered write.
+
+    Concurrent writes to the same key are resolved with the version (sum of the vector clock, id) of each write:
+    a write that causally follows another has a larger sum, so the versions never reorder causally related writes,
+    and every server ends up with the concurrent write that has the largest version.
+    A client gets the session guarantees (read your writes, monotonic reads, writes follow reads) by staying on one server.
+    Every server expires a key with a ttl at its deadline, and keeps its version, so that a concurrent write with
+    a lower version that arrives later does not bring the key back on some servers only.
+    With durability, the vector clock and the versions are logged with the writes and saved in the snapshots, so a
+    restarted server goes on numbering its writes from where it stopped.
+    """
+    def __init__(self, server_number, port_number, contacts, config=None, network=None):
+        # guards the vector clock, the versions and the waiting writes, shared by the client handler and the server handler
+        self.causal_lock = threading.Lock()
+        # before Server.__init__, which recovers them with the store (see `_restore`)
+        self.vector = {int(contact): 0 for contact in contacts} # number of writes of each server applied here
+        self.versions = {} # key -> version of its current value
+
+        super().__init__(server_number, port_number, contacts, config, network)
+
+        self.waiting = defaultdict(list) # (server, count) -> remote writes that cannot be applied before that write
+        self.num_waiting = 0
+
+        self.metrics.gauge("vector_clock", lambda: dict(self.vector))
+        self.metrics.gauge("waiting_writes", lambda: self.num_waiting)
+
+        self.api_thread = self._start_thread(self._client_handler)
+
+        self.recv_thread = self._start_thread(self._server_handler)
+
+
+    def _apply(self, id, operations, version, count): # must be called with causal_lock held
+        """
+        Apply the (operation, key, value) of a write together, except on the keys where a concurrent write with
+        a larger version is already applied, as the count-th write of its sender in the vector clock. The count is
+        logged with the write, even if it applies to no key.
+        """
+        writes = [(key, value) for operation, key, value in operations
+                  if operation == "set" and version > self.versions.get(key, (0, -1))]
+        deadlines = {key: value for operation, key, value in operations if operation == "ttl"}
+        logged = [[key, deadlines[key]] for key, value in writes if key in deadlines]
+        with self.kv_store_lock:
+            self._persist(version[0], id, writes, {"vector": [[id, count]]} | ({"deadlines": logged} if logged else {}))
+            for key, value in writes:
+                self.versions[key] = version
+                self._write("set", key, value)
+                if key in deadlines:
+                    self._write("ttl", key, deadlines[key])
+            self.vector[id] = count
+
+    def _state(self): # must be called with causal_lock and kv_store_lock held
+        """
+        The deadlines, the versions of the keys, those of the expired keys included, and the vector clock.
+        """
+        return super()._state() | {"versions": [[key, *version] for key, version in self.versions.items()],
+                                   "vector": list(self.vector.items())}
+
+    def _restore(self, timestamp, id, writes, state):
+        """
+        The writes of a record have the version (timestamp, id), the removals of the expired keys keep theirs, and the
+        vector clock counts the writes of the record.
+        """
+        super()._restore(timestamp, id, writes, state)
+        self.versions.update((key, (timestamp, id)) for key, value in writes if value is not REMOVED)
+        self.versions.update((key, tuple(version)) for key, *version in (state or {}).get("versions", []))
+        for server, count in (state or {}).get("vector", []):
+            self.vector[server] = max(self.vector.get(server, 0), count)
+
+    def _housekeep(self):
+        """
+        Expire the keys past their deadlines.
+        """
+        with self.causal_lock: # a snapshot taken here reads the vector clock and the versions
+            with self.kv_store_lock:
+                expired = self.wheel.advance(int(1000 * time.time()))
+                self._persist(sum(self.vector.values()), self.server_number, [(key, REMOVED) for key in expired])
+                for key in expired:
+                    self._write("expire", key, self.deadlines[key])
+
+    def _handle_request(self, client, message):
+        if message["type"] in READS: # local read
+            self._local_read(client, message)
+        elif message["type"] in ["set", "mset", "atomic_mset"]:
+            operations = self._operations(message) # a multi-key write is a single write of the vector clock
+            with self.causal_lock:
+                timestamp = self.vector[self.server_number] + 1
+                deps = [[server, count] for server, count in self.vector.items() if count and server != self.server_number]
+                self._apply(self.server_number, operations, (sum(self.vector.values()) + 1, self.server_number), timestamp)
+            self._reply(client, {"type": message["type"], "key": message["key"], "value": None})
+            self._log_operation(message["type"], message["key"], message["value"])
+            # only this thread sends, so the writes leave in the order of their timestamps
+            self._send_message({"timestamp": timestamp,
+                                "id": self.server_number,
+                                "ack": 0,
+                                "operations": operations,
+                                "deps": deps})
+
+    def _blocker(self, message): # must be called with causal_lock held
+        """
+        The (server, count) the remote write waits for, None if it can be applied.
+        """
+        if self.vector[message["id"]] < message["timestamp"] - 1:
+            return (message["id"], message["timestamp"] - 1)
+        for server, count in message["deps"]:
+            if self.vector[server] < count:
+                return (server, count)
+        return None
+
+    def _server_handler(self):
+        """
+        This method is responsible for handling the writes from the other servers.
+        """
+        while 1:
+            message = self._recv_message()
+            if "ping" in message or message["id"] == self.server_number: # our own writes are already applied
+                continue
+            with self.causal_lock:
+                ready = [message]
+                while ready:
+                    message = ready.pop()
+                    id, timestamp = message["id"], message["timestamp"]
+                    if timestamp <= self.vector[id]: # already applied
+                        continue
+                    blocker = self._blocker(message)
+                    if blocker is not None:
+                        message.setdefault("received", time.perf_counter())
+                        self.waiting[blocker].append(message)
+                        self.num_waiting += 1
+                        continue
+                    if "received" in message:
+                        self.metrics.histogram("dependency_wait_ms").observe(1000 * (time.perf_counter() - message["received"]))
+                    version = (timestamp + sum(count for server, count in message["deps"]), id)
+                    self._apply(id, message["operations"], version, timestamp)
+                    # the vector entries only grow one by one, so the writes waiting for this one are exactly under its key
+                    unblocked = self.waiting.pop((id, timestamp), [])
+                    self.num_waiting -= len(unblocked)
+                    ready.extend(unblocked)
+
+
+SERVERS = {"linearizability": Server_linearizability,
+           "sequential": Server_sequential,
+           "eventual": Server_eventual,
+           "causal": Server_causal}
+
+# the classes of the consistency levels for every "ordering" of server_config, the levels without a total order have one
+ORDERINGS = {"lamport": SERVERS,
+             "leader": {"linearizability": Server_leader_linearizability, "sequential": Server_leader_sequential}}
+
+
+def server_class(consistency_level, config=None):
+    """
+    The class of the servers of a consistency level, given the ordering of their config: "lamport" (default) or "leader".
+    """
+    ordering = (config or {}).get("ordering", "lamport")
+    if ordering not in ORDERINGS:
+        raise ValueError("The ordering must be one of the following: lamport, leader.")
+    return ORDERINGS[ordering].get(consistency_level, SERVERS[consistency_level])
+
 
-    # TODO: implement the eventual consistency level
-                
-    
 if __name__ == "__main__":
-    server_number, port_number, consistency_level = sys.argv[1:]
-    port_number = eval(port_number)
+    server_number, port_number, consistency_level = sys.argv[1:4]
+    port_number = json.loads(port_number)
+    config = json.loads(sys.argv[4]) if len(sys.argv) > 4 else {}
     own_port = port_number[server_number]
 
-    if consistency_level == "linearizability":
-        server = Server_linearizability(server_number, 
-                                        own_port,
-                                        contacts=port_number)
-    elif consistency_level == "sequential":
-        server = Server_sequential(server_number, 
-                                   own_port,
-                                   contacts=port_number)
-    elif consistency_level == "eventual":
-        server = Server_eventual(server_number, 
-                                 own_port,
-                                 contacts=port_number)
-    elif consistency_level == "causal":
-        server = Server_causal(server_number, 
-                               own_port,
-                               contacts=port_number)
-
+    server = server_class(consistency_level, config)(server_number,
+                                                     own_port,
+                                                     contacts=port_number,
+                                                     config=config)
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    try:
+        server.api_thread.join() # the threads of the server are daemons
+    finally:
+        if server.durability is not None:
+            server.durability.close()
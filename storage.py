@@ -0,0 +1,193 @@
+import struct
+import threading
+from array import array
+
+from codec import encode_value, decode_value
+
+
+"""
+Storage engines behind `Server.kv_store`. Every engine has the same interface:
+- get(key): the value of the key, None if the key is missing
+- put(key, value)
+- delete(key): remove the key if it is present
+- iterate(): iterator over the (key, value) pairs of a point-in-time copy of the store, it can be consumed by any thread
+- size(): number of keys
+get can be called concurrently with put and delete, the writers are serialized by the caller (kv_store_lock).
+"""
+
+
+class DictStorage:
+    """
+    The plain python dict, fastest for small stores. Every entry costs a dict slot plus a key and a value object.
+    """
+    def __init__(self):
+        self.data = {}
+
+    def get(self, key):
+        return self.data.get(key)
+
+    def put(self, key, value):
+        self.data[key] = value
+
+    def delete(self, key):
+        self.data.pop(key, None)
+
+    def iterate(self):
+        return iter(list(self.data.items()))
+
+    def size(self):
+        return len(self.data)
+
+
+# slot states of the index, any other value is the offset of the record in the arena
+EMPTY = -1
+DELETED = -2
+
+RECORD = struct.Struct("<BIBI") # key type, key length, value type, value length, followed by the key and the value
+
+
+class ArenaStorage:
+    """
+    Compact store for large keyspaces: the keys and the values are encoded (see `codec.encode_value`) and appended as
+    records to one contiguous bytearray, and an open-addressing index with linear probing maps the keys to the offsets
+    of their records. An entry costs its record (10 bytes plus the encoded key and value) and 17 to 34 bytes of index,
+    instead of three python objects. An overwrite or a delete leaves a dead record, the arena is compacted once
+    the dead records take more than half of it.
+    """
+    def __init__(self, capacity=1024, max_load=0.7):
+        self.max_load = max_load
+        self.arena = bytearray()
+        self.offsets = array("q", [EMPTY]) * capacity # capacity is a power of 2
+        self.hashes = array("I", [0]) * capacity # low 32 bits of the hash of the key in each slot, to skip most compares
+        self.count = 0 # live keys
+        self.used = 0 # live and deleted slots
+        self.garbage = 0 # bytes of the dead records
+        self.lock = threading.Lock() # get must not see a half-done resize or compaction
+
+    def _find(self, key_type, key, h):
+        """
+        Returns the slot of the key (-1 if missing) and the slot where it would be inserted.
+        """
+        mask = len(self.offsets) - 1
+        i = h & mask
+        free = -1
+        while 1:
+            offset = self.offsets[i]
+            if offset == EMPTY:
+                return -1, (free if free >= 0 else i)
+            if offset == DELETED:
+                if free < 0:
+                    free = i
+            elif self.hashes[i] == h:
+                record_key_type, key_length, _, _ = RECORD.unpack_from(self.arena, offset)
+                if (record_key_type == key_type and key_length == len(key)
+                        and self.arena.startswith(key, offset + RECORD.size)):
+                    return i, i
+            i = (i + 1) & mask
+
+    def _record_size(self, offset):
+        _, key_length, _, value_length = RECORD.unpack_from(self.arena, offset)
+        return RECORD.size + key_length + value_length
+
+    def get(self, key):
+        key_type, key = encode_value(key)
+        h = hash(key) & 0xFFFFFFFF
+        with self.lock:
+            slot, _ = self._find(key_type, key, h)
+            if slot < 0:
+                return None
+            offset = self.offsets[slot]
+            _, key_length, value_type, value_length = RECORD.unpack_from(self.arena, offset)
+            start = offset + RECORD.size + key_length
+            value = self.arena[start:start + value_length]
+        return decode_value(value_type, value)
+
+    def put(self, key, value):
+        key_type, key = encode_value(key)
+        value_type, value = encode_value(value)
+        h = hash(key) & 0xFFFFFFFF
+        with self.lock:
+            slot, free = self._find(key_type, key, h)
+            offset = len(self.arena)
+            self.arena += RECORD.pack(key_type, len(key), value_type, len(value))
+            self.arena += key
+            self.arena += value
+            if slot >= 0: # overwrite
+                self.garbage += self._record_size(self.offsets[slot])
+                self.offsets[slot] = offset
+            else:
+                if self.offsets[free] == EMPTY:
+                    self.used += 1
+                self.offsets[free] = offset
+                self.hashes[free] = h
+                self.count += 1
+                if self.used > self.max_load * len(self.offsets):
+                    self._resize()
+            if self.garbage > len(self.arena) // 2:
+                self._compact()
+
+    def delete(self, key):
+        key_type, key = encode_value(key)
+        h = hash(key) & 0xFFFFFFFF
+        with self.lock:
+            slot, _ = self._find(key_type, key, h)
+            if slot < 0:
+                return
+            self.garbage += self._record_size(self.offsets[slot])
+            self.offsets[slot] = DELETED
+            self.count -= 1
+            if self.garbage > len(self.arena) // 2:
+                self._compact()
+
+    def _resize(self): # must be called with the lock held
+        """
+        Rebuild the index without the deleted slots, twice as large if the live keys alone are past half the load limit.
+        """
+        capacity = len(self.offsets)
+        if self.count > self.max_load * capacity / 2:
+            capacity *= 2
+        offsets = array("q", [EMPTY]) * capacity
+        hashes = array("I", [0]) * capacity
+        mask = capacity - 1
+        for offset, h in zip(self.offsets, self.hashes):
+            if offset < 0:
+                continue
+            i = h & mask
+            while offsets[i] != EMPTY: # the keys are unique, so only free slots are looked for
+                i = (i + 1) & mask
+            offsets[i] = offset
+            hashes[i] = h
+        self.offsets, self.hashes = offsets, hashes
+        self.used = self.count
+
+    def _compact(self): # must be called with the lock held
+        """
+        Copy the live records to a new arena, in the order of the index.
+        """
+        arena = bytearray()
+        for i, offset in enumerate(self.offsets):
+            if offset < 0:
+                continue
+            self.offsets[i] = len(arena)
+            arena += self.arena[offset:offset + self._record_size(offset)]
+        self.arena = arena
+        self.garbage = 0
+
+    def iterate(self):
+        with self.lock:
+            arena = bytes(self.arena)
+            offsets = array("q", (offset for offset in self.offsets if offset >= 0))
+        return self._decode_records(arena, offsets)
+
+    def _decode_records(self, arena, offsets):
+        for offset in offsets:
+            key_type, key_length, value_type, value_length = RECORD.unpack_from(arena, offset)
+            start = offset + RECORD.size
+            yield (decode_value(key_type, arena[start:start + key_length]),
+                   decode_value(value_type, arena[start + key_length:start + key_length + value_length]))
+
+    def size(self):
+        return self.count
+
+
+STORAGES = {"dict": DictStorage, "arena": ArenaStorage}